@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# Benchmarks iptables_gui.py against synthetic rulesets and conntrack tables.
+# Stub sudo/iptables executables are put on PATH, so this needs neither root
+# nor netfilter.
+#
+#   python3 benchmark.py run --sizes 1000,10000,100000
+#   python3 benchmark.py compare            (last two runs)
+#   python3 benchmark.py compare OLD NEW
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(HERE, '.benchmarks')
+
+# Every stub logs its command line, that's how subprocesses are counted
+STUB = '''#!/bin/sh
+echo "{name} $*" >> "$BENCH_CALLS"
+{body}
+'''
+STUBS = {
+    'sudo': '[ "$1" = "-n" ] && shift\nexec "$@"',
+    'iptables-save': 'cat "$BENCH_RULES"',
+    'iptables-restore': 'cat > /dev/null',
+    'iptables': 'exit 0',
+    # The IPv6 side dumps the same synthetic ruleset, only its cost matters
+    'ip6tables-save': 'cat "$BENCH_RULES"',
+    'ip6tables-restore': 'cat > /dev/null',
+    'ip6tables': 'exit 0',
+    'ipset': 'exit 0',
+}
+
+# name, method, path, form data, drop the cached ruleset before each request
+ROUTES = [
+    ('index', 'GET', '/', None, True),
+    ('index_cached', 'GET', '/', None, False),
+    ('index_gzip', 'GET', '/', None, False),
+    ('index_304', 'GET', '/', None, False),
+    ('get_rules', 'GET', '/get_rules/filter/INPUT', None, True),
+    ('api_rules', 'GET', '/api/rules?table=filter&chain=CHAIN_0&limit=200', None, False),
+    ('api_search', 'GET', '/api/search?address=10.1.2.3', None, False),
+    ('api_analysis', 'GET', '/api/analysis', None, True),
+    ('api_profile', 'GET', '/api/profile', None, True),
+    ('add_rule', 'POST', '/add_rule', {'table': 'filter', 'chain': 'INPUT', 'action': 'ACCEPT',
+                                       'protocol': 'tcp', 'dest_port': '8080'}, False),
+    ('delete_rule', 'POST', '/delete_rule', {'table': 'filter', 'chain': 'INPUT', 'rule_number': '1'}, False),
+    ('stage_commit', 'POST', '/commit_changes', None, False),
+    ('conntrack_summary', 'GET', '/api/conntrack/summary?refresh=1', None, False),
+    ('conntrack_page', 'GET', '/api/conntrack?offset=1000&protocol=tcp&limit=100', None, False),
+]
+
+def synthetic_ruleset(size, chains, nat_share, seed=1):
+    # iptables-save -c output: a NAT table with DNAT/SNAT pairs and a filter
+    # table whose INPUT/FORWARD jump into many custom chains
+    rng = random.Random(seed)
+    counters = lambda: f"[{rng.randrange(100000)}:{rng.randrange(10000000)}]"
+    nat = int(size * nat_share)
+    custom = [f'CHAIN_{i}' for i in range(chains)]
+    lines = ['*nat', ':PREROUTING ACCEPT [0:0]', ':INPUT ACCEPT [0:0]',
+             ':OUTPUT ACCEPT [0:0]', ':POSTROUTING ACCEPT [0:0]']
+    for i in range(nat):
+        if i % 2:
+            lines.append(f"{counters()} -A PREROUTING -d 203.0.{i // 256 % 256}.{i % 256}/32 -i eth0 -p tcp "
+                         f"-m tcp --dport {1024 + i % 60000} -j DNAT --to-destination 10.{i % 256}.0.{i % 250 + 1}:80")
+        else:
+            lines.append(f"{counters()} -A POSTROUTING -s 10.{i // 256 % 256}.{i % 256}.0/24 -o eth0 "
+                         f"-j SNAT --to-source 198.51.100.{i % 250 + 1}")
+    lines += ['COMMIT', '*filter', ':INPUT DROP [0:0]', ':FORWARD DROP [0:0]', ':OUTPUT ACCEPT [0:0]']
+    lines += [f':{name} - [0:0]' for name in custom]
+    for i, name in enumerate(custom):
+        lines.append(f"{counters()} -A {'INPUT' if i % 2 else 'FORWARD'} -s 10.{i % 256}.0.0/16 -j {name}")
+    for i in range(max(size - nat - len(custom), 0)):
+        chain = 'INPUT' if i % 5 == 0 or not custom else custom[i // 5 % len(custom)]
+        kind = rng.random()
+        if kind < 0.5:
+            spec = (f"-s 10.{rng.randrange(256)}.{rng.randrange(256)}.0/24 -p tcp -m tcp "
+                    f"--dport {rng.randrange(1, 65535)} -j ACCEPT")
+        elif kind < 0.7:
+            spec = f"-d 192.168.{rng.randrange(256)}.{rng.randrange(256)}/32 -j DROP"
+        elif kind < 0.9:
+            spec = f"-i eth{rng.randrange(4)} -p udp -m udp --dport {rng.randrange(1, 65535)} -j ACCEPT"
+        else:
+            spec = "-m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT"
+        lines.append(f"{counters()} -A {chain} {spec}")
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+def synthetic_conntrack(size, seed=1):
+    # /proc/net/nf_conntrack lines: clients behind SNAT with a skewed number
+    # of connections each, some DNAT to internal servers, UDP DNS queries
+    rng = random.Random(seed)
+    lines = []
+    for i in range(size):
+        client = f"10.{rng.randrange(4)}.{rng.randrange(16)}.{int(rng.paretovariate(1.1)) % 254 + 1}"
+        server = f"93.184.{rng.randrange(8)}.{int(rng.paretovariate(1.5)) % 254 + 1}"
+        sport = rng.randrange(1024, 65535)
+        kind = rng.random()
+        if kind < 0.2:
+            lines.append(f"ipv4     2 udp      17 29 src={client} dst=198.51.100.53 sport={sport} dport=53 "
+                         f"src=198.51.100.53 dst=203.0.113.1 sport=53 dport={sport} mark=0 zone=0 use=2")
+        elif kind < 0.3:
+            backend = f"10.9.0.{i % 8 + 1}"
+            lines.append(f"ipv4     2 tcp      6 431999 ESTABLISHED src={server} dst=203.0.113.1 sport={sport} dport=443 "
+                         f"src={backend} dst={server} sport=8443 dport={sport} [ASSURED] mark=0 zone=0 use=2")
+        else:
+            lines.append(f"ipv4     2 tcp      6 431999 ESTABLISHED src={client} dst={server} sport={sport} dport=443 "
+                         f"src={server} dst=203.0.113.1 sport=443 dport={sport} [ASSURED] mark=0 zone=0 use=2")
+    return '\n'.join(lines) + '\n'
+
+def write_stubs(directory):
+    for name, body in STUBS.items():
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(STUB.format(name=name, body=body))
+        os.chmod(path, 0o755)
+
+def count_calls(path):
+    # Commands the app ran, the sudo stub only forwards to them
+    with open(path) as f:
+        return sum(1 for line in f if not line.startswith('sudo '))
+
+def run_worker(args):
+    # One size per process so peak RSS belongs to that size alone
+    sys.path.insert(0, HERE)
+    import iptables_gui
+    client = iptables_gui.app.test_client()
+    calls = os.environ['BENCH_CALLS']
+    results = {}
+    for name, method, path, data, cold in ROUTES:
+        latencies = []
+        spawned = []
+        size = 0
+        for i in range(args.repeat):
+            if name == 'stage_commit':
+                client.post('/stage/add_rule', data={'table': 'filter', 'chain': 'INPUT', 'action': 'ACCEPT',
+                                                     'protocol': 'tcp', 'dest_port': str(9000 + i)})
+            headers = {}
+            if name == 'index_gzip':
+                headers['Accept-Encoding'] = 'gzip'
+            if name == 'index_304':
+                headers['If-None-Match'] = client.get('/').headers['ETag']
+            if cold:
+                for cache in iptables_gui.ruleset_caches.values():
+                    cache.invalidate()
+            before = count_calls(calls)
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=data, headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+            spawned.append(count_calls(calls) - before)
+            size = len(response.get_data())
+            if response.status_code >= 400:
+                raise SystemExit(f"{name}: HTTP {response.status_code}")
+        latencies.sort()
+        results[name] = {'median_ms': statistics.median(latencies),
+                         'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                         'subprocesses': statistics.median(spawned),
+                         'response_bytes': size}
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    json.dump(results, sys.stdout)
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_benchmarks(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = {'commit': current_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0], 'repeat': args.repeat, 'sizes': {}}
+    with tempfile.TemporaryDirectory(prefix='iptables-gui-bench-') as directory:
+        write_stubs(directory)
+        for size in sizes:
+            rules = os.path.join(directory, f'rules-{size}.v4')
+            with open(rules, 'w') as f:
+                f.write(synthetic_ruleset(size, max(4, size // args.rules_per_chain), args.nat_share))
+            conntrack = os.path.join(directory, f'conntrack-{size}')
+            with open(conntrack, 'w') as f:
+                f.write(synthetic_conntrack(size))
+            calls = os.path.join(directory, 'calls.log')
+            open(calls, 'w').close()
+            env = dict(os.environ, PATH=directory + os.pathsep + os.environ['PATH'],
+                       BENCH_RULES=rules, BENCH_CALLS=calls, IPTABLES_GUI_CACHE_TTL='3600',
+                       IPTABLES_GUI_CONNTRACK_FILE=conntrack,
+                       # Synthetic rules stay out of the operator's history
+                       IPTABLES_GUI_HISTORY_DIR='')
+            output = subprocess.check_output([sys.executable, __file__, 'worker', '--repeat', str(args.repeat)],
+                                             env=env)
+            report['sizes'][str(size)] = json.loads(output)
+            print_results(size, report['sizes'][str(size)])
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{report['commit']}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"results saved to {path}")
+
+def print_results(size, results):
+    print(f"\n{size} rules, peak RSS {results['peak_rss_kb'] / 1024:.1f} MB")
+    print(f"{'route':<16}{'median ms':>12}{'p95 ms':>12}{'procs':>8}{'bytes':>12}")
+    for name, _, _, _, _ in ROUTES:
+        route = results[name]
+        print(f"{name:<16}{route['median_ms']:>12.2f}{route['p95_ms']:>12.2f}"
+              f"{route['subprocesses']:>8g}{route['response_bytes']:>12}")
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare_reports(args):
+    paths = args.reports
+    if not paths:
+        saved = sorted(os.listdir(RESULTS_DIR)) if os.path.isdir(RESULTS_DIR) else []
+        if len(saved) < 2:
+            raise SystemExit("need two saved runs in .benchmarks to compare")
+        paths = [os.path.join(RESULTS_DIR, name) for name in saved[-2:]]
+    old, new = load_report(paths[0]), load_report(paths[1])
+    print(f"{old['commit']} ({old['date']}) -> {new['commit']} ({new['date']})")
+    regressions = 0
+    for size in new['sizes']:
+        if size not in old['sizes']:
+            continue
+        before, after = old['sizes'][size], new['sizes'][size]
+        print(f"\n{size} rules, peak RSS {before['peak_rss_kb'] / 1024:.1f} -> {after['peak_rss_kb'] / 1024:.1f} MB")
+        print(f"{'route':<16}{'old ms':>12}{'new ms':>12}{'change':>10}{'procs':>10}")
+        for name, _, _, _, _ in ROUTES:
+            if name not in before or name not in after:
+                continue
+            change = (after[name]['median_ms'] / before[name]['median_ms'] - 1) * 100 if before[name]['median_ms'] else 0
+            flag = ''
+            if change > args.threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print(f"{name:<16}{before[name]['median_ms']:>12.2f}{after[name]['median_ms']:>12.2f}{change:>9.1f}%"
+                  f"{before[name]['subprocesses']:>5g}->{after[name]['subprocesses']:<4g}{flag}")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark iptables_gui.py with stub iptables')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='benchmark the working tree and save the results')
+    run.add_argument('--sizes', default='1000,10000,50000', help='comma separated rule counts')
+    run.add_argument('--repeat', type=int, default=5, help='requests per route')
+    run.add_argument('--rules-per-chain', type=int, default=500, help='average rules per custom chain')
+    run.add_argument('--nat-share', type=float, default=0.3, help='fraction of the rules in the nat table')
+    worker = commands.add_parser('worker')
+    worker.add_argument('--repeat', type=int, default=5)
+    compare = commands.add_parser('compare', help='compare two saved runs, exits 1 on regressions')
+    compare.add_argument('reports', nargs='*', help='OLD NEW result files, the last two runs by default')
+    compare.add_argument('--threshold', type=float, default=20, help='percent slower that counts as a regression')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmarks(args)
+    elif args.command == 'worker':
+        run_worker(args)
+    else:
+        compare_reports(args)
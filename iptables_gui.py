@@ -1,9 +1,41 @@
 #notomoto2 is gui web app to manage iptables  
-from flask import Flask, render_template_string, request, redirect, jsonify
+from flask import Flask, Blueprint, Response, render_template, make_response, request, redirect, jsonify
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 import subprocess
 import re
 import json
-from functools import wraps
+import shlex
+import ipaddress
+import bisect
+import itertools
+import csv
+import difflib
+import io
+import os
+import sys
+import socket
+import socketserver
+import struct
+import argparse
+import time
+import threading
+import queue
+import hashlib
+import hmac
+import http.client
+import urllib.parse
+import zlib
+import gzip
+import shutil
+from collections import Counter, deque
+from html import escape
+from functools import wraps, lru_cache, partial
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 
@@ -107,6 +139,40 @@ HTML_TEMPLATE = """
             border: 1px solid #ebccd1;
             color: #a94442;
         }
+        #rules-viewport {
+            height: 480px;
+            overflow-y: auto;
+            border: 1px solid #ddd;
+        }
+        #rules-spacer {
+            position: relative;
+        }
+        .rules-header, .rule-row {
+            display: grid;
+            grid-template-columns: 50px 80px 90px 130px 110px 50px 40px 1fr 1fr 2fr 200px;
+            align-items: center;
+            height: 32px;
+        }
+        .rules-header {
+            background-color: #4CAF50;
+            color: white;
+        }
+        .rule-row {
+            position: absolute;
+            left: 0;
+            right: 0;
+            border-bottom: 1px solid #ddd;
+        }
+        .rules-header div, .rule-row div {
+            padding: 0 6px;
+            overflow: hidden;
+            white-space: nowrap;
+            text-overflow: ellipsis;
+        }
+        .rule-row .button {
+            padding: 4px 8px;
+            margin: 2px;
+        }
     </style>
     <script>
         function openTab(evt, tabName) {
@@ -123,39 +189,523 @@ HTML_TEMPLATE = """
             evt.currentTarget.className += " active";
         }
 
-        function updateRuleDisplay() {
+        // The rules table only holds the rows in view, pages of rules are
+        // fetched from /api/rules as they scroll into it
+        const ROW_HEIGHT = 32;
+        const PAGE_SIZE = 200;
+        const RULE_FILTERS = ['target', 'protocol', 'source', 'destination', 'interface', 'q'];
+        const FAMILY = {{ family | tojson }};
+        let rulesState = {query: '', total: 0, pages: {}, loading: {}};
+
+        function escapeHtml(value) {
+            return String(value).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]));
+        }
+
+        function updateChainSelect() {
             const table = document.getElementById("table-select").value;
-            const chain = document.getElementById("chain-select").value;
-            fetch(`/get_rules/${table}/${chain}`)
+            const chainSelect = document.getElementById("chain-select");
+            chainSelect.innerHTML = (CHAINS_BY_TABLE[table] || [])
+                .map(chain => `<option value="${escapeHtml(chain)}">${escapeHtml(chain)}</option>`).join('');
+            updateRuleDisplay();
+        }
+
+        function updateRuleDisplay() {
+            const params = new URLSearchParams({
+                family: FAMILY,
+                table: document.getElementById("table-select").value,
+                chain: document.getElementById("chain-select").value
+            });
+            for (const name of RULE_FILTERS) {
+                const value = document.getElementById("filter-" + name).value.trim();
+                if (value) params.set(name, value);
+            }
+            rulesState = {query: params.toString(), total: 0, pages: {}, loading: {}};
+            document.getElementById("rules-viewport").scrollTop = 0;
+            loadRulesPage(0);
+            watchCounters(params.get('table'), params.get('chain'));
+        }
+
+        // Live packet rates for the chain on screen, pushed by the server
+        let counterSource = null;
+        let ruleRates = {};
+
+        function watchCounters(table, chain) {
+            if (counterSource) counterSource.close();
+            ruleRates = {};
+            counterSource = new EventSource('/api/counters/stream?' +
+                new URLSearchParams({family: FAMILY, table: table, chain: chain}));
+            counterSource.onmessage = function(event) {
+                ruleRates = {};
+                for (const rate of JSON.parse(event.data).rules) {
+                    ruleRates[rate.num] = rate;
+                }
+                renderVisibleRules();
+            };
+        }
+
+        function formatRate(value) {
+            if (value >= 1e6) return (value / 1e6).toFixed(1) + 'M';
+            if (value >= 1e3) return (value / 1e3).toFixed(1) + 'K';
+            return value.toFixed(value < 10 ? 1 : 0);
+        }
+
+        function rateCell(rate) {
+            if (!rate) return '';
+            let svg = '';
+            if (rate.history.length > 1) {
+                const max = Math.max(...rate.history, 1);
+                const points = rate.history.map((value, i) =>
+                    `${(i * 60 / (rate.history.length - 1)).toFixed(1)},${(20 - value * 18 / max).toFixed(1)}`).join(' ');
+                svg = `<svg width="60" height="20"><polyline points="${points}" fill="none" stroke="#4CAF50"/></svg>`;
+            }
+            return `${svg} <span title="${formatRate(rate.bps)} bytes/s">${formatRate(rate.pps)}/s</span>`;
+        }
+
+        function loadRulesPage(page) {
+            const state = rulesState;
+            if (state.pages[page] || state.loading[page]) return;
+            state.loading[page] = true;
+            const params = new URLSearchParams(state.query);
+            params.set('offset', page * PAGE_SIZE);
+            params.set('limit', PAGE_SIZE);
+            fetch('/api/rules?' + params)
+                .then(response => response.json())
+                .then(data => {
+                    if (state !== rulesState) return;
+                    if (data.error) {
+                        document.getElementById("rules-count").textContent = data.error;
+                        return;
+                    }
+                    state.pages[page] = data.rules;
+                    state.total = data.total;
+                    renderVisibleRules();
+                });
+        }
+
+        function ruleRow(rule, index, table, chain) {
+            return `<div class="rule-row" style="top: ${index * ROW_HEIGHT}px">
+                <div>${rule.num}</div><div>${rule.packets}</div><div>${rule.bytes}</div>
+                <div>${rateCell(ruleRates[rule.num])}</div>
+                <div>${escapeHtml(rule.target)}</div><div>${escapeHtml(rule.protocol)}</div><div>${rule.opt}</div>
+                <div>${escapeHtml(rule.source)}</div><div>${escapeHtml(rule.destination)}</div>
+                <div title="${escapeHtml(rule.spec)}">${escapeHtml(rule.extra)}</div>
+                <div>
+                    <form method="POST" action="/delete_rule" style="display: inline;">
+                        <input type="hidden" name="family" value="${FAMILY}">
+                        <input type="hidden" name="table" value="${escapeHtml(table)}">
+                        <input type="hidden" name="chain" value="${escapeHtml(chain)}">
+                        <input type="hidden" name="rule_number" value="${rule.num}">
+                        <button type="submit" class="button delete">Delete</button>
+                        <button type="submit" class="button delete" formaction="/stage/delete_rule">Stage</button>
+                    </form>
+                </div>
+            </div>`;
+        }
+
+        function renderVisibleRules() {
+            const viewport = document.getElementById("rules-viewport");
+            const params = new URLSearchParams(rulesState.query);
+            const first = Math.floor(viewport.scrollTop / ROW_HEIGHT);
+            const last = Math.min(first + Math.ceil(viewport.clientHeight / ROW_HEIGHT) + 1, rulesState.total);
+            const rows = [];
+            for (let i = first; i < last; i++) {
+                const page = Math.floor(i / PAGE_SIZE);
+                const rules = rulesState.pages[page];
+                if (!rules) {
+                    loadRulesPage(page);
+                    continue;
+                }
+                rows.push(ruleRow(rules[i - page * PAGE_SIZE], i, params.get('table'), params.get('chain')));
+            }
+            document.getElementById("rules-spacer").style.height = (rulesState.total * ROW_HEIGHT) + 'px';
+            document.getElementById("rules-rows").innerHTML = rows.join('');
+            document.getElementById("rules-count").textContent = rulesState.total + ' rules';
+        }
+
+        function searchRules() {
+            const params = new URLSearchParams({address: document.getElementById("search-address").value.trim(),
+                                                family: FAMILY});
+            const port = document.getElementById("search-port").value.trim();
+            if (port) params.set('port', port);
+            if (document.getElementById("search-any").checked) params.set('any', '1');
+            fetch('/api/search?' + params)
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("search-results");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const rows = data.rules.map(rule => `<tr><td>${escapeHtml(rule.table)}</td><td>${escapeHtml(rule.chain)}</td>
+                        <td>${rule.num}</td><td>${rule.sides.join(', ')}</td><td>${escapeHtml(rule.target)}</td>
+                        <td>${rule.packets}</td><td>${escapeHtml(rule.spec)}</td></tr>`);
+                    results.innerHTML = `<p>${data.total} rules (${data.elapsed_ms.toFixed(3)} ms)</p>
+                        <table><tr><th>Table</th><th>Chain</th><th>Num</th><th>Matched</th><th>Target</th><th>Pkts</th><th>Rule</th></tr>
+                        ${rows.join('')}</table>`;
+                });
+        }
+
+        function simulatePacket() {
+            const packet = Object.fromEntries(new FormData(document.getElementById("simulate-form")));
+            fetch('/api/simulate', {method: 'POST', headers: {'Content-Type': 'application/json'},
+                                    body: JSON.stringify({packet: packet})})
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("simulate-results");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const rows = data.trace.map(step => `<tr><td>${step.hook}</td><td>${escapeHtml(step.table)}</td>
+                        <td>${escapeHtml(step.chain)}</td><td>${step.num || ''}</td><td>${step.event}</td>
+                        <td>${escapeHtml(step.target || step.reason || '')}</td></tr>`);
+                    const where = data.table ? `${data.table}/${data.chain} ${data.num ? 'rule ' + data.num : 'policy'}` : 'no rules';
+                    results.innerHTML = `<div class="status ${data.verdict == 'ACCEPT' ? 'success' : 'error'}">
+                        ${data.verdict} by ${escapeHtml(where)}</div>
+                        <table><tr><th>Hook</th><th>Table</th><th>Chain</th><th>Rule</th><th>Event</th><th>Target</th></tr>
+                        ${rows.join('')}</table>`;
+                });
+        }
+
+        function simulateBatch() {
+            fetch('/api/simulate?limit=0', {method: 'POST', body: new FormData(document.getElementById("simulate-batch-form"))})
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("simulate-results");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const verdicts = Object.entries(data.summary).map(([verdict, count]) => `${verdict}: ${count}`).join(', ');
+                    const rows = Object.entries(data.decided_by).sort((a, b) => b[1] - a[1])
+                        .map(([rule, count]) => `<tr><td>${escapeHtml(rule)}</td><td>${count}</td></tr>`);
+                    const errors = data.errors.map(e => `<li>line ${e.line}: ${escapeHtml(e.error)}</li>`);
+                    results.innerHTML = `<p>${data.count} packets in ${data.elapsed_ms.toFixed(1)} ms: ${verdicts}</p>
+                        ${errors.length ? '<ul>' + errors.join('') + '</ul>' : ''}
+                        <table><tr><th>Decided by</th><th>Packets</th></tr>${rows.join('')}</table>`;
+                });
+        }
+
+        function analyzeRules() {
+            const results = document.getElementById("analysis-results");
+            results.innerHTML = '<p>Analyzing...</p>';
+            fetch('/api/analysis')
+                .then(response => response.json())
+                .then(data => {
+                    const describe = (chain, num) => escapeHtml(chain.specs[num] ? chain.specs[num].spec : '');
+                    const sections = data.chains.map(chain => {
+                        const rows = [];
+                        chain.shadowed.forEach(item => rows.push(`<tr><td>shadowed</td><td>${item.num}</td>
+                            <td>by rule ${item.by} (${escapeHtml(item.by_target)})${item.conflict ? ' <b>conflicting target</b>' : ''}</td>
+                            <td>${describe(chain, item.num)}</td></tr>`));
+                        chain.redundant.forEach(item => rows.push(`<tr><td>redundant</td><td>${item.num}</td>
+                            <td>${item.by == 'policy' ? 'same as policy' : 'by rule ' + item.by}</td>
+                            <td>${describe(chain, item.num)}</td></tr>`));
+                        chain.duplicates.forEach(item => rows.push(`<tr><td>duplicate</td><td>${item.num}</td>
+                            <td>of rule ${item.of}</td><td></td></tr>`));
+                        chain.mergeable.forEach(item => rows.push(`<tr><td>mergeable</td><td>${item.rules.join(', ')}</td>
+                            <td>${item.kind}</td><td>${item.specs.map(escapeHtml).join('<br>')}</td></tr>`));
+                        return `<h3>${escapeHtml(chain.table)}/${escapeHtml(chain.chain)} (${chain.rules} rules)</h3>
+                            <table><tr><th>Finding</th><th>Rule</th><th>Reason</th><th>Spec</th></tr>${rows.join('')}</table>`;
+                    });
+                    results.innerHTML = `<p>${data.rules} rules analyzed in ${data.elapsed_ms.toFixed(1)} ms</p>
+                        ${sections.length ? sections.join('') : '<p>No findings.</p>'}`;
+                });
+        }
+
+        function profileChains() {
+            const results = document.getElementById("profile-results");
+            results.innerHTML = '<p>Profiling...</p>';
+            fetch('/api/profile?' + new URLSearchParams({family: FAMILY}))
+                .then(response => response.json())
+                .then(data => {
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const hooks = Object.entries(data.hooks).map(([hook, item]) => `<tr><td>${hook}</td>
+                        <td>${item.per_packet.toFixed(2)}</td><td>${item.chains.map(escapeHtml).join(' &rarr; ')}</td></tr>`);
+                    const chains = data.chains.map(chain => `<tr><td>${escapeHtml(chain.table)}/${escapeHtml(chain.chain)}</td>
+                        <td>${chain.rules}</td><td>${chain.packets.toFixed(0)}</td><td>${chain.per_packet.toFixed(2)}</td>
+                        <td>${chain.with_jumps.toFixed(2)}</td>
+                        <td>${chain.saved_per_packet ? '-' + chain.saved_per_packet.toFixed(2) : ''}</td></tr>`);
+                    const proposals = data.chains.flatMap(chain => chain.proposals).map(item => `<tr>
+                        <td><input type="checkbox" name="move" value="${escapeHtml(JSON.stringify(
+                            {table: item.table, chain: item.chain, num: item.num, to: item.to, spec: item.spec}))}"></td>
+                        <td>${escapeHtml(item.table)}/${escapeHtml(item.chain)}</td><td>${item.num} &rarr; ${item.to}</td>
+                        <td>${item.packets}</td><td>${item.saved_per_packet.toFixed(2)}</td>
+                        <td>${item.blocked_by ? 'rule ' + item.blocked_by : 'top of chain'}</td>
+                        <td>${escapeHtml(item.spec)}</td></tr>`);
+                    results.innerHTML = `<p>Profiled in ${data.elapsed_ms.toFixed(1)} ms</p>
+                        <h3>Rules Evaluated Per Packet</h3>
+                        <table><tr><th>Hook</th><th>Rules</th><th>Chains</th></tr>${hooks.join('')}</table>
+                        <table><tr><th>Chain</th><th>Rules</th><th>Packets</th><th>Per Packet</th><th>With Jumps</th>
+                        <th>Saving</th></tr>${chains.join('')}</table>
+                        <h3>Proposed Reorders</h3>
+                        ${proposals.length ? `<form method="POST" action="/profile/apply">
+                            <input type="hidden" name="family" value="${FAMILY}">
+                            <table><tr><th></th><th>Chain</th><th>Move</th><th>Packets</th><th>Saving Per Packet</th>
+                            <th>Stops Above</th><th>Spec</th></tr>${proposals.join('')}</table>
+                            <button type="submit" class="button">Apply Selected</button></form>` : '<p>No proposals.</p>'}`;
+                });
+        }
+
+        function loadBlocklists() {
+            fetch('/api/blocklists')
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("blocklist-results");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const rows = data.sets.map(set => `<tr><td>${escapeHtml(set.name)}</td><td>${escapeHtml(set.type || '')}</td>
+                        <td>${set.entries}</td><td>${set.rules.map(rule => escapeHtml(`${rule.table}/${rule.chain} ${rule.num}: ${rule.spec}`)).join('<br>')}</td>
+                        <td><form method="POST" action="/delete_blocklist" style="display: inline;">
+                            <input type="hidden" name="name" value="${escapeHtml(set.name)}">
+                            <button type="submit" class="button delete">Delete</button></form></td></tr>`);
+                    results.innerHTML = `<table><tr><th>Set</th><th>Type</th><th>Entries</th><th>Referenced by</th><th>Action</th></tr>
+                        ${rows.join('')}</table>`;
+                });
+        }
+
+        function previewRestore() {
+            fetch('/api/restore/preview', {method: 'POST', body: new FormData(document.getElementById("restore-form"))})
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("restore-preview");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const list = (prefix, specs) => (specs || []).map(spec => escapeHtml(prefix + ' ' + spec)).join('<br>');
+                    const rows = data.chains.map(chain => `<tr><td>${escapeHtml(chain.table)}/${escapeHtml(chain.chain)}</td>
+                        <td>${chain.deleted ? 'deleted' : chain.created ? 'created' : (chain.unchanged + ' unchanged')}</td>
+                        <td>${chain.policy ? escapeHtml(chain.policy.join(' -> ')) : ''}</td>
+                        <td>${[list('+', chain.added), list('-', chain.removed), list('~', chain.moved)].filter(x => x).join('<br>')}</td></tr>`);
+                    results.innerHTML = `<p>${data.changes} changes</p>
+                        <table><tr><th>Chain</th><th>Status</th><th>Policy</th><th>Rules</th></tr>${rows.join('')}</table>
+                        <pre>${escapeHtml(data.payload)}</pre>`;
+                });
+        }
+
+        function loadHistory() {
+            fetch('/api/history')
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("history-results");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const familyOf = event => event.family || 'ipv4';
+                    const rows = data.events.map((event, i) => {
+                        const previous = data.events.slice(i + 1).find(other => familyOf(other) == familyOf(event));
+                        return `<tr><td>${event.id}</td>
+                        <td>${new Date(event.time * 1000).toLocaleString()}</td><td>${escapeHtml(event.reason)}</td>
+                        <td>${escapeHtml(familyOf(event))}</td>
+                        <td>${event.chains}</td><td>${event.rules}</td><td>${event.snapshot.slice(0, 12)}</td>
+                        <td>${previous ? `<button class="button" onclick="diffHistory(${previous.id}, ${event.id})">Changes</button>` : ''}
+                        <form method="POST" action="/history/rollback" style="display: inline;"
+                              onsubmit="return confirm('Roll back to snapshot ${event.id}?')">
+                            <input type="hidden" name="id" value="${event.id}">
+                            <input type="hidden" name="family" value="${FAMILY}">
+                            <button type="submit" class="button delete">Roll Back</button></form></td></tr>`;
+                    });
+                    results.innerHTML = `<table><tr><th>#</th><th>Time</th><th>Event</th><th>Family</th><th>Chains</th><th>Rules</th>
+                        <th>Snapshot</th><th>Action</th></tr>${rows.join('')}</table>`;
+                });
+        }
+
+        function diffHistory(from, to) {
+            fetch('/api/history/diff?' + new URLSearchParams({from: from, to: to}))
+                .then(response => response.json())
+                .then(data => {
+                    const list = (prefix, specs) => (specs || []).map(spec => escapeHtml(prefix + ' ' + spec)).join('<br>');
+                    const rows = data.chains.map(chain => `<tr><td>${escapeHtml(chain.table)}/${escapeHtml(chain.chain)}</td>
+                        <td>${chain.deleted ? 'deleted' : chain.created ? 'created' : (chain.unchanged + ' unchanged')}</td>
+                        <td>${chain.policy ? escapeHtml(chain.policy.join(' -> ')) : ''}</td>
+                        <td>${[list('+', chain.added), list('-', chain.removed), list('~', chain.moved)].filter(x => x).join('<br>')}</td></tr>`);
+                    document.getElementById("history-diff").innerHTML = `<h3>Snapshot ${from} to ${to}</h3>
+                        <table><tr><th>Chain</th><th>Status</th><th>Policy</th><th>Rules</th></tr>${rows.join('')}</table>`;
+                });
+        }
+
+        function collectFleet() {
+            const results = document.getElementById("fleet-results");
+            results.innerHTML = '<p>Collecting...</p>';
+            fetch('/api/fleet/rulesets')
+                .then(response => response.json())
+                .then(data => {
+                    const hosts = data.hosts.map(host => `<tr><td>${escapeHtml(host.host)}</td>
+                        <td>${host.ok ? 'ok' : escapeHtml(host.error)}</td>
+                        <td>${host.ok ? host.rules : ''}</td><td>${host.ok ? host.hash.slice(0, 12) : ''}</td>
+                        <td>${host.elapsed_ms.toFixed(0)} ms</td></tr>`);
+                    const policies = data.drift.policies.map(item => `<tr><td>${escapeHtml(item.table)}/${escapeHtml(item.chain)}</td>
+                        <td>${Object.entries(item.policies).map(([host, policy]) => escapeHtml(host + ': ' + policy)).join('<br>')}</td></tr>`);
+                    const rules = data.drift.rules.map(item => `<tr><td>${escapeHtml(item.table)}/${escapeHtml(item.chain)}</td>
+                        <td>${escapeHtml(item.spec)}</td><td>${escapeHtml(item.present.join(', '))}</td>
+                        <td>${escapeHtml(item.missing.join(', '))}</td></tr>`);
+                    results.innerHTML = `<table><tr><th>Host</th><th>Status</th><th>Rules</th><th>Ruleset</th><th>Time</th></tr>${hosts.join('')}</table>
+                        <h3>Policy drift</h3><table><tr><th>Chain</th><th>Policies</th></tr>${policies.join('')}</table>
+                        <h3>Rule drift</h3><table><tr><th>Chain</th><th>Rule</th><th>On</th><th>Missing on</th></tr>${rules.join('')}</table>`;
+                });
+        }
+
+        function pushFleet() {
+            fetch('/api/fleet/push', {method: 'POST', body: new FormData(document.getElementById("fleet-push-form"))})
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("fleet-results");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const rows = data.results.map(host => `<tr><td>${escapeHtml(host.host)}</td>
+                        <td>${host.ok ? 'ok' : escapeHtml(host.error)}</td>
+                        <td>${host.elapsed_ms.toFixed(0)} ms</td></tr>`);
+                    results.innerHTML = `<p>${data.dry_run ? 'Tested' : 'Pushed'} on ${data.results.filter(host => host.ok).length}/${data.results.length} hosts</p>
+                        <table><tr><th>Host</th><th>Result</th><th>Time</th></tr>${rows.join('')}</table>`;
+                });
+        }
+
+        function loadConntrackSummary() {
+            const results = document.getElementById("conntrack-summary");
+            results.innerHTML = '<p>Reading the connection tracking table...</p>';
+            const params = new URLSearchParams({refresh: 1, address: document.getElementById("conntrack-address").value});
+            fetch('/api/conntrack/summary?' + params)
                 .then(response => response.json())
                 .then(data => {
-                    const rulesTable = document.getElementById("rules-table");
-                    rulesTable.innerHTML = data.html;
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const counts = items => Object.entries(items).map(([key, count]) => escapeHtml(key + ' ' + count)).join(', ');
+                    // Counts past the exact range are upper bounds, count - error is the lower one
+                    const top = (title, items) => `<h3>${title}</h3><table><tr><th>${title}</th><th>Entries</th></tr>
+                        ${items.map(item => `<tr><td>${escapeHtml(item.key)}</td>
+                            <td>${item.error ? (item.count - item.error) + ' to ' + item.count : item.count}</td></tr>`).join('')}</table>`;
+                    const address = data.address ? `<p>${escapeHtml(data.address.address)}: about ${data.address.as_source} entries as source,
+                        ${data.address.as_destination} as destination</p>` : '';
+                    results.innerHTML = `<p>${data.total} entries read in ${data.elapsed_ms.toFixed(0)} ms.
+                        Protocols: ${counts(data.protocols)}. States: ${counts(data.states)}.</p>${address}
+                        ${top('Sources', data.top.source)}${top('Destinations', data.top.destination)}${top('NAT mappings', data.top.nat)}`;
                 });
         }
 
+        function loadConntrack(offset) {
+            const params = new URLSearchParams(new FormData(document.getElementById("conntrack-form")));
+            params.set('offset', offset);
+            fetch('/api/conntrack?' + params)
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("conntrack-entries");
+                    if (data.error) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const side = tuple => escapeHtml((tuple.src || '') + (tuple.sport ? ':' + tuple.sport : '') + ' -> ' +
+                                                     (tuple.dst || '') + (tuple.dport ? ':' + tuple.dport : ''));
+                    const rows = data.entries.map(entry => `<tr><td>${escapeHtml(entry.protocol)}</td><td>${escapeHtml(entry.state)}</td>
+                        <td>${side(entry.original)}</td><td>${side(entry.reply)}</td><td>${escapeHtml(entry.nat || '')}</td>
+                        <td>${entry.timeout}</td></tr>`);
+                    const previous = data.offset > 0 ?
+                        `<button class="button" onclick="loadConntrack(${Math.max(data.offset - data.limit, 0)})">Previous</button>` : '';
+                    const next = data.next !== null ? `<button class="button" onclick="loadConntrack(${data.next})">Next</button>` : '';
+                    results.innerHTML = `<p>Entries ${data.offset + 1} to ${data.offset + data.entries.length}</p>
+                        <table><tr><th>Protocol</th><th>State</th><th>Original</th><th>Reply</th><th>NAT</th><th>Timeout</th></tr>
+                        ${rows.join('')}</table>${previous}${next}`;
+                });
+        }
+
+        function loadLogs() {
+            fetch('/api/logs')
+                .then(response => response.json())
+                .then(data => {
+                    const results = document.getElementById("logs-results");
+                    if (data.error && !data.rules) {
+                        results.innerHTML = `<div class="status error">${escapeHtml(data.error)}</div>`;
+                        return;
+                    }
+                    const rule = r => r ? escapeHtml(`${r.table}/${r.chain} #${r.num === null ? '?' : r.num}`) : '';
+                    const rules = data.rules.map(r => `<tr><td>${rule(r)}</td><td>${escapeHtml(r.spec)}</td>
+                        <td>${r.count}</td><td>${escapeHtml(r.series.join(' '))}</td>
+                        <td>${r.last_seen ? new Date(r.last_seen * 1000).toLocaleTimeString() : ''}</td>
+                        <td>${r.sources.map(s => escapeHtml(s.src + ' ' + s.count)).join('<br>')}</td></tr>`);
+                    const sources = data.sources.map(s => `<tr><td>${escapeHtml(s.src)}</td>
+                        <td>${s.error ? (s.count - s.error) + ' to ' + s.count : s.count}</td></tr>`);
+                    const unmatched = data.unmatched.map(u => `<tr><td>${escapeHtml(u.key || '(no prefix)')}</td><td>${u.count}</td></tr>`);
+                    const recent = data.recent.slice().reverse().map(e => `<tr><td>${new Date(e.time * 1000).toLocaleTimeString()}</td>
+                        <td>${e.rule ? rule(e.rule) : escapeHtml(e.prefix)}</td><td>${escapeHtml(e.in || '')}</td><td>${escapeHtml(e.out || '')}</td>
+                        <td>${escapeHtml(e.proto)}</td><td>${escapeHtml(e.src + (e.sport ? ':' + e.sport : ''))}</td>
+                        <td>${escapeHtml(e.dst + (e.dport ? ':' + e.dport : ''))}</td></tr>`);
+                    results.innerHTML = `${data.error ? `<div class="status error">${escapeHtml(data.error)}</div>` : ''}
+                        <p>Reading ${escapeHtml(data.source)}: ${data.lines_total} lines, ${data.matched_total} matched to rules,
+                        ${data.lines_per_second.toFixed(0)} lines/s${data.behind_bytes ? ', ' + data.behind_bytes + ' bytes behind' : ''}</p>
+                        <h3>Rules</h3><table><tr><th>Rule</th><th>Spec</th><th>Logged</th><th>Per ${data.bucket_seconds}s</th><th>Last</th><th>Top sources</th></tr>${rules.join('')}</table>
+                        <h3>Sources</h3><table><tr><th>Source</th><th>Logged</th></tr>${sources.join('')}</table>
+                        <h3>Prefixes without a rule</h3><table><tr><th>Prefix</th><th>Lines</th></tr>${unmatched.join('')}</table>
+                        <h3>Latest</h3><table><tr><th>Time</th><th>Rule</th><th>In</th><th>Out</th><th>Protocol</th><th>Source</th><th>Destination</th></tr>${recent.join('')}</table>`;
+                });
+        }
+
+        let logsTimer = null;
+
+        function followLogs() {
+            clearInterval(logsTimer);
+            if (document.getElementById("logs-follow").checked) {
+                loadLogs();
+                logsTimer = setInterval(loadLogs, 2000);
+            }
+        }
+
         // Show rules tab by default
         document.addEventListener('DOMContentLoaded', function() {
             document.querySelector('.tablinks').click();
+            updateRuleDisplay();
         });
     </script>
 </head>
 <body>
     <div class="container">
         <h1>Advanced IPTables Manager</h1>
+        {% if families | length > 1 %}
+        <div class="form-group">
+            <select id="family-select" onchange="location.href = '/?family=' + this.value">
+                {% for name, info in families.items() %}
+                    <option value="{{ name }}" {% if name == family %}selected{% endif %}>{{ info.label }} ({{ info.iptables }})</option>
+                {% endfor %}
+            </select>
+        </div>
+        {% endif %}
         
         <div class="tab">
             <button class="tablinks" onclick="openTab(event, 'Rules')">Rules Management</button>
+            <button class="tablinks" onclick="openTab(event, 'Search')">Address Search</button>
+            <button class="tablinks" onclick="openTab(event, 'Simulator')">Packet Simulator</button>
+            <button class="tablinks" onclick="openTab(event, 'Analysis')">Rule Analysis</button>
+            <button class="tablinks" onclick="openTab(event, 'Profile')">Traversal Profile</button>
             <button class="tablinks" onclick="openTab(event, 'Chains')">Chains</button>
             <button class="tablinks" onclick="openTab(event, 'NAT')">NAT Configuration</button>
+            <button class="tablinks" onclick="openTab(event, 'Conntrack')">Connections</button>
+            <button class="tablinks" onclick="openTab(event, 'Logs')">Logged Packets</button>
             <button class="tablinks" onclick="openTab(event, 'Policies')">Default Policies</button>
+            <button class="tablinks" onclick="openTab(event, 'Blocklists')">Blocklists</button>
             <button class="tablinks" onclick="openTab(event, 'Save')">Save/Restore</button>
+            <button class="tablinks" onclick="openTab(event, 'History')">History</button>
+            {% if families | length > 1 %}
+            <button class="tablinks" onclick="openTab(event, 'DualStack')">IPv4/IPv6 ({{ family_mismatches | length }})</button>
+            {% endif %}
+            {% if fleet_hosts %}
+            <button class="tablinks" onclick="openTab(event, 'Fleet')">Fleet ({{ fleet_hosts | length }})</button>
+            {% endif %}
+            <button class="tablinks" onclick="openTab(event, 'Pending')">Pending Changes ({{ pending_changes | length }})</button>
         </div>
 
         <div id="Rules" class="tabcontent">
             <h2>Manage Rules</h2>
             <div class="form-group">
-                <select id="table-select" onchange="updateRuleDisplay()">
+                <select id="table-select" onchange="updateChainSelect()">
                     <option value="filter">Filter</option>
                     <option value="nat">NAT</option>
                     <option value="mangle">Mangle</option>
@@ -167,13 +717,34 @@ HTML_TEMPLATE = """
                     {% endfor %}
                 </select>
             </div>
+            <div class="form-group">
+                <input type="text" id="filter-target" placeholder="Target" onchange="updateRuleDisplay()">
+                <input type="text" id="filter-protocol" placeholder="Protocol" onchange="updateRuleDisplay()">
+                <input type="text" id="filter-source" placeholder="Source CIDR" onchange="updateRuleDisplay()">
+                <input type="text" id="filter-destination" placeholder="Destination CIDR" onchange="updateRuleDisplay()">
+                <input type="text" id="filter-interface" placeholder="Interface" onchange="updateRuleDisplay()">
+                <input type="text" id="filter-q" placeholder="Search" onchange="updateRuleDisplay()">
+                <span id="rules-count"></span>
+            </div>
 
             <div id="rules-table">
-                {{ rules_table | safe }}
+                <div class="rules-header">
+                    <div>Num</div><div>Pkts</div><div>Bytes</div><div>Rate</div><div>Target</div><div>Prot</div><div>Opt</div>
+                    <div>Source</div><div>Destination</div><div>Matches</div><div>Action</div>
+                </div>
+                <div id="rules-viewport" onscroll="renderVisibleRules()">
+                    <div id="rules-spacer">
+                        <div id="rules-rows"></div>
+                    </div>
+                </div>
             </div>
+            <script>
+                const CHAINS_BY_TABLE = {{ chains_by_table | tojson }};
+            </script>
 
             <h3>Add New Rule</h3>
             <form method="POST" action="/add_rule">
+                <input type="hidden" name="family" value="{{ family }}">
                 <div class="form-group">
                     <select name="table" required>
                         <option value="filter">Filter</option>
@@ -207,7 +778,7 @@ HTML_TEMPLATE = """
                     <select name="protocol">
                         <option value="tcp">TCP</option>
                         <option value="udp">UDP</option>
-                        <option value="icmp">ICMP</option>
+                        <option value="{{ 'ipv6-icmp' if family == 'ipv6' else 'icmp' }}">ICMP</option>
                         <option value="all">All</option>
                     </select>
                 </div>
@@ -217,10 +788,85 @@ HTML_TEMPLATE = """
                     <input type="text" name="to_destination" placeholder="To-Destination (for DNAT)">
                     <input type="text" name="in_interface" placeholder="Input Interface">
                     <input type="text" name="out_interface" placeholder="Output Interface">
+                    <input type="text" name="log_prefix" maxlength="29" placeholder="Log Prefix (for LOG)">
                 </div>
 
                 <button type="submit" class="button">Add Rule</button>
+                <button type="submit" class="button" formaction="/stage/add_rule">Stage Rule</button>
+            </form>
+        </div>
+
+        <div id="Search" class="tabcontent">
+            <h2>Which Rules Touch An Address</h2>
+            <form onsubmit="searchRules(); return false;">
+                <div class="form-group">
+                    <input type="text" id="search-address" placeholder="Address or CIDR" required>
+                    <input type="text" id="search-port" placeholder="Port">
+                    <label><input type="checkbox" id="search-any"> include rules without an address</label>
+                    <button type="submit" class="button">Search</button>
+                </div>
+            </form>
+            <div id="search-results"></div>
+        </div>
+
+        <div id="Simulator" class="tabcontent">
+            <h2>Packet Simulator</h2>
+            <form id="simulate-form" onsubmit="simulatePacket(); return false;">
+                <div class="form-group">
+                    <select name="hook">
+                        <option value="input">Input (to this host)</option>
+                        <option value="forward">Forward (routed)</option>
+                        <option value="output">Output (from this host)</option>
+                    </select>
+                    <input type="text" name="src" placeholder="Source IP" required>
+                    <input type="text" name="dst" placeholder="Destination IP" required>
+                    <select name="protocol">
+                        <option value="tcp">TCP</option>
+                        <option value="udp">UDP</option>
+                        <option value="icmp">ICMP</option>
+                    </select>
+                    <input type="text" name="sport" placeholder="Source Port">
+                    <input type="text" name="dport" placeholder="Destination Port">
+                </div>
+                <div class="form-group">
+                    <input type="text" name="in_interface" placeholder="Input Interface">
+                    <input type="text" name="out_interface" placeholder="Output Interface">
+                    <select name="state">
+                        <option value="NEW">NEW</option>
+                        <option value="ESTABLISHED">ESTABLISHED</option>
+                        <option value="RELATED">RELATED</option>
+                        <option value="INVALID">INVALID</option>
+                    </select>
+                    <button type="submit" class="button">Simulate</button>
+                </div>
+            </form>
+
+            <h3>Batch</h3>
+            <form id="simulate-batch-form" onsubmit="simulateBatch(); return false;">
+                <input type="file" name="packets_file" accept=".csv" required>
+                <button type="submit" class="button">Simulate CSV</button>
+                <span>columns: src,dst,protocol,sport,dport,in_interface,out_interface,hook,state</span>
             </form>
+            <div id="simulate-results"></div>
+        </div>
+
+        <div id="Analysis" class="tabcontent">
+            <h2>Shadowed And Redundant Rules</h2>
+            <button class="button" onclick="analyzeRules()">Analyze</button>
+            <form method="POST" action="/analysis/cleanup" style="display: inline;">
+                <label><input type="checkbox" name="kind" value="shadowed" checked> shadowed</label>
+                <label><input type="checkbox" name="kind" value="redundant" checked> redundant</label>
+                <label><input type="checkbox" name="kind" value="mergeable"> mergeable</label>
+                <button type="submit" class="button">Stage Cleanup</button>
+            </form>
+            <div id="analysis-results"></div>
+        </div>
+
+        <div id="Profile" class="tabcontent">
+            <h2>Chain Traversal Cost</h2>
+            <p>Computed from the rule counters since they were last zeroed. Moved rules start again from zero.</p>
+            <button class="button" onclick="profileChains()">Profile</button>
+            <div id="profile-results"></div>
         </div>
 
         <div id="Chains" class="tabcontent">
@@ -238,9 +884,11 @@ HTML_TEMPLATE = """
                     <td>{{ chain.name }}</td>
                     <td>
                         <form method="POST" action="/delete_chain" style="display: inline;">
+                            <input type="hidden" name="family" value="{{ family }}">
                             <input type="hidden" name="table" value="{{ chain.table }}">
                             <input type="hidden" name="chain" value="{{ chain.name }}">
                             <button type="submit" class="button delete">Delete</button>
+                            <button type="submit" class="button delete" formaction="/stage/delete_chain">Stage Delete</button>
                         </form>
                     </td>
                 </tr>
@@ -249,6 +897,7 @@ HTML_TEMPLATE = """
 
             <h3>Create New Chain</h3>
             <form method="POST" action="/create_chain">
+                <input type="hidden" name="family" value="{{ family }}">
                 <select name="table" required>
                     <option value="filter">Filter</option>
                     <option value="nat">NAT</option>
@@ -257,6 +906,7 @@ HTML_TEMPLATE = """
                 </select>
                 <input type="text" name="chain" placeholder="Chain Name" required>
                 <button type="submit" class="button">Create Chain</button>
+                <button type="submit" class="button" formaction="/stage/create_chain">Stage Chain</button>
             </form>
         </div>
 
@@ -284,6 +934,47 @@ HTML_TEMPLATE = """
             </form>
         </div>
 
+        <div id="Conntrack" class="tabcontent">
+            <h2>Connection Tracking</h2>
+            <div class="form-group">
+                <input type="text" id="conntrack-address" placeholder="Count entries of an address">
+                <button class="button" onclick="loadConntrackSummary()">Summarize</button>
+            </div>
+            <div id="conntrack-summary"></div>
+
+            <h3>Entries</h3>
+            <form id="conntrack-form" onsubmit="loadConntrack(0); return false;">
+                <div class="form-group">
+                    <input type="text" name="source" placeholder="Source Address">
+                    <input type="text" name="destination" placeholder="Destination Address">
+                    <input type="text" name="port" placeholder="Port">
+                    <select name="protocol">
+                        <option value="">Any protocol</option>
+                        <option value="tcp">TCP</option>
+                        <option value="udp">UDP</option>
+                        <option value="icmp">ICMP</option>
+                    </select>
+                    <select name="state">
+                        <option value="">Any state</option>
+                        <option value="ESTABLISHED">ESTABLISHED</option>
+                        <option value="SYN_SENT">SYN_SENT</option>
+                        <option value="TIME_WAIT">TIME_WAIT</option>
+                        <option value="CLOSE_WAIT">CLOSE_WAIT</option>
+                    </select>
+                    <button type="submit" class="button">Show Entries</button>
+                </div>
+            </form>
+            <div id="conntrack-entries"></div>
+        </div>
+
+        <div id="Logs" class="tabcontent">
+            <h2>Logged Packets</h2>
+            <p>Kernel log lines of LOG rules, matched back to the rule by their log prefix.</p>
+            <button class="button" onclick="loadLogs()">Refresh</button>
+            <label><input type="checkbox" id="logs-follow" onchange="followLogs()"> refresh every 2 seconds</label>
+            <div id="logs-results"></div>
+        </div>
+
         <div id="Policies" class="tabcontent">
             <h2>Default Policies</h2>
             <table>
@@ -300,6 +991,7 @@ HTML_TEMPLATE = """
                     <td>{{ policy.policy }}</td>
                     <td>
                         <form method="POST" action="/set_policy">
+                            <input type="hidden" name="family" value="{{ family }}">
                             <input type="hidden" name="table" value="{{ policy.table }}">
                             <input type="hidden" name="chain" value="{{ policy.chain }}">
                             <select name="policy">
@@ -308,6 +1000,7 @@ HTML_TEMPLATE = """
                                 <option value="REJECT">REJECT</option>
                             </select>
                             <button type="submit" class="button">Update</button>
+                            <button type="submit" class="button" formaction="/stage/set_policy">Stage</button>
                         </form>
                     </td>
                 </tr>
@@ -315,23 +1008,166 @@ HTML_TEMPLATE = """
             </table>
         </div>
 
+        <div id="Blocklists" class="tabcontent">
+            <h2>IP Blocklists</h2>
+            <form method="POST" action="/load_blocklist" enctype="multipart/form-data">
+                <div class="form-group">
+                    <input type="text" name="name" placeholder="Set Name" required>
+                    <select name="chain">
+                        {% for chain in chains %}
+                            <option value="{{ chain }}">{{ chain }}</option>
+                        {% endfor %}
+                    </select>
+                    <select name="direction">
+                        <option value="src">Source</option>
+                        <option value="dst">Destination</option>
+                    </select>
+                    <select name="action">
+                        <option value="DROP">DROP</option>
+                        <option value="REJECT">REJECT</option>
+                    </select>
+                </div>
+                <div class="form-group">
+                    <input type="file" name="blocklist_file" accept=".txt,.csv,.netset">
+                    <textarea name="entries" rows="4" cols="40" placeholder="or one address/CIDR per line"></textarea>
+                    <button type="submit" class="button">Load Blocklist</button>
+                </div>
+            </form>
+            <p>Loading an existing set replaces its contents atomically.</p>
+            <button class="button" onclick="loadBlocklists()">Show Sets</button>
+            <div id="blocklist-results"></div>
+        </div>
+
         <div id="Save" class="tabcontent">
             <h2>Save/Restore Rules</h2>
             <form method="POST" action="/save_rules">
-                <button type="submit" class="button">Save Current Rules</button>
+                <input type="hidden" name="family" value="{{ family }}">
+                <button type="submit" class="button">Save Current {{ families[family].label }} Rules</button>
             </form>
             
             <h3>Restore Rules</h3>
-            <form method="POST" action="/restore_rules" enctype="multipart/form-data">
-                <input type="file" name="rules_file" accept=".rules">
+            <form id="restore-form" method="POST" action="/restore_rules" enctype="multipart/form-data">
+                <input type="hidden" name="family" value="{{ family }}">
+                <input type="file" name="rules_file" accept=".rules,.v4,.v6">
+                <label><input type="checkbox" name="replace" value="1"> replace whole tables (resets all counters)</label>
+                <button type="button" class="button" onclick="previewRestore()">Preview</button>
                 <button type="submit" class="button">Restore Rules</button>
             </form>
+            <div id="restore-preview"></div>
+        </div>
+
+        <div id="History" class="tabcontent">
+            <h2>Ruleset History</h2>
+            <p>A snapshot is kept before and after every change made here.</p>
+            <button class="button" onclick="loadHistory()">Show History</button>
+            <div id="history-diff"></div>
+            <div id="history-results"></div>
+        </div>
+
+        {% if families | length > 1 %}
+        <div id="DualStack" class="tabcontent">
+            <h2>Rules Missing From The Other Family</h2>
+            <p>Rules without addresses usually belong in both families. These have no counterpart in the same chain of the other one.</p>
+            {% for name in unread_families %}
+            <div class="status error">The {{ families[name].label }} rules could not be read</div>
+            {% endfor %}
+            {% if family_mismatches %}
+            <table>
+                <tr>
+                    <th>Family</th>
+                    <th>Missing From</th>
+                    <th>Table</th>
+                    <th>Chain</th>
+                    <th>Num</th>
+                    <th>Rule</th>
+                </tr>
+                {% for rule in family_mismatches %}
+                <tr>
+                    <td>{{ families[rule.family].label }}</td>
+                    <td>{{ families[rule.missing_from].label }}{% if rule.chain_missing %} (no such chain){% endif %}</td>
+                    <td>{{ rule.table }}</td>
+                    <td>{{ rule.chain }}</td>
+                    <td>{{ rule.num }}</td>
+                    <td>{{ rule.spec }}</td>
+                </tr>
+                {% endfor %}
+            </table>
+            {% elif not unread_families %}
+            <p>Every rule without addresses exists in both families.</p>
+            {% endif %}
+        </div>
+        {% endif %}
+
+        {% if fleet_hosts %}
+        <div id="Fleet" class="tabcontent">
+            <h2>Fleet</h2>
+            <button class="button" onclick="collectFleet()">Collect Rulesets</button>
+            <form id="fleet-push-form" onsubmit="pushFleet(); return false;" style="display: inline;">
+                <select name="group">
+                    <option value="">All hosts</option>
+                    {% for group in fleet_groups %}
+                        <option value="{{ group }}">{{ group }}</option>
+                    {% endfor %}
+                </select>
+                <input type="number" name="concurrency" min="1" placeholder="Concurrency">
+                <label><input type="checkbox" name="dry_run" value="1"> test only</label>
+                <button type="submit" class="button">Push Pending Changes</button>
+            </form>
+            <div id="fleet-results"></div>
+        </div>
+        {% endif %}
+
+        <div id="Pending" class="tabcontent">
+            <h2>Pending Changes</h2>
+            {% if pending_changes %}
+            <table>
+                <tr>
+                    <th>#</th>
+                    <th>Family</th>
+                    <th>Table</th>
+                    <th>Change</th>
+                    <th>Action</th>
+                </tr>
+                {% for change in pending_changes %}
+                <tr>
+                    <td>{{ loop.index }}</td>
+                    <td>{{ families[change.family or 'ipv4'].label }}</td>
+                    <td>{{ change.table }}</td>
+                    <td>{{ change.op }} {{ change.chain }} {{ change.position or '' }} {{ change.policy or change.spec or '' }}</td>
+                    <td>
+                        <form method="POST" action="/discard_change" style="display: inline;">
+                            <input type="hidden" name="family" value="{{ family }}">
+                            <input type="hidden" name="index" value="{{ loop.index0 }}">
+                            <button type="submit" class="button delete">Discard</button>
+                        </form>
+                    </td>
+                </tr>
+                {% endfor %}
+            </table>
+
+            <h3>Commit script ({{ backend_name }})</h3>
+            <pre>{{ pending_payload }}</pre>
+
+            <form method="POST" action="/commit_changes" style="display: inline;">
+                <input type="hidden" name="family" value="{{ family }}">
+                <button type="submit" class="button">Commit All</button>
+            </form>
+            <form method="POST" action="/discard_changes" style="display: inline;">
+                <input type="hidden" name="family" value="{{ family }}">
+                <button type="submit" class="button delete">Discard All</button>
+            </form>
+            {% else %}
+            <p>No staged changes. Use the Stage buttons to collect edits and commit them in one go.</p>
+            {% endif %}
         </div>
     </div>
 </body>
 </html>
 """
 
+# Compiled once instead of on every page load
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+
 def require_sudo(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -340,249 +1176,4648 @@ def require_sudo(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def check_sudo():
-    try:
-        subprocess.check_output(['sudo', '-n', 'true'])
-        return True
-    except:
-        return False
+def invalidates_ruleset(f, families=None):
+    # Also keeps a snapshot of the rules from before and after the change,
+    # of every family families() says the request writes to: the requested
+    # family by default, none for a dry run
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            written = families() if families else [request_family()]
+        except Exception:
+            written = [request_family()]
+        for family in written:
+            record_snapshot(f'before {f.__name__}', family)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            for cache in ruleset_caches.values():
+                cache.invalidate()
+            for family in written:
+                record_snapshot(f'after {f.__name__}', family)
+    return decorated_function
 
-def get_chains(table='filter'):
-    try:
-        output = subprocess.check_output(['sudo', 'iptables', '-t', table, '-L', '-n']).decode()
-        chains = []
-        for line in output.split('\n'):
-            if line.startswith('Chain'):
-                chain_name = line.split()[1]
-                chains.append(chain_name)
-        return chains
-    except Exception as e:
-        print(f"Error getting chains: {e}")
-        return []
+def invalidates_rulesets(families):
+    # The same for routes that know better which families they write
+    return partial(invalidates_ruleset, families=families)
 
-def get_custom_chains():
-    tables = ['filter', 'nat', 'mangle', 'raw']
-    custom_chains = []
-    for table in tables:
-        try:
-            output = subprocess.check_output(['sudo', 'iptables', '-t', table, '-L', '-n']).decode()
-            for line in output.split('\n'):
-                if line.startswith('Chain') and not any(default in line for default in ['INPUT', 'OUTPUT', 'FORWARD', 'PREROUTING', 'POSTROUTING']):
-                    chain_name = line.split()[1]
-                    custom_chains.append({'table': table, 'name': chain_name})
-        except:
-            continue
-    return custom_chains
+# Commands and files of each address family. IPTABLES_GUI_IPV6=0 leaves
+# IPv6 out on hosts without ip6tables.
+ADDRESS_FAMILIES = {
+    'ipv4': {'label': 'IPv4', 'version': 4, 'iptables': 'iptables', 'save': 'iptables-save',
+             'restore': 'iptables-restore', 'nft': 'ip', 'rules_file': '/etc/iptables/rules.v4'},
+    'ipv6': {'label': 'IPv6', 'version': 6, 'iptables': 'ip6tables', 'save': 'ip6tables-save',
+             'restore': 'ip6tables-restore', 'nft': 'ip6', 'rules_file': '/etc/iptables/rules.v6'},
+}
+FAMILIES = {name: family for name, family in ADDRESS_FAMILIES.items()
+            if name == 'ipv4' or os.environ.get('IPTABLES_GUI_IPV6', '1') not in ('0', 'false', 'no')}
 
-def get_policies():
-    tables = ['filter', 'nat', 'mangle', 'raw']
-    policies = []
-    for table in tables:
-        try:
-            output = subprocess.check_output(['sudo', 'iptables', '-t', table, '-L', '-n']).decode()
-            for line in output.split('\n'):
-                if line.startswith('Chain'):
-                    parts = line.split()
-                    if len(parts) > 3 and parts[2] == '(policy':
-                        chain = parts[1]
-                        policy = parts[3].rstrip(')')
-                        policies.append({'table': table, 'chain': chain, 'policy': policy})
-        except:
-            continue
-    return policies
+# Programs the privileged helper is willing to run and the argument lists
+# it takes for each. iptables gets rule arguments, checked by helper_refusal
+# like the lines the restore commands read.
+HELPER_COMMANDS = ['iptables', 'iptables-save', 'iptables-restore', 'ip6tables', 'ip6tables-save',
+                   'ip6tables-restore', 'ipset', 'nft', 'conntrack', 'journalctl']
+# New kernel log lines as they come, for the log panel
+KERNEL_JOURNAL = ['journalctl', '-k', '-f', '-n', '0', '-o', 'cat']
+HELPER_ARGS = {
+    'iptables-save': [['-c']],
+    'ip6tables-save': [['-c']],
+    'iptables-restore': [[], ['--noflush'], ['--noflush', '--test']],
+    'ip6tables-restore': [[], ['--noflush'], ['--noflush', '--test']],
+    'nft': [['-j', 'list', 'ruleset'], ['-f', '-'], ['-c', '-f', '-']],
+    'ipset': [['list', '-t'], ['list', '-n'], ['restore']],
+    'conntrack': [['-L']],
+    'journalctl': [KERNEL_JOURNAL[1:]],
+}
+HELPER_IPTABLES_COMMANDS = {'-A', '-D', '-I', '-P', '-N', '-F', '-X'}
+IPSET_RESTORE_COMMANDS = {'create', 'add', 'del', 'flush', 'swap', 'destroy'}
+IPSET_NAME = re.compile(r'[A-Za-z0-9_.-]{1,31}')
+NFT_INCLUDE = re.compile(r'(^|;)\s*include\b')
 
-@app.route('/')
-def index():
-    chains = get_chains()
-    custom_chains = get_custom_chains()
-    policies = get_policies()
-    return render_template_string(HTML_TEMPLATE, 
-                                chains=chains,
-                                custom_chains=custom_chains,
-                                policies=policies,
-                                rules_table=get_rules_table('filter', 'INPUT'),
-nat_rules=get_nat_rules())
-
-def get_rules_table(table, chain):
-    try:
-        output = subprocess.check_output(['sudo', 'iptables', '-t', table, '-L', chain, '-n', '--line-numbers', '-v']).decode()
-        lines = output.split('\n')[2:]  # Skip header lines
-        html = '<table><tr><th>Num</th><th>Pkts</th><th>Bytes</th><th>Target</th><th>Prot</th><th>Opt</th><th>Source</th><th>Destination</th><th>Action</th></tr>'
-        
-        for line in lines:
-            if line.strip():
-                parts = line.split()
-                if len(parts) >= 8:
-                    html += f'''
-                        <tr>
-                            <td>{parts[0]}</td>
-                            <td>{parts[1]}</td>
-                            <td>{parts[2]}</td>
-                            <td>{parts[3]}</td>
-                            <td>{parts[4]}</td>
-                            <td>{parts[5]}</td>
-                            <td>{parts[6]}</td>
-                            <td>{parts[7]}</td>
-                            <td>
-                                <form method="POST" action="/delete_rule" style="display: inline;">
-                                    <input type="hidden" name="table" value="{table}">
-                                    <input type="hidden" name="chain" value="{chain}">
-                                    <input type="hidden" name="rule_number" value="{parts[0]}">
-                                    <button type="submit" class="button delete">Delete</button>
-                                </form>
-                            </td>
-                        </tr>
-                    '''
-        html += '</table>'
-        return html
-    except Exception as e:
-        return f'<div class="status error">Error getting rules: {str(e)}</div>'
+def modprobe_option(token):
+    # getopt takes any unambiguous prefix of a long option and bundled short
+    # options, --modp=/x and -vM/x both name the program iptables runs as
+    # root to load kernel modules
+    name = token.partition('=')[0]
+    return (len(name) > 3 and '--modprobe'.startswith(name)) or re.match(r'-[^-]*M', token) is not None
 
-def get_nat_rules():
-    try:
-        output = subprocess.check_output(['sudo', 'iptables', '-t', 'nat', '-L', '-n', '-v']).decode()
-        return f'<pre>{output}</pre>'
-    except Exception as e:
-        return f'<div class="status error">Error getting NAT rules: {str(e)}</div>'
+def unsafe_rule_token(tokens):
+    for previous, token in zip([''] + tokens, tokens):
+        if modprobe_option(token):
+            return token
+        # Extensions are loaded from a file named after the match or target
+        if previous in ('-m', '--match', '-j', '--jump', '-g', '--goto') and '/' in token:
+            return token
+    return None
 
-@app.route('/get_rules/<table>/<chain>')
-@require_sudo
-def get_rules(table, chain):
-    return jsonify({'html': get_rules_table(table, chain)})
+def helper_refusal(argv, data):
+    # Why the helper won't run argv (with data on stdin) as root, None when
+    # it will
+    program, args = argv[0], list(argv[1:])
+    if program not in HELPER_COMMANDS:
+        return f"command not allowed: {program!r}"
+    if program in LOCKING_COMMANDS and args[:1] == ['-w']:
+        if len(args) < 2 or not args[1].isdigit():
+            return f"{program}: -w takes a number of seconds"
+        args = args[2:]
+    bad = None
+    if program in ('iptables', 'ip6tables'):
+        if (len(args) < 4 or args[0] != '-t' or args[1] not in RESTORE_TABLES
+                or args[2] not in HELPER_IPTABLES_COMMANDS or not CHAIN_NAME.fullmatch(args[3])):
+            return f"{program}: arguments not allowed: {' '.join(args)!r}"
+        bad = unsafe_rule_token(args[4:])
+    elif program == 'ipset' and len(args) == 2 and args[0] == 'destroy':
+        if not IPSET_NAME.fullmatch(args[1]):
+            return f"ipset: invalid set name {args[1]!r}"
+    elif args not in HELPER_ARGS[program]:
+        return f"{program}: arguments not allowed: {' '.join(args)!r}"
+    for line in (data or '').splitlines():
+        if program in ('iptables-restore', 'ip6tables-restore') and line[:1] not in ('', '#', '*', ':'):
+            try:
+                bad = unsafe_rule_token(shlex.split(line))
+            except ValueError:
+                bad = line
+        elif program == 'nft' and NFT_INCLUDE.search(line):
+            bad = line
+        elif program == 'ipset' and line.strip():
+            words = line.split()
+            if words[0] not in IPSET_RESTORE_COMMANDS or any(word[:1] == '-' for word in words):
+                bad = line
+        if bad:
+            break
+    if bad:
+        return f"{program}: refused {bad!r}"
+    return None
 
-@app.route('/add_rule', methods=['POST'])
-@require_sudo
-def add_rule():
-    try:
-        cmd = ['sudo', 'iptables', '-t', request.form['table'], '-A', request.form['chain']]
-        
-        # Add protocol if specified
-        if request.form.get('protocol'):
-            cmd.extend(['-p', request.form['protocol']])
-        
-        # Add source IP if specified
-        if request.form.get('source_ip'):
-            cmd.extend(['-s', request.form['source_ip']])
-            
-        # Add destination IP if specified
-        if request.form.get('dest_ip'):
-            cmd.extend(['-d', request.form['dest_ip']])
-            
-        # Add ports if specified
-        if request.form.get('source_port'):
-            cmd.extend(['--sport', request.form['source_port']])
-        if request.form.get('dest_port'):
-            cmd.extend(['--dport', request.form['dest_port']])
-            
-        # Add interfaces if specified
-        if request.form.get('in_interface'):
-            cmd.extend(['-i', request.form['in_interface']])
-        if request.form.get('out_interface'):
-            cmd.extend(['-o', request.form['out_interface']])
-            
-        # Add NAT-specific options
-        if request.form['action'] == 'SNAT' and request.form.get('to_source'):
-            cmd.extend(['-j', 'SNAT', '--to-source', request.form['to_source']])
-        elif request.form['action'] == 'DNAT' and request.form.get('to_destination'):
-            cmd.extend(['-j', 'DNAT', '--to-destination', request.form['to_destination']])
+class HelperHandler(socketserver.StreamRequestHandler):
+    # One JSON request per line, one JSON response per line. A connection
+    # stays open for as many requests as the client sends, except a stream
+    # request: its output is sent as it comes and the connection ends with it.
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            self.wfile.write(b'{"error": "permission denied"}\n')
+            return
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                if message.get('op') == 'stream':
+                    self.server.stream(message['argv'], self.send)
+                    return
+                response = self.server.execute(message)
+            except OSError:
+                # The client went away
+                return
+            except Exception as e:
+                response = {'error': str(e)}
+            self.send(response)
+
+    def send(self, response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        self.wfile.flush()
+
+class HelperServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, allowed_uids):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, HelperHandler)
+        self.allowed_uids = set(allowed_uids) | {0}
+        # The privilege check is done once for the lifetime of the helper
+        self.privileged = os.geteuid() == 0
+
+    def peer_allowed(self, conn):
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid in self.allowed_uids
+
+    def execute(self, message):
+        if message.get('op') == 'ping':
+            return {'ok': True, 'privileged': self.privileged}
+        if message.get('op') == 'save_rules':
+            return self.save_rules(FAMILIES[message['family']])
+        argv = message['argv']
+        data = message.get('input')
+        refusal = helper_refusal(argv, data) if argv else "empty command"
+        if refusal:
+            return {'error': refusal}
+        result = subprocess.run(argv, capture_output=True,
+                                input=data.encode('utf-8', 'surrogateescape') if data is not None else None)
+        return {'returncode': result.returncode,
+                'stdout': result.stdout.decode('utf-8', 'surrogateescape'),
+                'stderr': result.stderr.decode('utf-8', 'surrogateescape')}
+
+    def stream(self, argv, send):
+        # {"data": ...} messages while the command writes, then its exit
+        # status. A client that disconnects stops the command.
+        refusal = helper_refusal(argv, None) if argv else "empty command"
+        if refusal:
+            send({'error': refusal})
+            return
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            while True:
+                data = os.read(process.stdout.fileno(), STREAM_READ_SIZE)
+                if not data:
+                    break
+                send({'data': data.decode('utf-8', 'surrogateescape')})
+            send({'returncode': process.wait(), 'stderr': process.stderr.read().decode('utf-8', 'surrogateescape')})
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+    def save_rules(self, family):
+        # The rules file is fixed, save commands never get a path from the
+        # client
+        result = subprocess.run([family['save']], capture_output=True)
+        if result.returncode == 0:
+            temp = family['rules_file'] + '.new'
+            with open(temp, 'wb') as f:
+                f.write(result.stdout)
+            os.replace(temp, family['rules_file'])
+        return {'returncode': result.returncode, 'stdout': '',
+                'stderr': result.stderr.decode('utf-8', 'surrogateescape')}
+
+def run_helper(path, user=None):
+    uids = []
+    if user:
+        import pwd
+        uids.append(pwd.getpwnam(user).pw_uid)
+    server = HelperServer(path, uids)
+    os.chmod(path, 0o600)
+    if uids:
+        os.chown(path, uids[0], -1)
+    print(f"iptables helper listening on {path}")
+    server.serve_forever()
+
+class HelperClient:
+    # Keeps one connection per thread to the privileged helper
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.privileged = None
+
+    def connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.path)
+        self.local.conn = conn
+        self.local.reader = conn.makefile('rb')
+
+    def request(self, message):
+        data = json.dumps(message).encode() + b'\n'
+        for attempt in range(2):
+            try:
+                if getattr(self.local, 'conn', None) is None:
+                    self.connect()
+                self.local.conn.sendall(data)
+                line = self.local.reader.readline()
+                if line:
+                    return json.loads(line)
+            except OSError:
+                if attempt:
+                    raise
+            # The helper went away, reconnect once
+            self.local.conn = None
+        raise ConnectionError(f"no answer from iptables helper at {self.path}")
+
+    def ping(self):
+        if self.privileged is None:
+            self.privileged = bool(self.request({'op': 'ping'}).get('privileged'))
+        return self.privileged
+
+    def stream(self, argv):
+        # Output pieces as the helper sends them, on a connection of its own
+        # that is closed when the reader stops
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+            conn.sendall(json.dumps({'op': 'stream', 'argv': argv}).encode() + b'\n')
+            with conn.makefile('rb') as reader:
+                for line in reader:
+                    response = json.loads(line)
+                    if 'error' in response:
+                        raise PermissionError(response['error'])
+                    if 'data' in response:
+                        yield response['data'].encode('utf-8', 'surrogateescape')
+                        continue
+                    if response['returncode'] != 0:
+                        raise subprocess.CalledProcessError(
+                            response['returncode'], argv, stderr=response['stderr'].encode('utf-8', 'surrogateescape'))
+                    return
+            raise ConnectionError(f"no answer from iptables helper at {self.path}")
+        finally:
+            conn.close()
+
+    def save_rules(self, family):
+        response = self.request({'op': 'save_rules', 'family': family})
+        if 'error' in response:
+            raise PermissionError(response['error'])
+        if response['returncode'] != 0:
+            raise subprocess.CalledProcessError(response['returncode'], [FAMILIES[family]['save']],
+                                                stderr=response['stderr'].encode('utf-8', 'surrogateescape'))
+
+    def run(self, argv, input=None):
+        response = self.request({'argv': argv,
+                                 'input': input.decode('utf-8', 'surrogateescape') if input is not None else None})
+        if 'error' in response:
+            raise PermissionError(response['error'])
+        return (response['returncode'],
+                response['stdout'].encode('utf-8', 'surrogateescape'),
+                response['stderr'].encode('utf-8', 'surrogateescape'))
+
+helper_client = None
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Requests slower than this many milliseconds are logged with a breakdown,
+# 0 turns the log off
+SLOW_REQUEST_MS = float(os.environ.get('IPTABLES_GUI_SLOW_REQUEST_MS', '0'))
+
+def format_labels(names, values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+class MetricHistogram:
+    # Prometheus histogram with one series per label combination
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.series.items()):
+                text = format_labels(self.labels, labels)
+                separator = ',' if text else ''
+                cumulative = 0
+                for bound, found in zip(self.buckets, counts):
+                    cumulative += found
+                    lines.append(f'{self.name}_bucket{{{text}{separator}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{text}{separator}le="+Inf"}} {count}')
+                braces = f'{{{text}}}' if text else ''
+                lines.append(f'{self.name}_sum{braces} {total}')
+                lines.append(f'{self.name}_count{braces} {count}')
+        return lines
+
+class MetricCounter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, amount, *labels):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{{{format_labels(self.labels, labels)}}} {value}')
+        return lines
+
+REQUEST_SECONDS = MetricHistogram('iptables_gui_request_duration_seconds', 'Time spent handling requests.',
+                                  ['route', 'method', 'status'])
+COMMAND_SECONDS = MetricHistogram('iptables_gui_command_duration_seconds', 'Time spent running privileged commands.',
+                                  ['command', 'exit_status'])
+COMMAND_OUTPUT = MetricCounter('iptables_gui_command_output_bytes_total', 'Output read from privileged commands.',
+                               ['command'])
+PARSE_SECONDS = MetricHistogram('iptables_gui_parse_duration_seconds', 'Time spent parsing iptables-save output.', [])
+BACKEND_FALLBACKS = MetricCounter('iptables_gui_backend_fallbacks_total',
+                                  'nftables reads and writes done through iptables instead.', ['operation'])
+RENDER_SECONDS = MetricHistogram('iptables_gui_render_duration_seconds', 'Time spent rendering templates.',
+                                 ['template'])
+METRICS = [REQUEST_SECONDS, COMMAND_SECONDS, COMMAND_OUTPUT, PARSE_SECONDS, BACKEND_FALLBACKS, RENDER_SECONDS]
+
+# Where the time of the current request went, for the slow request log
+request_timings = threading.local()
+
+def record_timing(part, seconds):
+    timings = getattr(request_timings, 'current', None)
+    if timings is not None:
+        timings[part] = timings.get(part, 0) + seconds
+        timings[part + '_count'] = timings.get(part + '_count', 0) + 1
+
+def command_kind(argv):
+    # "iptables -A", "ipset restore", "iptables-save": the program and what it does
+    if argv[0] in ('iptables', 'ip6tables'):
+        for arg in argv[1:]:
+            if arg in ('-A', '-D', '-I', '-R', '-N', '-X', '-F', '-P', '-L', '-S', '-Z', '-E'):
+                return f'{argv[0]} {arg}'
+    if argv[0] == 'ipset' and len(argv) > 1:
+        return f'ipset {argv[1]}'
+    if argv[0] in ('iptables-restore', 'ip6tables-restore') and '--test' in argv:
+        return f'{argv[0]} --test'
+    if argv[0] == 'nft':
+        return 'nft list' if 'list' in argv else 'nft -c' if '-c' in argv else 'nft -f'
+    return argv[0]
+
+@app.before_request
+def start_request_timer():
+    request.environ['iptables_gui.started'] = time.perf_counter()
+    request_timings.current = {}
+
+@app.after_request
+def record_request_time(response):
+    started = request.environ.get('iptables_gui.started')
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(elapsed, route, request.method, response.status_code)
+        timings = getattr(request_timings, 'current', None) or {}
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            accounted = sum(value for key, value in timings.items() if not key.endswith('_count'))
+            parts = ', '.join(f"{part} {timings[part] * 1000:.1f} ms ({timings[part + '_count']}x)"
+                              for part in ('commands', 'parse', 'render') if part in timings)
+            app.logger.warning(f"slow request {request.method} {request.path} {response.status_code} "
+                               f"{elapsed * 1000:.1f} ms: {parts or 'no commands'}, "
+                               f"other {(elapsed - accounted) * 1000:.1f} ms")
+    return response
+
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = int(os.environ.get('IPTABLES_GUI_GZIP_LEVEL', '6'))
+
+@app.after_request
+def compress_response(response):
+    # Streamed responses (SSE, the rule pages) are left alone, compressing
+    # them would mean buffering them
+    if (not GZIP_LEVEL or response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or 'gzip' not in request.accept_encodings):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.teardown_request
+def clear_request_timings(exc):
+    request_timings.current = None
+
+# Seconds iptables waits for the xtables lock instead of failing at once
+LOCK_WAIT = os.environ.get('IPTABLES_GUI_LOCK_WAIT', '10')
+LOCKING_COMMANDS = {'iptables', 'iptables-restore', 'ip6tables', 'ip6tables-restore'}
+
+def execute_command(argv, input=None):
+    # Runs a privileged command through the helper if one is configured,
+    # through sudo otherwise. Returns stdout, raises CalledProcessError.
+    started = time.perf_counter()
+    if helper_client is not None:
+        returncode, stdout, stderr = helper_client.run(argv, input)
+    else:
+        cmd = argv if os.geteuid() == 0 else ['sudo'] + argv
+        result = subprocess.run(cmd, input=input, capture_output=True)
+        returncode, stdout, stderr = result.returncode, result.stdout, result.stderr
+    kind = command_kind(argv)
+    COMMAND_SECONDS.observe(time.perf_counter() - started, kind, returncode)
+    COMMAND_OUTPUT.inc(len(stdout), kind)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, argv, output=stdout, stderr=stderr)
+    return stdout
+
+def is_read_command(argv):
+    if argv[0] in ('iptables-save', 'ip6tables-save'):
+        return True
+    if argv[0] in ('iptables', 'ip6tables'):
+        return any(arg in ('-L', '--list', '-S', '--list-rules') for arg in argv)
+    if argv[0] == 'ipset':
+        return argv[1:2] == ['list']
+    if argv[0] == 'nft':
+        return 'list' in argv
+    return False
+
+class SingleFlight:
+    # Concurrent calls with the same key share the result of the first one
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.started = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.started += 1
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.calls[key]
+        return future.result()
+
+class WriteQueue:
+    # Every mutating command runs on one thread in arrival order, so writers
+    # queue here instead of racing each other for the xtables lock
+    def __init__(self, runner):
+        self.runner = runner
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.completed = 0
+        # Bumped as every write starts and again as it ends. A read only
+        # shares a flight started in the same epoch, one that began before
+        # a write may have seen the rules from before it.
+        self.epoch = 0
+
+    def submit(self, argv, input=None):
+        future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put((argv, input, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            argv, input, future = self.queue.get()
+            self.epoch += 1
+            try:
+                result = self.runner(argv, input)
+            except Exception as e:
+                self.epoch += 1
+                future.set_exception(e)
+            else:
+                self.epoch += 1
+                future.set_result(result)
+            self.completed += 1
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'completed': self.completed}
+
+read_flights = SingleFlight()
+write_queue = WriteQueue(execute_command)
+
+def run_command(argv, input=None):
+    # Identical reads running at the same time are done once, everything
+    # else is serialized through the write queue
+    if argv[0] in LOCKING_COMMANDS and LOCK_WAIT:
+        argv = [argv[0], '-w', LOCK_WAIT] + argv[1:]
+    started = time.perf_counter()
+    try:
+        if input is None and is_read_command(argv):
+            return read_flights.do((write_queue.epoch, tuple(argv)), lambda: execute_command(argv))
+        return write_queue.submit(argv, input)
+    finally:
+        # Includes waiting for a shared read or for the write queue
+        record_timing('commands', time.perf_counter() - started)
+
+def command_error(e):
+    if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+        return e.stderr.decode(errors='replace').strip()
+    return str(e)
+
+sudo_checked_at = None
+
+def check_sudo():
+    if helper_client is not None:
+        try:
+            return helper_client.ping()
+        except Exception:
+            return False
+    if os.geteuid() == 0:
+        return True
+    # A successful probe is trusted for as long as a cached ruleset would be
+    global sudo_checked_at
+    if sudo_checked_at is not None and time.monotonic() - sudo_checked_at < CACHE_TTL:
+        return True
+    started = time.perf_counter()
+    try:
+        subprocess.check_output(['sudo', '-n', 'true'])
+        sudo_checked_at = time.monotonic()
+        return True
+    except:
+        sudo_checked_at = None
+        return False
+    finally:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, 'sudo -n', 0 if sudo_checked_at else 1)
+
+TABLES = ['filter', 'nat', 'mangle', 'raw']
+BUILTIN_CHAINS = ['INPUT', 'OUTPUT', 'FORWARD', 'PREROUTING', 'POSTROUTING']
+
+# Options whose value is pulled out of a rule into its own field.
+# -p/-s/-d/-i/-o are shown in their own columns, the port options stay in
+# the extra match text as well (like `iptables -L` shows them).
+RULE_FIELDS = {'-p': 'protocol', '-s': 'source', '-d': 'destination',
+               '-i': 'in_interface', '-o': 'out_interface'}
+PORT_FIELDS = {'--sport': 'sport', '--sports': 'sport',
+               '--source-port': 'sport', '--source-ports': 'sport',
+               '--dport': 'dport', '--dports': 'dport',
+               '--destination-port': 'dport', '--destination-ports': 'dport'}
+
+def parse_counters(text):
+    # "[packets:bytes]"
+    packets, _, nbytes = text.strip('[]').partition(':')
+    return int(packets), int(nbytes)
+
+def parse_rule_spec(spec, family='ipv4'):
+    tokens = shlex.split(spec) if '"' in spec or "'" in spec else spec.split()
+    anywhere = '::/0' if family == 'ipv6' else '0.0.0.0/0'
+    rule = {'protocol': 'all', 'opt': '--', 'source': anywhere,
+            'destination': anywhere, 'in_interface': '*', 'out_interface': '*',
+            'sport': '', 'dport': '', 'target': '', 'goto': False,
+            'matches': [], 'spec': spec, 'tokens': tokens}
+    extra = []
+    negate = False
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        value = tokens[i + 1] if i + 1 < len(tokens) else ''
+        prefix = '!' if negate else ''
+        negate = False
+        if tok == '!':
+            negate = True
+            i += 1
+            continue
+        if tok in RULE_FIELDS:
+            rule[RULE_FIELDS[tok]] = prefix + value
+        elif tok in ('-j', '-g'):
+            rule['target'] = value
+            rule['goto'] = tok == '-g'
+        elif tok == '-f':
+            rule['opt'] = '!f' if prefix else '-f'
+            i += 1
+            continue
         else:
-            cmd.extend(['-j', request.form['action']])
-            
-        subprocess.check_call(cmd)
+            if tok in PORT_FIELDS:
+                rule[PORT_FIELDS[tok]] = prefix + value
+            elif tok == '-m':
+                rule['matches'].append(value)
+            if prefix:
+                extra.append('!')
+            extra.append(tok)
+            i += 1
+            continue
+        i += 2
+    rule['extra'] = ' '.join(extra)
+    return rule
+
+def parse_iptables_save(text, family='ipv4'):
+    # Builds {table: {chain: {'policy', 'packets', 'bytes', 'rules'}}} out of
+    # one `iptables-save -c` or `ip6tables-save -c` dump. Custom chains have
+    # policy None.
+    ruleset = {}
+    chains = None
+    for line in text.splitlines():
+        if not line or line[0] == '#':
+            continue
+        if line[0] == '*':
+            chains = ruleset.setdefault(line[1:].strip(), {})
+        elif line[0] == ':':
+            parts = line[1:].split()
+            packets, nbytes = parse_counters(parts[2]) if len(parts) > 2 else (0, 0)
+            chains[parts[0]] = {'name': parts[0],
+                                'policy': None if parts[1] == '-' else parts[1],
+                                'packets': packets, 'bytes': nbytes, 'rules': []}
+        elif line == 'COMMIT':
+            chains = None
+        elif chains is not None:
+            packets = nbytes = 0
+            if line[0] == '[':
+                counters, _, line = line.partition(' ')
+                packets, nbytes = parse_counters(counters)
+            parts = line.split(None, 2)
+            if len(parts) < 2 or parts[0] != '-A':
+                continue
+            chain = chains.setdefault(parts[1], {'name': parts[1], 'policy': None,
+                                                 'packets': 0, 'bytes': 0, 'rules': []})
+            rule = parse_rule_spec(parts[2] if len(parts) > 2 else '', family)
+            rule['num'] = len(chain['rules']) + 1
+            rule['packets'] = packets
+            rule['bytes'] = nbytes
+            chain['rules'].append(rule)
+    return ruleset
+
+def load_ruleset(family='ipv4'):
+    return backends[family].load()
+
+CACHE_TTL = float(os.environ.get('IPTABLES_GUI_CACHE_TTL', '10'))
+
+class RulesetCache:
+    # Process-wide parsed ruleset. Mutating routes bump the generation, the
+    # TTL catches changes made outside the GUI.
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.generation = 0
+        self.ruleset = None
+        self.ruleset_generation = -1
+        self.loaded_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.derived_lock = threading.Lock()
+        self.derived_values = {}
+
+    def fresh(self):
+        return (self.ruleset is not None and self.ruleset_generation == self.generation
+                and time.monotonic() - self.loaded_at < self.ttl)
+
+    def get(self):
+        with self.lock:
+            if self.fresh():
+                self.hits += 1
+                return self.ruleset
+        # Only one thread reloads, the others wait for its result
+        with self.load_lock:
+            with self.lock:
+                if self.fresh():
+                    self.hits += 1
+                    return self.ruleset
+                self.misses += 1
+                generation = self.generation
+            ruleset = self.loader()
+            with self.lock:
+                self.ruleset = ruleset
+                self.ruleset_generation = generation
+                self.loaded_at = time.monotonic()
+            return ruleset
+
+    def derived(self, name, builder):
+        # Structures computed from the snapshot (indexes, compiled rules) are
+        # rebuilt only when the snapshot itself changes
+        ruleset = self.get()
+        with self.derived_lock:
+            cached = self.derived_values.get(name)
+            if cached is None or cached[0] is not ruleset:
+                cached = (ruleset, builder(ruleset))
+                self.derived_values[name] = cached
+            return cached[1]
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'generation': self.generation,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'age': time.monotonic() - self.loaded_at if self.ruleset is not None else None,
+                    'fresh': self.fresh()}
+
+ruleset_caches = {family: RulesetCache(partial(load_ruleset, family), CACHE_TTL) for family in FAMILIES}
+# Search, simulation, analysis, history, blocklists, logs and the fleet
+# work on the IPv4 rules
+ruleset_cache = ruleset_caches['ipv4']
+family_pool = ThreadPoolExecutor(max_workers=len(FAMILIES))
+
+def get_ruleset(family='ipv4'):
+    try:
+        return ruleset_caches[family].get()
+    except Exception as e:
+        print(f"Error getting {family} ruleset: {e}")
+        return {}
+
+def get_rulesets():
+    # Every family at once, a stale family is dumped while the other one is.
+    # Families that couldn't be read are left out.
+    futures = {family: family_pool.submit(cache.get) for family, cache in ruleset_caches.items()}
+    rulesets = {}
+    for family, future in futures.items():
+        try:
+            rulesets[family] = future.result()
+        except Exception as e:
+            print(f"Error getting {family} ruleset: {e}")
+    return rulesets
+
+def request_family():
+    # ?family= or the family field of a form, IPv4 when there is none
+    return request.values.get('family', 'ipv4')
+
+@app.before_request
+def check_family():
+    if request_family() not in FAMILIES:
+        return jsonify({'error': f"Unknown family {request_family()}, use {' or '.join(FAMILIES)}"}), 400
+
+def index_url():
+    # Back to the page of the family the form was for
+    family = request_family()
+    return '/' if family == 'ipv4' else f'/?family={family}'
+
+# Differs per process, so a restarted (maybe upgraded) GUI never answers
+# 304 for a page an older version rendered
+ETAG_SALT = os.urandom(8).hex()
+
+def ruleset_digest(ruleset):
+    # Everything the read views show, counters included
+    digest = hashlib.sha256()
+    for table, chains in ruleset.items():
+        for name, chain in chains.items():
+            digest.update(f"*{table} {name} {chain['policy']} {chain['packets']} {chain['bytes']}\n".encode())
+            digest.update(''.join(f"{rule['packets']} {rule['bytes']} {rule['spec']}\n"
+                                  for rule in chain['rules']).encode())
+    return digest.hexdigest()
+
+def ruleset_etag(families):
+    rulesets = get_rulesets() if len(families) > 1 else {family: get_ruleset(family) for family in families}
+    digests = ' '.join(ruleset_caches[family].derived('digest', ruleset_digest) if family in rulesets else 'unread'
+                       for family in families)
+    return hashlib.sha256(f"{ETAG_SALT} {digests} {pending_changes.version}".encode()).hexdigest()[:32]
+
+def conditional_on_ruleset(f, every_family=False):
+    # Read views answer If-None-Match with a 304 while the ruleset snapshot
+    # of the requested family (and the staged changes) they were rendered
+    # from haven't changed, without rendering anything
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            etag = ruleset_etag(list(FAMILIES) if every_family else [request_family()])
+        except Exception:
+            return f(*args, **kwargs)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return decorated_function
+
+def conditional_on_rulesets(f):
+    # The same for views showing every family
+    return conditional_on_ruleset(f, every_family=True)
+
+def ordered_tables(ruleset):
+    return [t for t in TABLES if t in ruleset] + [t for t in ruleset if t not in TABLES]
+
+def get_chains(ruleset, table='filter'):
+    return list(ruleset.get(table, {}))
+
+def get_custom_chains(ruleset):
+    custom_chains = []
+    for table in ordered_tables(ruleset):
+        for chain in ruleset[table].values():
+            if chain['policy'] is None:
+                custom_chains.append({'table': table, 'name': chain['name']})
+    return custom_chains
+
+def get_policies(ruleset):
+    policies = []
+    for table in ordered_tables(ruleset):
+        for chain in ruleset[table].values():
+            if chain['policy'] is not None:
+                policies.append({'table': table, 'chain': chain['name'], 'policy': chain['policy']})
+    return policies
+
+# Options tying a rule to the addresses of its own family
+ADDRESS_OPTIONS = {'-s', '--source', '-d', '--destination', '--to-source', '--to-destination', '--to',
+                   '--src-range', '--dst-range'}
+# ip6tables spellings of the same thing, as iptables spells it
+FAMILY_SPELLINGS = {'ipv6-icmp': 'icmp', 'icmpv6': 'icmp', 'icmp6': 'icmp', '--icmpv6-type': '--icmp-type',
+                    'icmp6-port-unreachable': 'icmp-port-unreachable',
+                    'icmp6-adm-prohibited': 'icmp-admin-prohibited',
+                    'icmp6-addr-unreachable': 'icmp-host-unreachable',
+                    'icmp6-no-route': 'icmp-net-unreachable'}
+# ICMPv6 types meaning the same as an ICMP one
+ICMPV6_TYPES = {'128': '8', '129': '0', '1': '3', '3': '11', '4': '12'}
+
+def family_neutral_spec(rule, family):
+    # The rule as either family would write it, None when it can only exist
+    # in its own family (addresses, ICMP types without a counterpart). Kept
+    # on the cached rule like the parsed networks.
+    if 'neutral_spec' not in rule:
+        tokens = [FAMILY_SPELLINGS.get(token, token) for token in rule['tokens']]
+        if ADDRESS_OPTIONS.intersection(tokens):
+            tokens = None
+        elif '--icmp-type' in tokens:
+            i = tokens.index('--icmp-type') + 1
+            icmp_type = tokens[i] if i < len(tokens) else ''
+            if family == 'ipv6':
+                tokens[i] = ICMPV6_TYPES.get(icmp_type)
+            elif icmp_type not in ICMPV6_TYPES.values():
+                tokens[i] = None
+            if tokens[i] is None:
+                tokens = None
+        rule['neutral_spec'] = ' '.join(tokens) if tokens is not None else None
+    return rule['neutral_spec']
+
+def family_mismatches(rulesets):
+    # Rules of one family with no counterpart in the same chain of the
+    # other. Counterparts are used up, a rule written twice in one family
+    # and once in the other is reported once.
+    if len(rulesets) < 2:
+        return []
+    mismatches = []
+    for family, other_family in itertools.permutations(rulesets, 2):
+        ruleset, other = rulesets[family], rulesets[other_family]
+        for table in ordered_tables(ruleset):
+            for name, chain in ruleset[table].items():
+                other_chain = other.get(table, {}).get(name)
+                counterparts = Counter(family_neutral_spec(rule, other_family)
+                                       for rule in (other_chain['rules'] if other_chain else []))
+                for rule in chain['rules']:
+                    spec = family_neutral_spec(rule, family)
+                    if spec is None:
+                        continue
+                    if counterparts[spec]:
+                        counterparts[spec] -= 1
+                        continue
+                    mismatches.append({'family': family, 'missing_from': other_family, 'table': table,
+                                       'chain': name, 'num': rule['num'], 'spec': rule['spec'],
+                                       'chain_missing': other_chain is None})
+    return mismatches
+
+@app.route('/')
+@conditional_on_rulesets
+def index():
+    family = request_family()
+    rulesets = get_rulesets()
+    ruleset = rulesets.get(family, {})
+    started = time.perf_counter()
+    page = render_template(INDEX_TEMPLATE,
+                           family=family,
+                           families=FAMILIES,
+                           unread_families=[name for name in FAMILIES if name not in rulesets],
+                           family_mismatches=family_mismatches(rulesets),
+                           chains=get_chains(ruleset),
+                           custom_chains=get_custom_chains(ruleset),
+                           policies=get_policies(ruleset),
+                           chains_by_table={table: get_chains(ruleset, table) for table in ordered_tables(ruleset)},
+                           nat_rules=get_nat_rules(ruleset),
+                           pending_changes=pending_changes.list(),
+                           pending_payload=pending_changes.payload(),
+                           backend_name=', '.join(dict.fromkeys(backend.name for backend in backends.values())),
+                           fleet_hosts=fleet,
+                           fleet_groups=sorted({group for host in fleet for group in host.groups}))
+    elapsed = time.perf_counter() - started
+    RENDER_SECONDS.observe(elapsed, 'index')
+    record_timing('render', elapsed)
+    return page
+
+def get_rules_table(ruleset, table, chain, family='ipv4'):
+    if chain not in ruleset.get(table, {}):
+        return f'<div class="status error">Error getting rules: no chain {escape(chain)} in table {escape(table)}</div>'
+    html = ['<table><tr><th>Num</th><th>Pkts</th><th>Bytes</th><th>Target</th><th>Prot</th><th>Opt</th><th>Source</th><th>Destination</th><th>Action</th></tr>']
+    for rule in ruleset[table][chain]['rules']:
+        html.append(f'''
+            <tr>
+                <td>{rule['num']}</td>
+                <td>{rule['packets']}</td>
+                <td>{rule['bytes']}</td>
+                <td>{escape(rule['target'])}</td>
+                <td>{escape(rule['protocol'])}</td>
+                <td>{rule['opt']}</td>
+                <td>{escape(rule['source'])}</td>
+                <td>{escape(rule['destination'])}</td>
+                <td>
+                    <form method="POST" action="/delete_rule" style="display: inline;">
+                        <input type="hidden" name="family" value="{family}">
+                        <input type="hidden" name="table" value="{escape(table)}">
+                        <input type="hidden" name="chain" value="{escape(chain)}">
+                        <input type="hidden" name="rule_number" value="{rule['num']}">
+                        <button type="submit" class="button delete">Delete</button>
+                        <button type="submit" class="button delete" formaction="/stage/delete_rule">Stage Delete</button>
+                    </form>
+                </td>
+            </tr>
+        ''')
+    html.append('</table>')
+    return ''.join(html)
+
+def format_chain_listing(chain):
+    # Same layout as `iptables -L <chain> -n -v`
+    if chain['policy'] is not None:
+        header = f"Chain {chain['name']} (policy {chain['policy']} {chain['packets']} packets, {chain['bytes']} bytes)"
+    else:
+        header = f"Chain {chain['name']}"
+    lines = [header, f"{'pkts':>8} {'bytes':>8} {'target':<12} {'prot':<4} {'opt':<3} {'in':<8} {'out':<8} {'source':<20} {'destination':<20}"]
+    for rule in chain['rules']:
+        lines.append(f"{rule['packets']:>8} {rule['bytes']:>8} {rule['target']:<12} {rule['protocol']:<4} {rule['opt']:<3} "
+                     f"{rule['in_interface']:<8} {rule['out_interface']:<8} {rule['source']:<20} {rule['destination']:<20} {rule['extra']}")
+    return '\n'.join(lines)
+
+def get_nat_rules(ruleset):
+    if 'nat' not in ruleset:
+        return '<div class="status error">Error getting NAT rules: nat table not loaded</div>'
+    output = '\n\n'.join(format_chain_listing(chain) for chain in ruleset['nat'].values())
+    return f'<pre>{escape(output)}</pre>'
+
+@app.route('/get_nat_rules')
+@require_sudo
+@conditional_on_ruleset
+def nat_rules():
+    return jsonify({'html': get_nat_rules(get_ruleset(request_family()))})
+
+@app.route('/api/families/mismatches')
+@require_sudo
+@conditional_on_rulesets
+def api_family_mismatches():
+    rulesets = get_rulesets()
+    return jsonify({'families': list(rulesets), 'unread': [family for family in FAMILIES if family not in rulesets],
+                    'mismatches': family_mismatches(rulesets)})
+
+RULE_API_FIELDS = ['num', 'packets', 'bytes', 'target', 'protocol', 'opt', 'source', 'destination',
+                   'in_interface', 'out_interface', 'extra', 'spec']
+
+def rule_network(rule, field):
+    # Parsed once per cached snapshot, None for anything that isn't a network
+    key = field + '_net'
+    if key not in rule:
+        try:
+            rule[key] = ipaddress.ip_network(rule[field].lstrip('!'), strict=False)
+        except ValueError:
+            rule[key] = None
+    return rule[key]
+
+def interface_matches(pattern, name):
+    pattern = pattern.lstrip('!')
+    if pattern.endswith('+'):
+        return name.startswith(pattern[:-1])
+    return pattern == name
+
+def build_rule_filter(args):
+    # Returns a predicate for the filters given in the query string,
+    # or None when nothing is filtered
+    checks = []
+    if args.get('target'):
+        target = args['target'].upper()
+        checks.append(lambda rule: rule['target'].upper() == target)
+    if args.get('protocol'):
+        protocol = args['protocol'].lower()
+        checks.append(lambda rule: rule['protocol'].lstrip('!').lower() == protocol)
+    for field in ('source', 'destination'):
+        if args.get(field):
+            network = ipaddress.ip_network(args[field], strict=False)
+            # Rules without an address (0.0.0.0/0) don't count as touching it
+            checks.append(lambda rule, field=field, network=network:
+                          rule_network(rule, field) is not None
+                          and rule_network(rule, field).prefixlen > 0
+                          and rule_network(rule, field).version == network.version
+                          and rule_network(rule, field).overlaps(network))
+    if args.get('interface'):
+        interface = args['interface']
+        checks.append(lambda rule: interface_matches(rule['in_interface'], interface)
+                      or interface_matches(rule['out_interface'], interface))
+    if args.get('q'):
+        text = args['q'].lower()
+        checks.append(lambda rule: text in rule['spec'].lower())
+    if not checks:
+        return None
+    return lambda rule: all(check(rule) for check in checks)
+
+@app.route('/api/rules')
+@require_sudo
+@conditional_on_ruleset
+def api_rules():
+    table = request.args.get('table', 'filter')
+    chain = request.args.get('chain', 'INPUT')
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+        matches = build_rule_filter(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    chain_data = get_ruleset(request_family()).get(table, {}).get(chain)
+    if chain_data is None:
+        return jsonify({'error': f"No chain {chain} in table {table}"}), 404
+    rules = chain_data['rules']
+
+    def generate():
+        header = json.dumps({'table': table, 'chain': chain, 'offset': offset, 'limit': limit})
+        yield header[:-1] + ', "rules": ['
+        if matches is None:
+            total = len(rules)
+            for i, rule in enumerate(rules[offset:offset + limit]):
+                yield (',' if i else '') + json.dumps({k: rule[k] for k in RULE_API_FIELDS})
+        else:
+            total = 0
+            for rule in rules:
+                if not matches(rule):
+                    continue
+                if offset <= total < offset + limit:
+                    yield (',' if total > offset else '') + json.dumps({k: rule[k] for k in RULE_API_FIELDS})
+                total += 1
+        yield f'], "total": {total}}}'
+    return Response(generate(), mimetype='application/json')
+
+def parse_port_ranges(value):
+    # "22", "1000:2000" or a multiport list "80,443,8000:8080"
+    ranges = []
+    for part in value.split(','):
+        low, _, high = part.partition(':')
+        low = int(low) if low else 0
+        ranges.append((low, int(high) if high else (65535 if _ else low)))
+    return ranges
+
+@lru_cache(maxsize=65536)
+def parse_prefix(text):
+    # (version, network as int, prefix length) without building ipaddress
+    # objects, which is too slow for 100k rules. None if not an address.
+    address, _, length = text.partition('/')
+    try:
+        if ':' in address:
+            version, bits, packed = 6, 128, socket.inet_pton(socket.AF_INET6, address)
+        else:
+            version, bits, packed = 4, 32, socket.inet_pton(socket.AF_INET, address)
+        length = int(length) if length else bits
+    except (OSError, ValueError):
+        return None
+    if not 0 <= length <= bits:
+        return None
+    mask = ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+    return version, int.from_bytes(packed, 'big') & mask, length
+
+class PrefixIndex:
+    # Prefixes bucketed by length, one hash lookup per length present answers
+    # "which prefixes contain this address"; a sorted array of network
+    # starts answers "which prefixes lie inside this network"
+    def __init__(self, bits):
+        self.bits = bits
+        self.by_length = {}
+        self.starts = []
+        self.start_keys = []
+
+    def add(self, address, length, value):
+        table = self.by_length.setdefault(length, {})
+        table.setdefault(address >> (self.bits - length), []).append(value)
+        self.starts.append((address, length, value))
+
+    def freeze(self):
+        self.starts.sort()
+        self.start_keys = [start[0] for start in self.starts]
+
+    def lookup(self, address, prefixlen):
+        found = []
+        for length, table in self.by_length.items():
+            if length <= prefixlen:
+                found.extend(table.get(address >> (self.bits - length), ()))
+        low = bisect.bisect_left(self.start_keys, address)
+        high = bisect.bisect_right(self.start_keys, address | ((1 << (self.bits - prefixlen)) - 1))
+        for start, length, value in self.starts[low:high]:
+            if length > prefixlen:
+                found.append(value)
+        return found
+
+class IntervalTree:
+    # Static centered interval tree over (low, high, value). Single ports
+    # are the common case and go into a plain dict instead.
+    def __init__(self, intervals):
+        self.points = {}
+        ranges = {}
+        for low, high, value in intervals:
+            if low == high:
+                self.points.setdefault(low, []).append(value)
+            else:
+                ranges.setdefault((low, high), []).append(value)
+        self.root = self.build([(low, high, values) for (low, high), values in ranges.items()])
+
+    def build(self, intervals):
+        if not intervals:
+            return None
+        points = sorted(low + high for low, high, value in intervals)
+        center = points[len(points) // 2] / 2
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        return (center,
+                sorted(here, key=lambda i: i[0]),
+                sorted(here, key=lambda i: -i[1]),
+                self.build(left), self.build(right))
+
+    def stab(self, point):
+        found = list(self.points.get(point, ()))
+        node = self.root
+        while node is not None:
+            center, by_low, by_high, left, right = node
+            if point < center:
+                for low, high, values in by_low:
+                    if low > point:
+                        break
+                    found.extend(values)
+                node = left
+            else:
+                for low, high, values in by_high:
+                    if high < point:
+                        break
+                    found.extend(values)
+                node = right
+        return found
+
+class RuleIndex:
+    # Source/destination prefixes and port ranges of every rule in every
+    # table, for "which rules touch this address" searches
+    SIDES = (('source', 'sport'), ('destination', 'dport'))
+
+    def __init__(self, ruleset):
+        self.entries = []
+        self.prefixes = {side: {4: PrefixIndex(32), 6: PrefixIndex(128)} for side, _ in self.SIDES}
+        self.unbound = {side: set() for side, _ in self.SIDES}
+        self.portless = {field: set() for _, field in self.SIDES}
+        intervals = {field: [] for _, field in self.SIDES}
+        for table in ordered_tables(ruleset):
+            for chain in ruleset[table].values():
+                for rule in chain['rules']:
+                    rule_id = len(self.entries)
+                    self.entries.append((table, chain['name'], rule))
+                    for side, field in self.SIDES:
+                        prefix = parse_prefix(rule[side])
+                        # Negated or missing addresses match (almost) anything
+                        if prefix is None or prefix[2] == 0:
+                            self.unbound[side].add(rule_id)
+                        else:
+                            self.prefixes[side][prefix[0]].add(prefix[1], prefix[2], rule_id)
+                        try:
+                            if not rule[field] or rule[field].startswith('!'):
+                                raise ValueError(rule[field])
+                            for low, high in parse_port_ranges(rule[field]):
+                                intervals[field].append((low, high, rule_id))
+                        except ValueError:
+                            self.portless[field].add(rule_id)
+        for by_version in self.prefixes.values():
+            for prefixes in by_version.values():
+                prefixes.freeze()
+        self.ports = {field: IntervalTree(values) for field, values in intervals.items()}
+
+    def search(self, network, port=None, include_any=False):
+        # Returns {rule_id: [sides]} for rules whose source or destination
+        # overlaps the network (and whose port on that side allows the port)
+        matches = {}
+        for side, field in self.SIDES:
+            ids = self.prefixes[side][network.version].lookup(int(network.network_address), network.prefixlen)
+            if include_any:
+                ids = list(self.unbound[side]) + ids
+            if port is not None:
+                stabbed = set(self.ports[field].stab(port))
+                portless = self.portless[field]
+                ids = [i for i in ids if i in portless or i in stabbed]
+            for rule_id in ids:
+                sides = matches.setdefault(rule_id, [])
+                if side not in sides:
+                    sides.append(side)
+        return matches
+
+@app.route('/api/search')
+@require_sudo
+@conditional_on_ruleset
+def search_rules():
+    try:
+        network = ipaddress.ip_network(request.args['address'], strict=False)
+        port = int(request.args['port']) if request.args.get('port') else None
+        limit = min(max(int(request.args.get('limit', 500)), 1), 5000)
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f"Invalid search: {e}"}), 400
+    include_any = request.args.get('any') in ('1', 'true', 'on')
+    # The family the ETag was computed for
+    index = ruleset_caches[request_family()].derived('rule_index', RuleIndex)
+    started = time.perf_counter()
+    matches = index.search(network, port, include_any)
+    elapsed = time.perf_counter() - started
+    rules = []
+    for rule_id in sorted(matches)[:limit]:
+        table, chain, rule = index.entries[rule_id]
+        rules.append({'table': table, 'chain': chain, 'num': rule['num'], 'sides': matches[rule_id],
+                      'target': rule['target'], 'spec': rule['spec'],
+                      'packets': rule['packets'], 'bytes': rule['bytes']})
+    return jsonify({'address': str(network), 'family': request_family(), 'port': port, 'total': len(matches),
+                    'elapsed_ms': elapsed * 1000, 'rules': rules})
+
+# Tables each hook runs, in the order the kernel runs them
+HOOK_PATHS = {
+    'input': [('PREROUTING', ['raw', 'mangle', 'nat']), ('INPUT', ['mangle', 'filter', 'nat'])],
+    'forward': [('PREROUTING', ['raw', 'mangle', 'nat']), ('FORWARD', ['mangle', 'filter']),
+                ('POSTROUTING', ['mangle', 'nat'])],
+    'output': [('OUTPUT', ['raw', 'mangle', 'nat', 'filter']), ('POSTROUTING', ['mangle', 'nat'])],
+}
+PROTOCOL_NUMBERS = {'icmp': 1, 'tcp': 6, 'udp': 17, 'gre': 47, 'esp': 50, 'ah': 51,
+                    'icmpv6': 58, 'ipv6-icmp': 58, 'sctp': 132}
+CONNTRACK_STATES = ['NEW', 'ESTABLISHED', 'RELATED', 'INVALID', 'UNTRACKED']
+# Verdicts that end the walk through a table. NAT targets accept the packet
+# for the nat table, DROP/REJECT/QUEUE end it for good.
+ACCEPTING_TARGETS = {'ACCEPT', 'SNAT', 'DNAT', 'MASQUERADE', 'REDIRECT', 'NETMAP'}
+FINAL_TARGETS = {'DROP', 'REJECT', 'QUEUE', 'NFQUEUE'}
+VERDICTS = ['ACCEPT', 'DROP', 'REJECT', 'QUEUE']
+# Matches the simulator understands, anything else makes the rule never match
+SIMULATED_MATCHES = {'tcp', 'udp', 'multiport', 'conntrack', 'state', 'comment'}
+MAX_JUMP_DEPTH = 64
+# Chains at least this long are split by the leading bits of the address
+PARTITION_MIN_RULES = 64
+
+def verdict_of(target):
+    if target in ('DROP', 'REJECT'):
+        return target
+    if target in ('QUEUE', 'NFQUEUE'):
+        return 'QUEUE'
+    return 'ACCEPT'
+
+def parse_nat_destination(value):
+    # First address and port of "--to-destination 10.0.0.5-10.0.0.9:80-90"
+    address, port = value, None
+    if value.startswith('['):
+        address, _, port = value[1:].partition(']')
+        port = port.lstrip(':')
+    elif value.count(':') == 1:
+        address, _, port = value.partition(':')
+    prefix = parse_prefix(address.split('-')[0]) if address else None
+    port = int(port.split('-')[0]) if port else None
+    return prefix, port
+
+def compile_rule(rule):
+    compiled = {'num': rule['num'], 'target': rule['target'], 'goto': rule['goto'],
+                'target_args': (), 'checks': [], 'unsupported': [], 'opaque': [], 'dnat': None}
+    tokens = rule['tokens']
+    module = None
+    negate = False
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == '!':
+            negate = True
+            i += 1
+            continue
+        value = tokens[i + 1] if i + 1 < len(tokens) else ''
+        step = 2
+        if tok in ('-j', '-g'):
+            args = tokens[i + 2:]
+            compiled['target_args'] = tuple(args)
+            if value == 'DNAT' and '--to-destination' in args:
+                compiled['dnat'] = parse_nat_destination(args[args.index('--to-destination') + 1])
+            break
+        try:
+            if tok == '-m':
+                module = value
+                if value not in SIMULATED_MATCHES:
+                    compiled['unsupported'].append(value)
+                    compiled['opaque'].append(('-m', value))
+            elif tok in ('-s', '-d'):
+                version, address, length = parse_prefix(value)
+                bits = 32 if version == 4 else 128
+                mask = ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+                compiled['checks'].append(('src' if tok == '-s' else 'dst', (version, address, mask), negate))
+            elif tok == '-p':
+                if value.lower() != 'all':
+                    number = int(value) if value.isdigit() else PROTOCOL_NUMBERS[value.lower()]
+                    compiled['checks'].append(('proto', number, negate))
+            elif tok in ('-i', '-o'):
+                compiled['checks'].append(('in' if tok == '-i' else 'out', value, negate))
+            elif tok in PORT_FIELDS or tok == '--ports':
+                field = PORT_FIELDS.get(tok, 'ports')
+                compiled['checks'].append((field, parse_port_ranges(value), negate))
+            elif tok in ('--ctstate', '--state'):
+                compiled['checks'].append(('state', set(value.split(',')), negate))
+            elif tok == '--comment':
+                pass
+            else:
+                raise ValueError(tok)
+        except (KeyError, TypeError, ValueError):
+            # An option we can't evaluate, skip over its arguments
+            if module in SIMULATED_MATCHES or tok[:2] != '--':
+                compiled['unsupported'].append(tok)
+            step = 1
+            while i + step < len(tokens) and tokens[i + step][:1] != '-' and tokens[i + step] != '!':
+                step += 1
+            compiled['opaque'].append(tuple((['!'] if negate else []) + tokens[i:i + step]))
+        negate = False
+        i += step
+    return compiled
+
+def compile_ruleset(ruleset):
+    return {table: {name: {'policy': chain['policy'],
+                           'rules': [compile_rule(rule) for rule in chain['rules']]}
+                    for name, chain in chains.items()}
+            for table, chains in ruleset.items()}
+
+def parse_packet(data):
+    # {src, dst, protocol, sport, dport, in_interface, out_interface, hook, state}
+    packet = {}
+    for field in ('src', 'dst'):
+        prefix = parse_prefix(str(data.get(field, '')).strip())
+        if prefix is None or prefix[2] != (32 if prefix[0] == 4 else 128):
+            raise ValueError(f"{field} must be an address: {data.get(field)!r}")
+        packet[field] = prefix[:2]
+    if packet['src'][0] != packet['dst'][0]:
+        raise ValueError("src and dst are from different address families")
+    protocol = str(data.get('protocol') or 'tcp').lower()
+    packet['proto'] = int(protocol) if protocol.isdigit() else PROTOCOL_NUMBERS[protocol]
+    for field in ('sport', 'dport'):
+        packet[field] = int(data[field]) if str(data.get(field) or '').strip() else None
+    packet['in'] = data.get('in_interface') or None
+    packet['out'] = data.get('out_interface') or None
+    packet['hook'] = str(data.get('hook') or 'input').lower()
+    if packet['hook'] not in HOOK_PATHS:
+        raise ValueError(f"hook must be one of {', '.join(HOOK_PATHS)}")
+    packet['state'] = str(data.get('state') or 'NEW').upper()
+    if packet['state'] not in CONNTRACK_STATES:
+        raise ValueError(f"state must be one of {', '.join(CONNTRACK_STATES)}")
+    return packet
+
+def rule_matches(compiled, packet):
+    if compiled['unsupported']:
+        return False
+    for field, value, negate in compiled['checks']:
+        if field in ('src', 'dst'):
+            version, address = packet[field]
+            result = version == value[0] and address & value[2] == value[1]
+        elif field == 'proto':
+            result = packet['proto'] == value
+        elif field == 'ports':
+            result = any(packet[port] is not None and low <= packet[port] <= high
+                         for port in ('sport', 'dport') for low, high in value)
+        elif field in ('sport', 'dport'):
+            port = packet[field]
+            result = port is not None and any(low <= port <= high for low, high in value)
+        elif field in ('in', 'out'):
+            result = packet[field] is not None and interface_matches(value, packet[field])
+        else:
+            result = packet['state'] in value
+        if result == negate:
+            return False
+    return True
+
+class PacketSimulator:
+    # Walks packets through the compiled ruleset the way netfilter would:
+    # tables in hook order, jumps and gotos into custom chains, RETURN,
+    # chain policies. DNAT rewrites the destination for later tables.
+    def __init__(self, ruleset):
+        self.chains = compile_ruleset(ruleset)
+
+    def trace(self, packet):
+        packet = dict(packet)
+        trace = []
+        decision = None
+        for hook, tables in HOOK_PATHS[packet['hook']]:
+            for table in tables:
+                if hook not in self.chains.get(table, {}):
+                    continue
+                if table == 'nat' and packet['state'] != 'NEW':
+                    trace.append({'hook': hook, 'table': table, 'chain': hook, 'event': 'skip',
+                                  'reason': 'only NEW connections go through nat'})
+                    continue
+                target, chain, rule = self.run_chain(table, hook, packet, trace)
+                verdict = verdict_of(target)
+                if table == 'filter' or verdict != 'ACCEPT' or decision is None:
+                    decision = {'verdict': verdict, 'table': table, 'chain': chain,
+                                'num': rule['num'] if rule else None, 'target': target}
+                if verdict != 'ACCEPT':
+                    return dict(decision, trace=trace)
+                if rule and rule['dnat'] and rule['dnat'][0]:
+                    packet['dst'] = rule['dnat'][0][:2]
+                    if rule['dnat'][1] is not None:
+                        packet['dport'] = rule['dnat'][1]
+        if decision is None:
+            decision = {'verdict': 'ACCEPT', 'table': None, 'chain': None, 'num': None, 'target': None}
+        return dict(decision, trace=trace)
+
+    def run_chain(self, table, hook, packet, trace):
+        chains = self.chains[table]
+        stack = []
+        chain, position = hook, 0
+        trace.append({'hook': hook, 'table': table, 'chain': chain, 'event': 'enter'})
+        while True:
+            rules = chains[chain]['rules']
+            jumped = False
+            while position < len(rules):
+                rule = rules[position]
+                position += 1
+                if rule['unsupported']:
+                    trace.append({'hook': hook, 'table': table, 'chain': chain, 'num': rule['num'], 'event': 'skip',
+                                  'reason': 'unsupported match ' + ', '.join(rule['unsupported'])})
+                    continue
+                if not rule_matches(rule, packet):
+                    continue
+                target = rule['target']
+                trace.append({'hook': hook, 'table': table, 'chain': chain, 'num': rule['num'],
+                              'event': 'match', 'target': target})
+                if target in ACCEPTING_TARGETS or target in FINAL_TARGETS:
+                    return target, chain, rule
+                if target == 'RETURN':
+                    break
+                if target in chains:
+                    if not rule['goto']:
+                        stack.append((chain, position))
+                        if len(stack) > MAX_JUMP_DEPTH:
+                            raise ValueError(f"Jump loop through {table}/{target}")
+                    chain, position = target, 0
+                    trace.append({'hook': hook, 'table': table, 'chain': chain, 'event': 'enter'})
+                    jumped = True
+                    break
+            if jumped:
+                continue
+            if stack:
+                trace.append({'hook': hook, 'table': table, 'chain': chain, 'event': 'return'})
+                chain, position = stack.pop()
+                continue
+            policy = chains[hook]['policy'] or 'ACCEPT'
+            trace.append({'hook': hook, 'table': table, 'chain': hook, 'event': 'policy', 'target': policy})
+            return policy, hook, None
+
+    def run_batch(self, packets):
+        # Returns one {'verdict', 'table', 'chain', 'num'} per packet
+        if np is not None and packets and all(p['src'][0] == 4 for p in packets):
+            return BatchEvaluation(self, packets).run()
+        results = []
+        for packet in packets:
+            result = self.trace(packet)
+            results.append({key: result[key] for key in ('verdict', 'table', 'chain', 'num')})
+        return results
+
+class BatchEvaluation:
+    # Vectorized version of PacketSimulator.trace for IPv4: each rule is
+    # evaluated against every packet still in the chain at once
+    def __init__(self, simulator, packets):
+        self.chains = simulator.chains
+        self.interfaces = sorted({p[field] for p in packets for field in ('in', 'out') if p[field]})
+        codes = {name: i for i, name in enumerate(self.interfaces)}
+        self.src = np.array([p['src'][1] for p in packets], dtype=np.uint32)
+        self.dst = np.array([p['dst'][1] for p in packets], dtype=np.uint32)
+        self.proto = np.array([p['proto'] for p in packets], dtype=np.int16)
+        self.sport = np.array([-1 if p['sport'] is None else p['sport'] for p in packets], dtype=np.int32)
+        self.dport = np.array([-1 if p['dport'] is None else p['dport'] for p in packets], dtype=np.int32)
+        self.iface = {field: np.array([codes[p[field]] if p[field] else -1 for p in packets], dtype=np.int32)
+                      for field in ('in', 'out')}
+        self.state = np.array([CONNTRACK_STATES.index(p['state']) for p in packets], dtype=np.int8)
+        self.hooks = [p['hook'] for p in packets]
+        self.verdict = np.zeros(len(packets), dtype=np.int8)
+        self.decided = np.full(len(packets), -1, dtype=np.int32)
+        self.refs = []
+        self.lookups = {}
+        self.plans = {}
+
+    def lookup(self, kind, value):
+        # Boolean table over interface names / states, indexed by code
+        key = (kind, value if isinstance(value, str) else tuple(sorted(value)))
+        if key not in self.lookups:
+            if kind == 'iface':
+                table = [interface_matches(value, name) for name in self.interfaces]
+            else:
+                table = [state in value for state in CONNTRACK_STATES]
+            self.lookups[key] = np.array(table + [False], dtype=bool)
+        return self.lookups[key]
+
+    def mask(self, rule, idx):
+        matched = np.ones(len(idx), dtype=bool)
+        for field, value, negate in rule['checks']:
+            if field in ('src', 'dst'):
+                column = (self.src if field == 'src' else self.dst)[idx]
+                result = (column & np.uint32(value[2])) == np.uint32(value[1])
+            elif field == 'proto':
+                result = self.proto[idx] == value
+            elif field in ('sport', 'dport', 'ports'):
+                columns = [self.sport[idx], self.dport[idx]] if field == 'ports' else [getattr(self, field)[idx]]
+                result = np.zeros(len(idx), dtype=bool)
+                for column in columns:
+                    for low, high in value:
+                        result |= (column >= low) & (column <= high)
+            elif field in ('in', 'out'):
+                result = self.lookup('iface', value)[self.iface[field][idx]]
+            else:
+                result = self.lookup('state', value)[self.state[idx]]
+            matched &= ~result if negate else result
+            if not matched.any():
+                break
+        return matched
+
+    def ref(self, table, chain, num):
+        self.refs.append((table, chain, num))
+        return len(self.refs) - 1
+
+    def plan(self, table, chain):
+        # For long chains, group the rules by the leading 8/16/24 bits of their
+        # source (or destination) prefix. Packets are then split the same way
+        # and each group only runs the rules that can match it, in chain order.
+        key = (table, chain)
+        if key not in self.plans:
+            rules = self.chains[table][chain]['rules']
+            best = None
+            if len(rules) >= PARTITION_MIN_RULES:
+                for field in ('src', 'dst'):
+                    for bits in (24, 16, 8):
+                        top_mask = ((1 << bits) - 1) << (32 - bits)
+                        buckets = {}
+                        shared = []
+                        for position, rule in enumerate(rules):
+                            bucket = None
+                            for check, value, negate in rule['checks']:
+                                if check == field and not negate and value[0] == 4 and value[2] & top_mask == top_mask:
+                                    bucket = value[1] >> (32 - bits)
+                            if bucket is None:
+                                shared.append(position)
+                            else:
+                                buckets.setdefault(bucket, []).append(position)
+                        if best is None or len(shared) < len(best[3]):
+                            best = (field, bits, buckets, shared)
+            if best is None or len(best[3]) > len(rules) // 2:
+                self.plans[key] = None
+            else:
+                field, bits, buckets, shared = best
+                self.plans[key] = (field, bits,
+                                   {bucket: [rules[p] for p in sorted(positions + shared)]
+                                    for bucket, positions in buckets.items()},
+                                   [rules[p] for p in shared])
+        return self.plans[key]
+
+    def run_chain(self, table, chain, idx, table_verdict, table_ref, depth):
+        # Decides what it can, returns the packets that fall off the end
+        # of the chain (or hit RETURN)
+        if depth > MAX_JUMP_DEPTH:
+            raise ValueError(f"Jump loop through {table}/{chain}")
+        plan = self.plan(table, chain)
+        if plan is None or len(idx) < 2:
+            return self.run_rules(table, chain, self.chains[table][chain]['rules'], idx,
+                                  table_verdict, table_ref, depth)
+        field, bits, buckets, shared = plan
+        top = (self.src if field == 'src' else self.dst)[idx] >> np.uint32(32 - bits)
+        keys = np.fromiter(buckets, dtype=np.uint32, count=len(buckets))
+        bucketed = np.isin(top, keys)
+        # Packets outside every bucket only need the shared rules
+        returned = [self.run_rules(table, chain, shared, idx[~bucketed], table_verdict, table_ref, depth)]
+        idx, top = idx[bucketed], top[bucketed]
+        order = np.argsort(top, kind='stable')
+        idx, top = idx[order], top[order]
+        starts = np.flatnonzero(np.diff(top)) + 1
+        for group, start in zip(np.split(idx, starts), [0] + starts.tolist()):
+            if len(group):
+                returned.append(self.run_rules(table, chain, buckets[int(top[start])], group,
+                                               table_verdict, table_ref, depth))
+        return np.concatenate(returned)
+
+    def run_rules(self, table, chain, rules, idx, table_verdict, table_ref, depth):
+        chains = self.chains[table]
+        pending = idx
+        returned = []
+        for rule in rules:
+            if not len(pending):
+                break
+            if rule['unsupported']:
+                continue
+            matched = self.mask(rule, pending)
+            hit = pending[matched]
+            if not len(hit):
+                continue
+            target = rule['target']
+            if target in ACCEPTING_TARGETS or target in FINAL_TARGETS:
+                table_verdict[hit] = VERDICTS.index(verdict_of(target))
+                table_ref[hit] = self.ref(table, chain, rule['num'])
+                if rule['dnat'] and rule['dnat'][0] and rule['dnat'][0][0] == 4:
+                    self.dst[hit] = rule['dnat'][0][1]
+                    if rule['dnat'][1] is not None:
+                        self.dport[hit] = rule['dnat'][1]
+                pending = pending[~matched]
+            elif target == 'RETURN':
+                returned.append(hit)
+                pending = pending[~matched]
+            elif target in chains:
+                back = self.run_chain(table, target, hit, table_verdict, table_ref, depth + 1)
+                if rule['goto']:
+                    returned.append(back)
+                    pending = pending[~matched]
+                else:
+                    pending = np.concatenate([pending[~matched], back])
+        returned.append(pending)
+        return np.concatenate(returned)
+
+    def run(self):
+        n = len(self.hooks)
+        table_verdict = np.zeros(n, dtype=np.int8)
+        table_ref = np.full(n, -1, dtype=np.int32)
+        for hook_name, path in HOOK_PATHS.items():
+            alive = np.array([i for i, hook in enumerate(self.hooks) if hook == hook_name], dtype=np.int64)
+            for hook, tables in path:
+                for table in tables:
+                    if not len(alive) or hook not in self.chains.get(table, {}):
+                        continue
+                    idx = alive
+                    if table == 'nat':
+                        idx = alive[self.state[alive] == CONNTRACK_STATES.index('NEW')]
+                    returned = self.run_chain(table, hook, idx, table_verdict, table_ref, 0)
+                    policy = self.chains[table][hook]['policy'] or 'ACCEPT'
+                    table_verdict[returned] = VERDICTS.index(verdict_of(policy))
+                    table_ref[returned] = self.ref(table, hook, None)
+                    final = idx[table_verdict[idx] != 0]
+                    self.verdict[final] = table_verdict[final]
+                    if table == 'filter':
+                        self.decided[idx] = table_ref[idx]
+                    else:
+                        self.decided[final] = table_ref[final]
+                        undecided = idx[self.decided[idx] == -1]
+                        self.decided[undecided] = table_ref[undecided]
+                    alive = np.setdiff1d(alive, final, assume_unique=True)
+        results = []
+        for verdict, decided in zip(self.verdict.tolist(), self.decided.tolist()):
+            table, chain, num = self.refs[decided] if decided >= 0 else (None, None, None)
+            results.append({'verdict': VERDICTS[verdict], 'table': table, 'chain': chain, 'num': num})
+        return results
+
+def read_packets_csv(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+@app.route('/api/simulate', methods=['POST'])
+@require_sudo
+def simulate():
+    # JSON {"packet": {...}} for a full trace, {"packets": [...]} or an
+    # uploaded CSV (packets_file) for a batch
+    try:
+        if 'packets_file' in request.files:
+            raw_packets = read_packets_csv(request.files['packets_file'].read().decode())
+        else:
+            data = request.get_json(force=True)
+            if 'packet' in data:
+                packet = parse_packet(data['packet'])
+                simulator = ruleset_cache.derived('simulator', PacketSimulator)
+                return jsonify(simulator.trace(packet))
+            raw_packets = data['packets']
+        packets = []
+        errors = []
+        for line, raw in enumerate(raw_packets, 1):
+            try:
+                packets.append(parse_packet(raw))
+            except (KeyError, ValueError) as e:
+                errors.append({'line': line, 'error': str(e)})
+        limit = int(request.args.get('limit', 1000))
+    except Exception as e:
+        return jsonify({'error': f"Invalid packets: {e}"}), 400
+    simulator = ruleset_cache.derived('simulator', PacketSimulator)
+    started = time.perf_counter()
+    results = simulator.run_batch(packets)
+    elapsed = time.perf_counter() - started
+    summary = {}
+    rules = {}
+    for result in results:
+        summary[result['verdict']] = summary.get(result['verdict'], 0) + 1
+        key = f"{result['table']}/{result['chain']}/{result['num'] or 'policy'}"
+        rules[key] = rules.get(key, 0) + 1
+    return jsonify({'count': len(results), 'elapsed_ms': elapsed * 1000, 'vectorized': np is not None,
+                    'summary': summary, 'decided_by': rules, 'errors': errors, 'results': results[:limit]})
+
+# Matches whose result depends on more than the packet, a rule using one
+# can never be relied on to cover another
+STATEFUL_MATCHES = {'limit', 'hashlimit', 'statistic', 'recent', 'connlimit', 'quota', 'time'}
+MULTIPORT_MAX = 15
+
+def rule_shape(position, compiled):
+    # Match space of a compiled rule as comparable fields. Negated checks and
+    # matches we don't model only compare by equality (the 'exact' set).
+    target = compiled['target']
+    shape = {'pos': position, 'num': compiled['num'], 'target': target, 'target_args': compiled['target_args'],
+             'goto': compiled['goto'],
+             'terminal': compiled['goto'] or target in ACCEPTING_TARGETS or target in FINAL_TARGETS or target == 'RETURN',
+             'src': None, 'dst': None, 'proto': None, 'sport': None, 'dport': None, 'ports': None,
+             'in': None, 'out': None, 'state': None,
+             'exact': set(compiled['opaque']),
+             'stateful': bool(STATEFUL_MATCHES.intersection(compiled['unsupported']))}
+    for field, value, negate in compiled['checks']:
+        if negate:
+            shape['exact'].add(('!', field, repr(value)))
+        elif field in ('src', 'dst'):
+            version, address, mask = value
+            shape[field] = (version, address, bin(mask).count('1'))
+        elif field == 'state':
+            shape[field] = frozenset(value)
+        elif field in ('sport', 'dport', 'ports'):
+            shape[field] = tuple(value)
+        else:
+            shape[field] = value
+    return shape
+
+def prefix_covers(a, b):
+    if a is None:
+        return True
+    if b is None or a[0] != b[0] or a[2] > b[2]:
+        return False
+    shift = (32 if a[0] == 4 else 128) - a[2]
+    return a[1] >> shift == b[1] >> shift
+
+def ranges_cover(a, b):
+    if a is None:
+        return True
+    return b is not None and all(any(al <= bl and bh <= ah for al, ah in a) for bl, bh in b)
+
+def ranges_overlap(a, b):
+    return a is None or b is None or any(al <= bh and bl <= ah for al, ah in a for bl, bh in b)
+
+def interface_covers(a, b):
+    if a is None:
+        return True
+    return b is not None and (a == b or (a.endswith('+') and b.startswith(a[:-1])))
+
+def interface_overlaps(a, b):
+    if a is None or b is None:
+        return True
+    return interface_covers(a, b) or interface_covers(b, a) or (
+        a.endswith('+') and b.endswith('+') and (a.startswith(b[:-1]) or b.startswith(a[:-1])))
+
+def shape_covers(a, b):
+    # Every packet b matches is also matched by a
+    return (not a['stateful']
+            and a['exact'] <= b['exact']
+            and prefix_covers(a['src'], b['src'])
+            and prefix_covers(a['dst'], b['dst'])
+            and (a['proto'] is None or a['proto'] == b['proto'])
+            and ranges_cover(a['sport'], b['sport'])
+            and ranges_cover(a['dport'], b['dport'])
+            and ranges_cover(a['ports'], b['ports'])
+            and interface_covers(a['in'], b['in'])
+            and interface_covers(a['out'], b['out'])
+            and (a['state'] is None or (b['state'] is not None and b['state'] <= a['state'])))
+
+def shapes_overlap(a, b):
+    # Some packet could match both. Errs on the side of True.
+    return ((prefix_covers(a['src'], b['src']) or prefix_covers(b['src'], a['src']))
+            and (prefix_covers(a['dst'], b['dst']) or prefix_covers(b['dst'], a['dst']))
+            and (a['proto'] is None or b['proto'] is None or a['proto'] == b['proto'])
+            and ranges_overlap(a['sport'], b['sport'])
+            and ranges_overlap(a['dport'], b['dport'])
+            and interface_overlaps(a['in'], b['in'])
+            and interface_overlaps(a['out'], b['out'])
+            and (a['state'] is None or b['state'] is None or bool(a['state'] & b['state'])))
+
+# Targets two overlapping rules can swap places with, a packet matching
+# both gets the same verdict either way
+INTERCHANGEABLE_TARGETS = {'ACCEPT', 'DROP', 'RETURN'}
+
+def same_action(a, b):
+    # Same target with the same arguments, SNAT to another address or REJECT
+    # with another reply is a different action
+    return a['target'] == b['target'] and a['target_args'] == b['target_args']
+
+def rule_blocks(earlier, shape):
+    # `shape` can't move above `earlier` when some packet could match both
+    return shapes_overlap(earlier, shape) and not (
+        same_action(earlier, shape) and shape['target'] in INTERCHANGEABLE_TARGETS
+        and not earlier['goto'] and not shape['goto'] and not earlier['stateful'])
+
+def port_key(ranges):
+    if ranges is None:
+        return None
+    if len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+        return ranges[0][0]
+    return 'ranges'
+
+class ShapeIndex:
+    # Rules of one chain keyed on source prefix, protocol and destination
+    # port, with one index for every subset of those fields so a lookup can
+    # leave the ones the query doesn't constrain open. Lookups return
+    # position-sorted lists whose entries already agree on the keyed fields;
+    # the caller checks them in order and stops at the first hit.
+    MASKS = list(itertools.product((False, True), repeat=3))
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.indexes = {mask: {} for mask in self.MASKS}
+        self.lengths = set()
+        self.starts = {4: [], 6: []}
+        for shape in shapes:
+            prefix = shape['src']
+            keys = (self.prefix_key(prefix, prefix[2]) if prefix else None, shape['proto'], port_key(shape['dport']))
+            for mask, index in self.indexes.items():
+                index.setdefault(tuple(itertools.compress(keys, mask)), []).append(shape['pos'])
+            if prefix:
+                self.lengths.add((prefix[0], prefix[2]))
+                self.starts[prefix[0]].append((prefix[1], prefix[2], shape['pos']))
+        for starts in self.starts.values():
+            starts.sort()
+
+    def prefix_key(self, prefix, length):
+        version, address, _ = prefix
+        return (version, length, address >> ((32 if version == 4 else 128) - length))
+
+    def containing_keys(self, prefix):
+        keys = [None]
+        if prefix is not None:
+            keys.extend(self.prefix_key(prefix, length) for version, length in self.lengths
+                        if version == prefix[0] and length <= prefix[2])
+        return keys
+
+    def port_keys(self, shape):
+        key = port_key(shape['dport'])
+        return [None, 'ranges'] + ([key] if key != 'ranges' else [])
+
+    def covering(self, shape):
+        protos = [None] if shape['proto'] is None else [None, shape['proto']]
+        ports = [None] if shape['dport'] is None else self.port_keys(shape)
+        index = self.indexes[(True, True, True)]
+        return [index[key] for key in itertools.product(self.containing_keys(shape['src']), protos, ports)
+                if key in index]
+
+    def overlapping(self, shape, later=True):
+        # A multiport or range query can meet rules keyed on any single port
+        # inside it, those are found with the port left open
+        mask = (shape['src'] is not None, shape['proto'] is not None,
+                shape['dport'] is not None and port_key(shape['dport']) != 'ranges')
+        options = []
+        if mask[0]:
+            options.append(self.containing_keys(shape['src']))
+        if mask[1]:
+            options.append([None, shape['proto']])
+        if mask[2]:
+            options.append(self.port_keys(shape))
+        index = self.indexes[mask]
+        lists = [index[key] for key in itertools.product(*options) if key in index]
+        if mask[0]:
+            # Longer prefixes inside the source overlap it too
+            version, address, length = shape['src']
+            bits = 32 if version == 4 else 128
+            starts = self.starts[version]
+            low = bisect.bisect_left(starts, (address, length + 1))
+            high = bisect.bisect_left(starts, ((address | ((1 << (bits - length)) - 1)) + 1,))
+            lists.append(sorted(position for _, _, position in starts[low:high]
+                                if position > shape['pos'] or not later))
+        return lists
+
+    def first_earlier_cover(self, shape):
+        # Earliest terminating rule above `shape` that matches all its packets
+        best = None
+        for found in self.covering(shape):
+            for position in found:
+                if position >= shape['pos'] or (best is not None and position >= best):
+                    break
+                other = self.shapes[position]
+                if other['terminal'] and shape_covers(other, shape):
+                    best = position
+                    break
+        return None if best is None else self.shapes[best]
+
+    def first_later_overlap(self, shape):
+        # First rule below `shape` that some of its packets could reach
+        best = None
+        for found in self.overlapping(shape):
+            start = bisect.bisect_right(found, shape['pos'])
+            for position in found[start:]:
+                if best is not None and position >= best:
+                    break
+                if shapes_overlap(self.shapes[position], shape):
+                    best = position
+                    break
+        return None if best is None else self.shapes[best]
+
+    def last_earlier_blocker(self, shape):
+        # Last rule above `shape` that it can't be moved past
+        best = None
+        for found in self.overlapping(shape, later=False):
+            end = bisect.bisect_left(found, shape['pos'])
+            for position in reversed(found[:end]):
+                if best is not None and position <= best:
+                    break
+                if rule_blocks(self.shapes[position], shape):
+                    best = position
+                    break
+        return None if best is None else self.shapes[best]
+
+def strip_options(tokens, options, modules):
+    # Rule tokens without the given options (and their value) and match modules
+    kept = []
+    removed = []
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == '!' and i + 1 < len(tokens) and tokens[i + 1] in options:
+            return None, None
+        if tok in options and i + 1 < len(tokens):
+            removed.append(tokens[i + 1])
+            i += 2
+        elif tok == '-m' and i + 1 < len(tokens) and tokens[i + 1] in modules:
+            i += 2
+        else:
+            kept.append(tok)
+            i += 1
+    return kept, removed
+
+def merge_candidates(rules, dead):
+    # Runs of adjacent rules that only differ in destination port or source
+    # address, with the replacement rules for each run
+    merges = []
+    dport_options = {'--dport', '--dports', '--destination-port', '--destination-ports'}
+    for kind in ('dport', 'source'):
+        run = []
+        run_key = None
+        for rule in rules + [None]:
+            key = value = None
+            if rule is not None and rule['num'] not in dead:
+                if kind == 'dport' and rule['protocol'] in ('tcp', 'udp'):
+                    key, values = strip_options(rule['tokens'], dport_options, {'tcp', 'udp', 'multiport'})
+                    # Other port options would end up inside -m multiport
+                    if key is not None and any(tok in PORT_FIELDS for tok in key):
+                        key = None
+                elif kind == 'source':
+                    key, values = strip_options(rule['tokens'], {'-s'}, set())
+                if key is not None and len(values) == 1:
+                    value = values[0]
+                else:
+                    key = None
+            if key is not None and key == run_key:
+                run.append((rule, value))
+                continue
+            if len(run) > 1:
+                merges.extend(merge_run(kind, run_key, run))
+            run = [(rule, value)] if key is not None else []
+            run_key = key
+    return merges
+
+def merge_run(kind, key, run):
+    if kind == 'dport':
+        # multiport takes 15 ports, a range counts as two
+        groups = [[]]
+        weight = 0
+        for rule, value in run:
+            for port in value.split(','):
+                cost = 2 if ':' in port else 1
+                if weight + cost > MULTIPORT_MAX:
+                    groups.append([])
+                    weight = 0
+                groups[-1].append(port)
+                weight += cost
+        target = key.index('-j') if '-j' in key else key.index('-g') if '-g' in key else len(key)
+        specs = [format_rule_spec(key[:target] + ['-m', 'multiport', '--dports', ','.join(group)] + key[target:])
+                 for group in groups]
+    else:
+        try:
+            networks = list(ipaddress.collapse_addresses(ipaddress.ip_network(value, strict=False)
+                                                         for rule, value in run))
+        except (TypeError, ValueError):
+            return []
+        specs = [format_rule_spec(['-s', str(network)] + key) for network in networks]
+    if len(specs) >= len(run):
+        return []
+    return [{'kind': kind, 'rules': [rule['num'] for rule, value in run], 'specs': specs}]
+
+def analyze_ruleset(ruleset):
+    started = time.perf_counter()
+    compiled = compile_ruleset(ruleset)
+    chains = []
+    total = 0
+    for table in ordered_tables(ruleset):
+        for name, chain in ruleset[table].items():
+            rules = chain['rules']
+            total += len(rules)
+            shapes = [rule_shape(i, rule) for i, rule in enumerate(compiled[table][name]['rules'])]
+            index = ShapeIndex(shapes)
+            shadowed = []
+            redundant = []
+            duplicates = []
+            dead = set()
+            first_spec = {}
+            for shape, rule in zip(shapes, rules):
+                if rule['spec'] in first_spec:
+                    duplicates.append({'num': rule['num'], 'of': first_spec[rule['spec']]})
+                else:
+                    first_spec[rule['spec']] = rule['num']
+                cover = index.first_earlier_cover(shape)
+                if cover is not None:
+                    shadowed.append({'num': shape['num'], 'target': shape['target'],
+                                     'by': cover['num'], 'by_target': cover['target'],
+                                     'conflict': not same_action(cover, shape)})
+                    dead.add(shape['num'])
+            for shape in shapes:
+                if shape['num'] in dead or not shape['terminal'] or shape['goto'] or shape['stateful']:
+                    continue
+                later = index.first_later_overlap(shape)
+                if later is None:
+                    # Nothing below can see these packets, they get the policy
+                    if (chain['policy'] is not None and shape['target'] == chain['policy']
+                            and not shape['target_args']):
+                        redundant.append({'num': shape['num'], 'target': shape['target'], 'by': 'policy'})
+                        dead.add(shape['num'])
+                elif (later['num'] not in dead and later['terminal'] and not later['goto']
+                        and same_action(later, shape) and shape_covers(later, shape)):
+                    redundant.append({'num': shape['num'], 'target': shape['target'], 'by': later['num']})
+                    dead.add(shape['num'])
+            mergeable = merge_candidates(rules, dead)
+            if shadowed or redundant or duplicates or mergeable:
+                duplicated = {rules[item['of'] - 1]['spec'] for item in duplicates}
+                involved = dead.union(*(merge['rules'] for merge in mergeable))
+                chains.append({'table': table, 'chain': name, 'rules': len(rules),
+                               'shadowed': shadowed, 'redundant': redundant,
+                               'duplicates': duplicates, 'mergeable': mergeable,
+                               'specs': {num: {'spec': rules[num - 1]['spec'],
+                                               'unique': rules[num - 1]['spec'] not in duplicated}
+                                         for num in sorted(involved)}})
+    return {'rules': total, 'elapsed_ms': (time.perf_counter() - started) * 1000, 'chains': chains}
+
+def cleanup_changes(analysis, kinds):
+    # Deletes and merges, bottom of each chain first so the positions above
+    # stay valid while the payload runs. Rules are deleted by spec unless the
+    # chain holds the same spec more than once.
+    changes = []
+    for chain in analysis['chains']:
+        table, name = chain['table'], chain['chain']
+        actions = []
+        for kind in ('shadowed', 'redundant'):
+            if kind in kinds:
+                actions.extend((item['num'], [item['num']], []) for item in chain[kind])
+        if 'mergeable' in kinds:
+            deleted = {num for num, _, _ in actions}
+            for merge in chain['mergeable']:
+                if not deleted.intersection(merge['rules']):
+                    actions.append((merge['rules'][0], merge['rules'], merge['specs']))
+                    deleted.update(merge['rules'])
+        for first, nums, specs in sorted(actions, reverse=True):
+            for num in sorted(nums, reverse=True):
+                rule = chain['specs'][num]
+                changes.append({'op': 'delete', 'table': table, 'chain': name, 'spec': rule['spec'],
+                                'position': None if rule['unique'] else num})
+            for offset, spec in enumerate(specs):
+                changes.append({'op': 'insert', 'table': table, 'chain': name,
+                                'position': first + offset, 'spec': spec})
+    return changes
+
+@app.route('/api/analysis')
+@require_sudo
+@conditional_on_ruleset
+def api_analysis():
+    return jsonify(ruleset_cache.derived('analysis', analyze_ruleset))
+
+@app.route('/analysis/cleanup', methods=['POST'])
+@require_sudo
+def stage_cleanup():
+    try:
+        kinds = request.form.getlist('kind') or ['shadowed', 'redundant']
+        changes = cleanup_changes(ruleset_cache.derived('analysis', analyze_ruleset), kinds)
+        touched = {(change['table'], change['chain']) for change in changes}
+        if any((change['table'], change['chain']) in touched for change in pending_changes.list()):
+            raise ValueError("Commit or discard the pending changes for these chains first")
+        for change in changes:
+            pending_changes.add(change)
         return redirect('/')
     except Exception as e:
-        return f'<div class="status error">Error adding rule: {str(e)}</div>'
+        return f'<div class="status error">Error staging cleanup: {escape(str(e))}</div>'
+
+# Hot rules per chain the profiler tries to move up, and the share of the
+# chain's evaluations a move has to save to be proposed
+PROFILE_CANDIDATES = 50
+PROFILE_MIN_SAVING = 0.01
+
+def chain_kept(chains, key, kept, depth=0):
+    # Share of the packets entering a custom chain that get their verdict in
+    # it, or below it, instead of returning to the caller
+    if key not in kept:
+        kept[key] = 0.0
+        chain = chains[key]
+        total = 0
+        if depth < MAX_JUMP_DEPTH:
+            for rule, shape in zip(chain['rules'], chain['shapes']):
+                callee = (key[0], rule['target'])
+                if callee in chains:
+                    total += rule['packets'] * chain_kept(chains, callee, kept, depth + 1)
+                elif shape['terminal'] and rule['target'] != 'RETURN':
+                    total += rule['packets']
+        kept[key] = min(total / chain['packets'], 1.0) if chain['packets'] else 0.0
+    return kept[key]
+
+def chain_cost(chains, key, costs, depth=0):
+    # Rule evaluations per packet entering a chain, the chains it jumps to
+    # included
+    if key not in costs:
+        costs[key] = 0.0
+        chain = chains[key]
+        total = chain['evaluations']
+        if depth < MAX_JUMP_DEPTH:
+            for rule in chain['rules']:
+                callee = (key[0], rule['target'])
+                if callee in chains and rule['packets']:
+                    total += rule['packets'] * chain_cost(chains, callee, costs, depth + 1)
+        costs[key] = total / chain['packets'] if chain['packets'] else 0.0
+    return costs[key]
+
+def reorder_proposals(chain):
+    # Hot terminating rules moved up past rules none of their packets could
+    # match. Moving rule j up to k saves its packets the rules in between and
+    # costs the packets those rules took one more evaluation.
+    rules, shapes, leaving = chain['rules'], chain['shapes'], chain['leaving']
+    candidates = sorted((shape for shape in shapes
+                         if shape['terminal'] and not shape['stateful'] and rules[shape['pos']]['packets']),
+                        key=lambda shape: rules[shape['pos']]['packets'], reverse=True)[:PROFILE_CANDIDATES]
+    if not candidates:
+        return []
+    index = ShapeIndex(shapes)
+    proposals = []
+    for shape in candidates:
+        j = shape['pos']
+        packets = rules[j]['packets']
+        blocker = index.last_earlier_blocker(shape)
+        gain = saving = 0
+        best = None
+        for k in range(j - 1, blocker['pos'] if blocker else -1, -1):
+            gain += packets - leaving[k]
+            if gain > saving:
+                saving, best = gain, k
+        if best is None or saving < PROFILE_MIN_SAVING * chain['evaluations']:
+            continue
+        # The index only narrows the search, never emit a move past a rule
+        # some of the moved rule's packets could match
+        if any(rule_blocks(shapes[k], shape) for k in range(best, j)):
+            continue
+        proposals.append({'table': chain['table'], 'chain': chain['chain'], 'num': j + 1, 'to': best + 1,
+                          'spec': rules[j]['spec'], 'target': shape['target'], 'packets': packets,
+                          'blocked_by': blocker['num'] if blocker else None,
+                          'saved': saving, 'saved_per_packet': saving / chain['packets']})
+    return sorted(proposals, key=lambda proposal: proposal['saved'], reverse=True)
+
+def profile_ruleset(ruleset):
+    # Traversal cost from the exact counters. Packets entering a custom chain
+    # are the ones its jumps matched, a built-in chain's are its policy
+    # counter plus everything its rules took out of it; a rule is evaluated
+    # by every packet entering the chain minus the ones earlier rules took.
+    started = time.perf_counter()
+    compiled = compile_ruleset(ruleset)
+    chains = {}
+    for table in ordered_tables(ruleset):
+        for name, chain in ruleset[table].items():
+            chains[table, name] = {'table': table, 'chain': name, 'rules': chain['rules'],
+                                   'policy': chain['policy'], 'packets': 0,
+                                   'shapes': [rule_shape(i, rule)
+                                              for i, rule in enumerate(compiled[table][name]['rules'])]}
+    for (table, name), chain in chains.items():
+        for rule in chain['rules']:
+            if (table, rule['target']) in chains:
+                chains[table, rule['target']]['packets'] += rule['packets']
+    kept = {}
+    for key, chain in chains.items():
+        if chain['policy'] is None:
+            chain_kept(chains, key, kept)
+    for (table, name), chain in chains.items():
+        # Packets leaving the chain at each rule: its matches for a verdict,
+        # RETURN or goto, the share a jump's chain keeps for a jump
+        leaving = []
+        for rule, shape in zip(chain['rules'], chain['shapes']):
+            callee = (table, rule['target'])
+            if callee in chains and not shape['goto']:
+                leaving.append(rule['packets'] * kept.get(callee, 0.0))
+            else:
+                leaving.append(rule['packets'] if shape['terminal'] else 0)
+        reaching = [0] * len(leaving)
+        if chain['policy'] is not None:
+            count = ruleset[table][name]['packets']
+            for i in range(len(leaving) - 1, -1, -1):
+                count = max(count + leaving[i], chain['rules'][i]['packets'])
+                reaching[i] = count
+            chain['packets'] = reaching[0] if reaching else ruleset[table][name]['packets']
+        else:
+            # Clamped, counters zeroed on a single rule would go negative
+            count = chain['packets']
+            for i, amount in enumerate(leaving):
+                count = max(count, chain['rules'][i]['packets'])
+                reaching[i] = count
+                count -= amount
+        chain['leaving'] = leaving
+        chain['evaluations'] = sum(reaching)
+    costs = {}
+    report = []
+    for key, chain in chains.items():
+        if not chain['packets']:
+            continue
+        proposals = reorder_proposals(chain)
+        report.append({'table': chain['table'], 'chain': chain['chain'], 'rules': len(chain['rules']),
+                       'packets': chain['packets'], 'evaluations': chain['evaluations'],
+                       'per_packet': chain['evaluations'] / chain['packets'],
+                       'with_jumps': chain_cost(chains, key, costs), 'proposals': proposals,
+                       'saved_per_packet': sum(proposal['saved'] for proposal in proposals) / chain['packets']})
+    hooks = {}
+    for hook, path in HOOK_PATHS.items():
+        steps = [(table, name) for name, tables in path for table in tables if (table, name) in chains]
+        hooks[hook] = {'chains': [f'{table}/{name}' for table, name in steps],
+                       'per_packet': sum(chain_cost(chains, step, costs) for step in steps)}
+    report.sort(key=lambda chain: chain['evaluations'], reverse=True)
+    return {'hooks': hooks, 'chains': report, 'elapsed_ms': (time.perf_counter() - started) * 1000}
+
+def reorder_changes(ruleset, moves):
+    # Deletes and inserts for the accepted moves, checked again against the
+    # live rules. Every moved rule is placed right above the rule it was
+    # proposed to pass, moves into the same spot keep their order.
+    changes = []
+    by_chain = {}
+    for move in moves:
+        by_chain.setdefault((move['table'], move['chain']), []).append(move)
+    for (table, name), chain_moves in by_chain.items():
+        rules = ruleset.get(table, {}).get(name, {}).get('rules')
+        if rules is None:
+            raise ValueError(f"No chain {name} in {table}")
+        shapes = [rule_shape(i, compile_rule(rule)) for i, rule in enumerate(rules)]
+        anchors = {}
+        for move in chain_moves:
+            num, to = int(move['num']), int(move['to'])
+            if not 1 <= to < num <= len(rules) or rules[num - 1]['spec'] != move['spec']:
+                raise ValueError(f"Rule {num} of {table}/{name} changed, profile again")
+            shape = shapes[num - 1]
+            blocker = next((other for other in shapes[to - 1:num - 1] if rule_blocks(other, shape)), None)
+            if not shape['terminal'] or shape['stateful'] or blocker is not None:
+                raise ValueError(f"Rule {num} of {table}/{name} can't move above rule {to}")
+            anchors[num - 1] = to - 1
+        order = sorted(range(len(rules)), key=lambda i: (anchors.get(i, i), i not in anchors, i))
+        chain_changes, summary = diff_chain(table, name, rules, [rules[i] for i in order])
+        changes.extend(chain_changes)
+    return changes
+
+@app.route('/api/profile')
+@require_sudo
+@conditional_on_ruleset
+def api_profile():
+    return jsonify(ruleset_caches[request_family()].derived('profile', profile_ruleset))
+
+@app.route('/profile/apply', methods=['POST'])
+@require_sudo
+@invalidates_ruleset
+def apply_reorders():
+    try:
+        family = request_family()
+        moves = [json.loads(move) for move in request.form.getlist('move')]
+        if not moves:
+            raise ValueError("No proposals selected")
+        ruleset_caches[family].invalidate()
+        changes = reorder_changes(get_ruleset(family), moves)
+        # One transaction, no packet sees a chain half reordered
+        apply_changes([{**change, 'family': family} for change in changes])
+        return redirect(index_url())
+    except Exception as e:
+        return f'<div class="status error">Error applying reorders: {escape(command_error(e))}</div>'
+
+COUNTER_INTERVAL = float(os.environ.get('IPTABLES_GUI_COUNTER_INTERVAL', '2'))
+COUNTER_HISTORY = int(os.environ.get('IPTABLES_GUI_COUNTER_HISTORY', '60'))
+# Open counter streams hold a server worker each, past this many a new one
+# gets a 503 so the other requests still find a free worker
+WORKERS = int(os.environ.get('IPTABLES_GUI_WORKERS', '16'))
+COUNTER_STREAMS = int(os.environ.get('IPTABLES_GUI_COUNTER_STREAMS', str(max(WORKERS // 2, 1))))
+
+class CounterPoller:
+    # Polls exact counters while at least one client is streaming them and
+    # keeps a fixed-size history of packet rates per rule. Every client
+    # shares the same poller thread.
+    def __init__(self, loader, interval, history):
+        self.loader = loader
+        self.interval = interval
+        self.history_size = history
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.thread = None
+        self.previous = {}
+        self.history = {}
+        self.rates = {}
+        self.chains = {}
+        self.polled_at = None
+
+    def subscribe(self):
+        updates = queue.Queue(maxsize=1)
+        with self.lock:
+            self.subscribers.append(updates)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return updates
+
+    def unsubscribe(self, updates):
+        with self.lock:
+            if updates in self.subscribers:
+                self.subscribers.remove(updates)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+            try:
+                self.update(self.loader(), time.monotonic())
+            except Exception as e:
+                print(f"Error polling counters: {e}")
+            time.sleep(self.interval)
+
+    def update(self, ruleset, now):
+        previous = self.previous
+        current = {}
+        rates = {}
+        chains = {}
+        for table, table_chains in ruleset.items():
+            for chain in table_chains.values():
+                seen = {}
+                numbers = []
+                for rule in chain['rules']:
+                    # Identify rules by spec, not position, so an insert
+                    # higher up doesn't mix up the deltas
+                    occurrence = seen.get(rule['spec'], 0)
+                    seen[rule['spec']] = occurrence + 1
+                    key = (table, chain['name'], rule['spec'], occurrence)
+                    current[key] = (rule['packets'], rule['bytes'], now)
+                    numbers.append((rule['num'], key))
+                    last = previous.get(key)
+                    if last is None or rule['packets'] < last[0] or now <= last[2]:
+                        continue
+                    elapsed = now - last[2]
+                    rates[key] = ((rule['packets'] - last[0]) / elapsed, (rule['bytes'] - last[1]) / elapsed)
+                chains[(table, chain['name'])] = numbers
+        with self.lock:
+            for key, (pps, bps) in rates.items():
+                history = self.history.get(key)
+                if history is None:
+                    history = self.history[key] = deque(maxlen=self.history_size)
+                history.append(pps)
+            for key in list(self.history):
+                if key not in current:
+                    del self.history[key]
+            self.previous = current
+            self.rates = rates
+            self.chains = chains
+            self.polled_at = time.time()
+            subscribers = list(self.subscribers)
+        for updates in subscribers:
+            try:
+                updates.put_nowait(True)
+            except queue.Full:
+                pass
+
+    def chain_rates(self, table, chain):
+        with self.lock:
+            rules = []
+            for num, key in self.chains.get((table, chain), []):
+                if key in self.rates:
+                    pps, bps = self.rates[key]
+                    rules.append({'num': num, 'pps': pps, 'bps': bps, 'history': list(self.history.get(key, ()))})
+            return {'table': table, 'chain': chain, 'time': self.polled_at, 'rules': rules}
+
+counter_pollers = {family: CounterPoller(partial(load_ruleset, family), COUNTER_INTERVAL, COUNTER_HISTORY)
+                   for family in FAMILIES}
+counter_streams = threading.BoundedSemaphore(COUNTER_STREAMS)
+
+@app.route('/api/counters/stream')
+@require_sudo
+def stream_counters():
+    table = request.args.get('table', 'filter')
+    chain = request.args.get('chain', 'INPUT')
+    counter_poller = counter_pollers[request_family()]
+    if not counter_streams.acquire(blocking=False):
+        return jsonify({'error': f"Already {COUNTER_STREAMS} counter streams open"}), 503, {'Retry-After': '30'}
+    updates = counter_poller.subscribe()
+
+    def generate():
+        try:
+            yield f"retry: {int(COUNTER_INTERVAL * 1000)}\n\n"
+            while True:
+                try:
+                    updates.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f"data: {json.dumps(counter_poller.chain_rates(table, chain))}\n\n"
+        finally:
+            counter_poller.unsubscribe(updates)
+    response = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # Also when the client is gone before the generator ever ran
+    response.call_on_close(counter_streams.release)
+    return response
+
+@app.route('/get_rules/<table>/<chain>')
+@require_sudo
+@conditional_on_ruleset
+def get_rules(table, chain):
+    family = request_family()
+    ruleset = get_ruleset(family)
+    started = time.perf_counter()
+    html = get_rules_table(ruleset, table, chain, family)
+    elapsed = time.perf_counter() - started
+    RENDER_SECONDS.observe(elapsed, 'rules_table')
+    record_timing('render', elapsed)
+    return jsonify({'html': html})
+
+def build_rule_spec(form):
+    spec = []
+
+    # Add protocol if specified
+    if form.get('protocol'):
+        spec.extend(['-p', form['protocol']])
+
+    # Add source IP if specified
+    if form.get('source_ip'):
+        spec.extend(['-s', form['source_ip']])
+
+    # Add destination IP if specified
+    if form.get('dest_ip'):
+        spec.extend(['-d', form['dest_ip']])
+
+    # Add ports if specified
+    if form.get('source_port'):
+        spec.extend(['--sport', form['source_port']])
+    if form.get('dest_port'):
+        spec.extend(['--dport', form['dest_port']])
+
+    # Add interfaces if specified
+    if form.get('in_interface'):
+        spec.extend(['-i', form['in_interface']])
+    if form.get('out_interface'):
+        spec.extend(['-o', form['out_interface']])
+
+    # Add NAT-specific options
+    if form['action'] == 'SNAT' and form.get('to_source'):
+        spec.extend(['-j', 'SNAT', '--to-source', form['to_source']])
+    elif form['action'] == 'DNAT' and form.get('to_destination'):
+        spec.extend(['-j', 'DNAT', '--to-destination', form['to_destination']])
+    elif form['action'] == 'LOG' and form.get('log_prefix'):
+        # The prefix is how logged packets are traced back to this rule
+        spec.extend(['-j', 'LOG', '--log-prefix', form['log_prefix']])
+    else:
+        spec.extend(['-j', form['action']])
+    return spec
+
+# A newline (or any control character but the tab) would start a line of
+# its own in the restore payload
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x08\x0a-\x1f\x7f]')
+# What iptables takes as a chain name: 28 characters at most, no blanks or
+# quotes, not starting like an option
+CHAIN_NAME = re.compile(r'[^\s"\'!-][^\s"\']{0,27}')
+RESTORE_TABLES = TABLES + ['security']
+
+def quote_restore_arg(arg):
+    # iptables-restore only understands double quotes
+    if CONTROL_CHARACTERS.search(arg):
+        raise ValueError(f"Control character in {arg!r}")
+    if arg and not any(c in arg for c in ' \t"\''):
+        return arg
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def format_rule_spec(spec):
+    return ' '.join(quote_restore_arg(arg) for arg in spec)
+
+def validate_change(change):
+    # Everything of a change that ends up on a restore line as it is
+    if change['table'] not in RESTORE_TABLES:
+        raise ValueError(f"Unknown table {change['table']!r}")
+    if not CHAIN_NAME.fullmatch(change['chain']):
+        raise ValueError(f"Invalid chain name {change['chain']!r}")
+    if 'spec' in change and CONTROL_CHARACTERS.search(change['spec']):
+        raise ValueError(f"Control character in {change['spec']!r}")
+    if change.get('position') is not None and not isinstance(change['position'], int):
+        raise ValueError(f"Invalid position {change['position']!r}")
+    if change['op'] == 'policy' and change['policy'] not in ('ACCEPT', 'DROP'):
+        raise ValueError(f"Invalid policy {change['policy']!r}")
+
+def format_restore_commands(change):
+    validate_change(change)
+    op = change['op']
+    chain = change['chain']
+    if op == 'append':
+        return [f"-A {chain} {change['spec']}"]
+    if op == 'insert':
+        return [f"-I {chain} {change['position']} {change['spec']}"]
+    if op == 'delete':
+        if change.get('position'):
+            return [f"-D {chain} {change['position']}"]
+        return [f"-D {chain} {change['spec']}"]
+    if op == 'policy':
+        return [f"-P {chain} {change['policy']}"]
+    if op == 'new_chain':
+        return [f"-N {chain}"]
+    if op == 'delete_chain':
+        return [f"-F {chain}", f"-X {chain}"]
+    raise ValueError(f"Unknown change {op}")
+
+def build_restore_script(changes):
+    # One *table ... COMMIT block per table, changes keep their order inside
+    # it. Also returns the index of the change behind every payload line.
+    commands = {}
+    for index, change in enumerate(changes):
+        commands.setdefault(change['table'], []).extend((index, command)
+                                                        for command in format_restore_commands(change))
+    lines = []
+    sources = [None]
+    for table, table_commands in commands.items():
+        lines.append(f'*{table}')
+        sources.append(None)
+        for index, command in table_commands:
+            lines.append(command)
+            sources.append(index)
+        lines.append('COMMIT')
+        sources.append(None)
+    return '\n'.join(lines) + '\n', sources
+
+def build_restore_payload(changes):
+    return build_restore_script(changes)[0]
+
+def restore_error_line(message):
+    # "iptables-restore: line 12 failed" and friends
+    match = re.search(r'line:? (\d+)', message)
+    return int(match.group(1)) if match else None
+
+class ChangeError(RuntimeError):
+    # A change set the backend refused, index is the change it failed on
+    # when that is known
+    def __init__(self, message, index=None):
+        super().__init__(message)
+        self.index = index
+
+class LegacyBackend:
+    # iptables-save for reads, iptables-restore --noflush for writes, or
+    # their ip6tables counterparts
+    def __init__(self, family):
+        self.family = family
+        self.commands = FAMILIES[family]
+        self.name = self.commands['iptables']
+
+    def load(self):
+        output = run_command([self.commands['save'], '-c']).decode()
+        started = time.perf_counter()
+        ruleset = parse_iptables_save(output, self.family)
+        elapsed = time.perf_counter() - started
+        PARSE_SECONDS.observe(elapsed)
+        record_timing('parse', elapsed)
+        return ruleset
+
+    def script(self, changes):
+        return build_restore_payload(changes) if changes else ''
+
+    def apply(self, changes, test_only=False):
+        if len(changes) == 1 and not test_only:
+            # One change is one plain iptables call, a chain delete two
+            change = changes[0]
+            try:
+                for command in format_restore_commands(change):
+                    run_command([self.commands['iptables'], '-t', change['table']] + shlex.split(command))
+            except subprocess.CalledProcessError as e:
+                raise ChangeError(command_error(e), 0)
+            return
+        payload, sources = build_restore_script(changes)
+        # --test first so a bad line anywhere leaves every table untouched
+        commands = [[self.commands['restore'], '--noflush', '--test']]
+        if not test_only:
+            commands.append([self.commands['restore'], '--noflush'])
+        for cmd in commands:
+            try:
+                run_command(cmd, input=payload.encode())
+            except subprocess.CalledProcessError as e:
+                message = command_error(e)
+                line = restore_error_line(message)
+                raise ChangeError(message, sources[line] if line is not None and line < len(sources) else None)
+
+# Tables iptables-nft keeps in the nftables "ip" and "ip6" families
+NFT_TABLES = TABLES + ['security']
+NFT_VERDICTS = {'accept': 'ACCEPT', 'drop': 'DROP', 'return': 'RETURN', 'queue': 'QUEUE'}
+NFT_STATE_ORDER = ['INVALID', 'NEW', 'RELATED', 'ESTABLISHED', 'UNTRACKED']
+NFT_LIMIT_UNITS = {'second': 'sec', 'minute': 'min', 'hour': 'hour', 'day': 'day'}
+LOG_LEVELS = ['emerg', 'alert', 'crit', 'err', 'warn', 'notice', 'info', 'debug']
+NFT_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+# nftables icmpv6 reject types and the ip6tables --reject-with names
+NFT_ICMPV6_REJECTS = {'port-unreachable': 'icmp6-port-unreachable', 'admin-prohibited': 'icmp6-adm-prohibited',
+                      'addr-unreachable': 'icmp6-addr-unreachable', 'no-route': 'icmp6-no-route'}
+
+def nft_address(value):
+    # "10.0.0.1" or {"prefix": {"addr": "10.0.0.0", "len": 8}}
+    if isinstance(value, str) and not value.startswith('@'):
+        return value if '/' in value else value + ('/128' if ':' in value else '/32')
+    if isinstance(value, dict) and 'prefix' in value:
+        return f"{value['prefix']['addr']}/{value['prefix']['len']}"
+    raise ValueError(f"No iptables equivalent for address {value!r}")
+
+def nft_ports(value):
+    # 22, {"range": [1024, 2048]} or {"set": [...]} as iptables port strings
+    if isinstance(value, int):
+        return [str(value)]
+    if isinstance(value, dict) and 'range' in value:
+        return ['%d:%d' % tuple(value['range'])]
+    if isinstance(value, dict) and 'set' in value:
+        return [port for item in value['set'] for port in nft_ports(item)]
+    raise ValueError(f"No iptables equivalent for ports {value!r}")
+
+def nft_nat_address(body):
+    if not isinstance(body.get('addr'), str) or isinstance(body.get('port'), dict):
+        raise ValueError("Only single NAT addresses and ports have an iptables equivalent")
+    return body['addr'] + (f":{body['port']}" if body.get('port') else '')
+
+def nft_rule_spec(exprs, comment=None, family='ip'):
+    # The iptables-save spec of a rule made of native nftables expressions,
+    # in the order iptables-save prints options. ValueError for xt matches
+    # and anything else iptables can't express. family is the nftables one,
+    # ip or ip6.
+    head = {}
+    matches = []
+    target = []
+    packets = nbytes = 0
+    for expr in exprs:
+        (kind, body), = expr.items()
+        if target and kind != 'counter':
+            raise ValueError(f"{kind} after the verdict")
+        if kind == 'match':
+            left, right, op = body['left'], body['right'], body['op']
+            if op not in ('==', '!=', 'in'):
+                raise ValueError(f"No iptables equivalent for {op}")
+            negate = ['!'] if op == '!=' else []
+            if 'payload' in left:
+                protocol, field = left['payload'].get('protocol'), left['payload'].get('field')
+                if protocol == family and field in ('saddr', 'daddr'):
+                    head['-s' if field == 'saddr' else '-d'] = negate + [nft_address(right)]
+                elif (protocol, field) in (('ip', 'protocol'), ('ip6', 'nexthdr')) and isinstance(right, str):
+                    head['-p'] = negate + [right]
+                elif protocol in PORT_PROTOCOLS and field in ('sport', 'dport'):
+                    ports = nft_ports(right)
+                    if len(ports) > 1:
+                        matches.append(['-m', 'multiport'] + negate + [f'--{field}s', ','.join(ports)])
+                    else:
+                        matches.append(['-m', protocol] + negate + [f'--{field}', ports[0]])
+                else:
+                    raise ValueError(f"No iptables equivalent for {protocol} {field}")
+            elif 'meta' in left and left['meta']['key'] == 'l4proto' and isinstance(right, str):
+                head['-p'] = negate + [right]
+            elif 'meta' in left and left['meta']['key'] in ('iifname', 'oifname') and isinstance(right, str):
+                name = right[:-1] + '+' if right.endswith('*') else right
+                head['-i' if left['meta']['key'] == 'iifname' else '-o'] = negate + [name]
+            elif 'ct' in left and left['ct']['key'] == 'state':
+                states = right.get('set') if isinstance(right, dict) else right
+                states = {state.upper() for state in ([states] if isinstance(states, str) else states)}
+                matches.append(['-m', 'conntrack'] + negate +
+                               ['--ctstate', ','.join(state for state in NFT_STATE_ORDER if state in states)])
+            else:
+                raise ValueError(f"No iptables equivalent for {json.dumps(left)}")
+        elif kind == 'counter' and isinstance(body, dict):
+            packets, nbytes = body['packets'], body['bytes']
+        elif kind == 'limit' and body.get('per') in NFT_LIMIT_UNITS and body.get('rate_unit', 'packets') == 'packets' \
+                and not body.get('inv'):
+            matches.append(['-m', 'limit', '--limit', f"{body['rate']}/{NFT_LIMIT_UNITS[body['per']]}",
+                            '--limit-burst', str(body.get('burst', 5))])
+        elif kind in NFT_VERDICTS:
+            target = ['-j', NFT_VERDICTS[kind]]
+        elif kind in ('jump', 'goto'):
+            target = ['-j' if kind == 'jump' else '-g', body['target']]
+        elif kind == 'reject':
+            body = body or {}
+            if body.get('type') == 'tcp reset':
+                reason = 'tcp-reset'
+            elif body.get('type', 'icmp') == 'icmp' and family == 'ip':
+                reason = 'icmp-' + body.get('expr', 'port-unreachable')
+            elif body.get('type', 'icmpv6') == 'icmpv6' and family == 'ip6' and \
+                    body.get('expr', 'port-unreachable') in NFT_ICMPV6_REJECTS:
+                reason = NFT_ICMPV6_REJECTS[body.get('expr', 'port-unreachable')]
+            else:
+                raise ValueError(f"No iptables equivalent for reject {body.get('type')}")
+            target = ['-j', 'REJECT', '--reject-with', reason]
+        elif kind == 'log':
+            target = ['-j', 'LOG']
+            if body.get('prefix'):
+                target += ['--log-prefix', body['prefix']]
+            if body.get('level', 'warn') != 'warn':
+                target += ['--log-level', str(LOG_LEVELS.index(body['level']))]
+        elif kind in ('snat', 'dnat'):
+            target = ['-j', kind.upper(), '--to-source' if kind == 'snat' else '--to-destination',
+                      nft_nat_address(body)]
+        elif kind == 'masquerade' and not body:
+            target = ['-j', 'MASQUERADE']
+        else:
+            raise ValueError(f"No iptables equivalent for {kind}")
+    if comment is not None:
+        matches.append(['-m', 'comment', '--comment', comment])
+    tokens = []
+    for option in ('-s', '-d', '-i', '-o', '-p'):
+        if option in head:
+            tokens += head[option][:-1] + [option, head[option][-1]]
+    for match in matches:
+        tokens += match
+    return format_rule_spec(tokens + target), packets, nbytes
+
+def nft_string(value):
+    if '"' in value or '\n' in value:
+        raise ValueError(f"Can't quote {value!r} for nft")
+    return f'"{value}"'
+
+def nft_name(name):
+    return name if NFT_NAME.match(name) else nft_string(name)
+
+def nft_statement(spec, chains, family='ip'):
+    # The nftables rule iptables-nft would create for an iptables spec, with
+    # the counter it always adds. ValueError for matches and targets without
+    # a native translation; chains are the jump targets there are.
+    tokens = shlex.split(spec)
+    parts = []
+    tail = []
+    protocol = None
+    limit = None
+    target = None
+    options = {}
+    negate = False
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == '!':
+            negate = True
+            i += 1
+            continue
+        if i + 1 >= len(tokens):
+            raise ValueError(f"No nftables translation for {tok}")
+        value = tokens[i + 1]
+        op = '!= ' if negate else ''
+        if negate and (',' in value or tok in ('-m', '-j', '-g', '--comment', '--limit', '--limit-burst')):
+            raise ValueError(f"No nftables translation for ! {tok} {value}")
+        negate = False
+        if tok in ('-p', '--protocol'):
+            protocol = value
+            parts.append(f"meta l4proto {op}{value}")
+        elif tok in ('-s', '--source', '-d', '--destination'):
+            parts.append(f"{family} {'saddr' if tok in ('-s', '--source') else 'daddr'} {op}{value}")
+        elif tok in ('-i', '--in-interface', '-o', '--out-interface'):
+            name = value[:-1] + '*' if value.endswith('+') else value
+            parts.append(f"{'iifname' if tok in ('-i', '--in-interface') else 'oifname'} {op}{nft_string(name)}")
+        elif tok == '-m':
+            if value not in SIMULATED_MATCHES | {'limit'}:
+                raise ValueError(f"No nftables translation for -m {value}")
+        elif tok in PORT_FIELDS:
+            if protocol not in PORT_PROTOCOLS:
+                raise ValueError(f"{tok} needs -p tcp or udp")
+            ports = [port.replace(':', '-') for port in value.split(',')]
+            parts.append(f"{protocol} {PORT_FIELDS[tok]} {op}" +
+                         (ports[0] if len(ports) == 1 else '{ ' + ', '.join(ports) + ' }'))
+        elif tok in ('--ctstate', '--state'):
+            parts.append(f"ct state {op}{{ {', '.join(state.lower() for state in value.split(','))} }}")
+        elif tok == '--comment':
+            tail.append(f"comment {nft_string(value)}")
+        elif tok == '--limit':
+            rate, _, unit = value.partition('/')
+            units = {'s': 'second', 'sec': 'second', 'second': 'second', 'm': 'minute', 'min': 'minute',
+                     'minute': 'minute', 'h': 'hour', 'hour': 'hour', 'd': 'day', 'day': 'day'}
+            limit = f"limit rate {int(rate)}/{units[unit or 'hour']}"
+        elif tok == '--limit-burst':
+            options['burst'] = int(value)
+        elif tok in ('-j', '--jump', '-g', '--goto'):
+            target = (value, tok in ('-g', '--goto'))
+        elif tok in ('--to-source', '--to-destination', '--reject-with', '--log-prefix', '--log-level'):
+            options[tok] = value
+        else:
+            raise ValueError(f"No nftables translation for {tok}")
+        i += 2
+    if limit:
+        parts.append(limit + (f" burst {options['burst']} packets" if 'burst' in options else ''))
+    parts.append('counter')
+    if target is None:
+        pass
+    elif target[0] in ('ACCEPT', 'DROP', 'RETURN', 'QUEUE'):
+        parts.append(target[0].lower())
+    elif target[0] == 'REJECT':
+        reason = options.get('--reject-with', 'icmp-port-unreachable')
+        if reason == 'tcp-reset':
+            parts.append('reject with tcp reset')
+        elif family == 'ip' and reason.startswith('icmp-') and not reason.startswith('icmp-admin'):
+            parts.append(f"reject with icmp type {reason[5:]}")
+        elif family == 'ip6' and reason in NFT_ICMPV6_REJECTS.values():
+            parts.append(f"reject with icmpv6 type "
+                         f"{next(name for name, value in NFT_ICMPV6_REJECTS.items() if value == reason)}")
+        else:
+            raise ValueError(f"No nftables translation for --reject-with {reason}")
+    elif target[0] == 'LOG':
+        log = 'log'
+        if '--log-prefix' in options:
+            log += f" prefix {nft_string(options['--log-prefix'])}"
+        if '--log-level' in options:
+            level = options['--log-level']
+            log += f" level {LOG_LEVELS[int(level)] if level.isdigit() else level}"
+        parts.append(log)
+    elif target[0] in ('SNAT', 'DNAT'):
+        address = options.get('--to-source' if target[0] == 'SNAT' else '--to-destination')
+        if not address:
+            raise ValueError(f"{target[0]} needs an address")
+        parts.append(f"{target[0].lower()} to {address}")
+    elif target[0] == 'MASQUERADE':
+        parts.append('masquerade')
+    elif target[0] in chains:
+        parts.append(f"{'goto' if target[1] else 'jump'} {nft_name(target[0])}")
+    else:
+        raise ValueError(f"No nftables translation for -j {target[0]}")
+    return ' '.join(parts + tail)
+
+class NftablesBackend:
+    # One `nft -j list ruleset` for reads and one `nft -f` transaction for
+    # writes, on the tables of one family. Rulesets holding rules iptables
+    # can't express (xt matches included) are read and written through the
+    # legacy backend instead.
+    name = 'nftables'
+
+    def __init__(self, family, legacy):
+        self.family = family
+        self.nft_family = FAMILIES[family]['nft']
+        self.legacy = legacy
+
+    def dump(self):
+        output = run_command(['nft', '-j', 'list', 'ruleset'])
+        started = time.perf_counter()
+        ruleset = {}
+        for item in json.loads(output)['nftables']:
+            (kind, body), = item.items()
+            if kind not in ('chain', 'rule') or body['family'] != self.nft_family or body['table'] not in NFT_TABLES:
+                continue
+            chains = ruleset.setdefault(body['table'], {})
+            if kind == 'chain':
+                chains[body['name']] = {'name': body['name'],
+                                        'policy': body['policy'].upper() if 'hook' in body else None,
+                                        'packets': 0, 'bytes': 0, 'rules': [],
+                                        'hook': (body['type'], body['hook'], body['prio']) if 'hook' in body else None}
+                continue
+            chain = chains[body['chain']]
+            spec, packets, nbytes = nft_rule_spec(body['expr'], body.get('comment'), self.nft_family)
+            rule = parse_rule_spec(spec, self.family)
+            rule['num'] = len(chain['rules']) + 1
+            rule['packets'] = packets
+            rule['bytes'] = nbytes
+            rule['handle'] = body['handle']
+            chain['rules'].append(rule)
+        # Same table order as iptables-save
+        ruleset = {table: ruleset[table] for table in NFT_TABLES if table in ruleset}
+        elapsed = time.perf_counter() - started
+        PARSE_SECONDS.observe(elapsed)
+        record_timing('parse', elapsed)
+        return ruleset
+
+    def load(self):
+        try:
+            return self.dump()
+        except (ValueError, KeyError, TypeError, subprocess.CalledProcessError) as e:
+            app.logger.info("Reading the rules with %s: %s", self.legacy.commands['save'], command_error(e))
+            BACKEND_FALLBACKS.inc(1, 'load')
+            return self.legacy.load()
+
+    def build(self, changes, ruleset):
+        # nft script for the change set and the index of the change behind
+        # every script line. Rules are addressed by handle; the handles of
+        # every chain are tracked as the script inserts and deletes, rules
+        # the script adds itself have none yet.
+        rules = {}
+        lines = []
+        sources = [None]
+
+        def chain_rules(table, chain):
+            if (table, chain) not in rules:
+                rules[table, chain] = [(rule['handle'], rule['spec']) for rule in ruleset[table][chain]['rules']]
+            return rules[table, chain]
+
+        for index, change in enumerate(changes):
+            op = change['op']
+            table = change['table']
+            where = f"{self.nft_family} {table} {nft_name(change['chain'])}"
+            commands = []
+            if op in ('append', 'insert'):
+                chains = set(ruleset.get(table, {})) | {chain for t, chain in rules if t == table}
+                statement = nft_statement(change['spec'], chains, self.nft_family)
+                handles = chain_rules(table, change['chain'])
+                position = len(handles) + 1 if op == 'append' else int(change['position'])
+                if position == len(handles) + 1:
+                    commands.append(f"add rule {where} {statement}")
+                elif 1 <= position <= len(handles) and handles[position - 1][0] is not None:
+                    commands.append(f"insert rule {where} position {handles[position - 1][0]} {statement}")
+                elif 2 <= position <= len(handles) and handles[position - 2][0] is not None:
+                    commands.append(f"add rule {where} position {handles[position - 2][0]} {statement}")
+                else:
+                    raise ValueError(f"Can't address position {position} of {table}/{change['chain']}")
+                handles.insert(position - 1, (None, change['spec']))
+            elif op == 'delete':
+                handles = chain_rules(table, change['chain'])
+                if change.get('position'):
+                    position = int(change['position']) - 1
+                else:
+                    position = [spec for handle, spec in handles].index(change['spec'])
+                if not 0 <= position < len(handles) or handles[position][0] is None:
+                    raise ValueError(f"Can't address the rule to delete in {table}/{change['chain']}")
+                commands.append(f"delete rule {where} handle {handles.pop(position)[0]}")
+            elif op == 'policy':
+                kind, hook, priority = ruleset[table][change['chain']]['hook']
+                commands.append(f"add chain {where} {{ type {kind} hook {hook} priority {priority}; "
+                                f"policy {change['policy'].lower()}; }}")
+            elif op == 'new_chain':
+                commands.append(f"create chain {where}")
+                rules[table, change['chain']] = []
+            elif op == 'delete_chain':
+                commands.extend([f"flush chain {where}", f"delete chain {where}"])
+                rules[table, change['chain']] = []
+            else:
+                raise ValueError(f"Unknown change {op}")
+            lines.extend(commands)
+            sources.extend([index] * len(commands))
+        return '\n'.join(lines) + '\n', sources
+
+    def script(self, changes):
+        if not changes:
+            return ''
+        try:
+            return self.build(changes, get_ruleset(self.family))[0]
+        except (ValueError, KeyError, TypeError):
+            return self.legacy.script(changes)
+
+    def apply(self, changes, test_only=False):
+        # Handles come from a fresh dump, not from a cached ruleset
+        try:
+            script, sources = self.build(changes, self.dump())
+        except (ValueError, KeyError, TypeError, subprocess.CalledProcessError) as e:
+            app.logger.info("Writing the changes with %s: %s", self.legacy.commands['restore'], command_error(e))
+            BACKEND_FALLBACKS.inc(1, 'apply')
+            return self.legacy.apply(changes, test_only)
+        try:
+            run_command(['nft', '-c', '-f', '-'] if test_only else ['nft', '-f', '-'], input=script.encode())
+        except subprocess.CalledProcessError as e:
+            # "/dev/stdin:3:1-20: Error: ..."
+            message = command_error(e)
+            match = re.search(r':(\d+):\d+', message)
+            line = int(match.group(1)) if match else None
+            raise ChangeError(message, sources[line] if line is not None and line < len(sources) else None)
+
+def detect_backend(name, family='ipv4'):
+    # auto: nftables when iptables (ip6tables) is the iptables-nft shim and
+    # nft is installed
+    legacy = LegacyBackend(family)
+    if name == 'auto':
+        try:
+            version = subprocess.run([legacy.commands['iptables'], '-V'], capture_output=True, text=True).stdout
+        except OSError:
+            version = ''
+        name = 'nftables' if 'nf_tables' in version and shutil.which('nft') else 'iptables'
+    if name == 'nftables':
+        return NftablesBackend(family, legacy)
+    if name == 'iptables':
+        return legacy
+    raise ValueError(f"Unknown backend {name}, use auto, iptables or nftables")
+
+backends = {family: detect_backend(os.environ.get('IPTABLES_GUI_BACKEND', 'auto'), family) for family in FAMILIES}
+
+def family_changes(changes):
+    # Indexes of the changes of each family, IPv4 first. Changes without a
+    # family are IPv4 ones.
+    groups = {}
+    for index, change in enumerate(changes):
+        groups.setdefault(change.get('family', 'ipv4'), []).append(index)
+    unknown = set(groups) - set(FAMILIES)
+    if unknown:
+        raise ValueError(f"Unknown family {', '.join(sorted(unknown))}")
+    return {family: groups[family] for family in FAMILIES if family in groups}
+
+def apply_changes(changes, test_only=False):
+    # One transaction per family on its own backend. With both families in
+    # the set every one is tested before any is written. ChangeError.index
+    # is the index in `changes`.
+    groups = family_changes(changes)
+    if len(groups) > 1 and not test_only:
+        apply_changes(changes, test_only=True)
+    for family, indexes in groups.items():
+        try:
+            backends[family].apply([changes[i] for i in indexes], test_only)
+        except ChangeError as e:
+            raise ChangeError(str(e), indexes[e.index] if e.index is not None else None) from e
+
+def changes_script(changes):
+    groups = family_changes(changes)
+    if len(groups) == 1:
+        family, = groups
+        return backends[family].script(changes)
+    return ''.join(f"# {FAMILIES[family]['label']}\n" + backends[family].script([changes[i] for i in indexes])
+                   for family, indexes in groups.items())
+
+def change_from_form(action, form, ruleset):
+    table = form['table']
+    chain = form['chain']
+    if action == 'add_rule':
+        return {'op': 'append', 'table': table, 'chain': chain,
+                'spec': format_rule_spec(build_rule_spec(form))}
+    if action == 'delete_rule':
+        # Resolve the number against the snapshot the operator was looking at,
+        # earlier staged deletes would renumber the chain otherwise
+        rules = ruleset.get(table, {}).get(chain, {}).get('rules', [])
+        number = int(form['rule_number'])
+        if not 1 <= number <= len(rules):
+            raise ValueError(f"No rule {number} in {table}/{chain}")
+        spec = rules[number - 1]['spec']
+        # A delete by spec takes the first rule with it, not necessarily this one
+        if sum(1 for rule in rules if rule['spec'] == spec) > 1:
+            raise ValueError(f"Rule {number} of {table}/{chain} is in the chain more than once, "
+                             f"delete it directly instead of staging it")
+        return {'op': 'delete', 'table': table, 'chain': chain, 'spec': spec}
+    if action == 'set_policy':
+        return {'op': 'policy', 'table': table, 'chain': chain, 'policy': form['policy']}
+    if action == 'create_chain':
+        return {'op': 'new_chain', 'table': table, 'chain': chain}
+    if action == 'delete_chain':
+        return {'op': 'delete_chain', 'table': table, 'chain': chain}
+    raise ValueError(f"Cannot stage {action}")
+
+class ChangeSet:
+    # Edits staged from the forms, committed together as one transaction
+    # of the backend
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.changes = []
+        self.version = 0
+
+    def add(self, change):
+        with self.lock:
+            self.changes.append(change)
+            self.version += 1
+
+    def remove(self, index):
+        with self.lock:
+            del self.changes[index]
+            self.version += 1
+
+    def clear(self):
+        with self.lock:
+            self.changes = []
+            self.version += 1
+
+    def list(self):
+        with self.lock:
+            return list(self.changes)
+
+    def payload(self):
+        with self.lock:
+            return changes_script(self.changes)
+
+    def commit(self):
+        with self.lock:
+            if not self.changes:
+                return 0
+            apply_changes(self.changes)
+            committed = len(self.changes)
+            self.clear()
+            return committed
+
+pending_changes = ChangeSet()
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify({**ruleset_cache.stats(), 'backend': backends['ipv4'].name,
+                    'families': {family: {**cache.stats(), 'backend': backends[family].name}
+                                 for family, cache in ruleset_caches.items()},
+                    'reads': {'started': read_flights.started, 'shared': read_flights.shared},
+                    'writes': write_queue.stats()})
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    stats = ruleset_cache.stats()
+    for name, value, help in (('ruleset_cache_hits_total', stats['hits'], 'Ruleset reads served from the cache.'),
+                              ('ruleset_cache_misses_total', stats['misses'], 'Ruleset reads that dumped the rules.'),
+                              ('shared_reads_total', read_flights.shared, 'Reads that joined an identical running command.'),
+                              ('queued_writes_total', write_queue.completed, 'Commands run through the write queue.'),
+                              ('log_lines_total', log_ingester.lines, 'Kernel log lines read for LOG rules.')):
+        lines.extend([f'# HELP iptables_gui_{name} {help}', f'# TYPE iptables_gui_{name} counter',
+                      f'iptables_gui_{name} {value}'])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/stage/<action>', methods=['POST'])
+@require_sudo
+def stage_change(action):
+    try:
+        family = request_family()
+        change = change_from_form(action, request.form, get_ruleset(family))
+        change['family'] = family
+        validate_change(change)
+        pending_changes.add(change)
+        return redirect(index_url())
+    except Exception as e:
+        return f'<div class="status error">Error staging change: {escape(command_error(e))}</div>'
+
+@app.route('/changes')
+def list_changes():
+    return jsonify({'changes': pending_changes.list(), 'payload': pending_changes.payload()})
+
+@app.route('/discard_change', methods=['POST'])
+def discard_change():
+    try:
+        pending_changes.remove(int(request.form['index']))
+        return redirect(index_url())
+    except Exception as e:
+        return f'<div class="status error">Error discarding change: {escape(command_error(e))}</div>'
+
+@app.route('/discard_changes', methods=['POST'])
+def discard_changes():
+    pending_changes.clear()
+    return redirect(index_url())
+
+def staged_families():
+    return list(family_changes(pending_changes.list()))
+
+@app.route('/commit_changes', methods=['POST'])
+@require_sudo
+@invalidates_rulesets(staged_families)
+def commit_changes():
+    try:
+        pending_changes.commit()
+        return redirect(index_url())
+    except Exception as e:
+        return f'<div class="status error">Error committing changes: {escape(str(e))}</div>'
+
+# Fields of the add rule form, the same names are used by the bulk import
+RULE_FORM_FIELDS = ['table', 'chain', 'action', 'protocol', 'source_ip', 'dest_ip', 'source_port', 'dest_port',
+                    'in_interface', 'out_interface', 'to_source', 'to_destination', 'log_prefix']
+RULE_ACTIONS = ['ACCEPT', 'DROP', 'REJECT', 'LOG', 'RETURN', 'SNAT', 'DNAT', 'MASQUERADE']
+NAT_ACTIONS = {'SNAT': 'to_source', 'DNAT': 'to_destination', 'MASQUERADE': None}
+PORT_PROTOCOLS = {'tcp', 'udp', 'udplite', 'sctp', 'dccp'}
+INTERFACE_NAME = re.compile(r'^[A-Za-z0-9_.:@-]{1,15}\+?$')
+PORT_RANGE = re.compile(r'^(\d{1,5})(?::(\d{1,5}))?$')
+NAT_PORTS = re.compile(r'(\d{1,5})(?:-(\d{1,5}))?')
+# Rules that fail iptables-restore --test are dropped one at a time, a
+# payload failing more often than this is rejected as a whole
+BULK_MAX_RETRIES = 20
+
+def valid_nat_target(value, family):
+    # --to-source/--to-destination: addr[-addr][:port[-port]], IPv6
+    # addresses in brackets when a port follows
+    addresses, ports = value, ''
+    if value.startswith('['):
+        addresses, bracket, ports = value[1:].partition(']')
+        if not bracket or ports[:1] not in ('', ':'):
+            return False
+        ports = ports[1:]
+    elif family == 'ipv4' and ':' in value:
+        addresses, _, ports = value.partition(':')
+        if not ports:
+            return False
+    if ports:
+        match = NAT_PORTS.fullmatch(ports)
+        if not match or any(int(port) > 65535 for port in match.groups() if port):
+            return False
+    if not addresses:
+        return bool(ports)
+    parts = addresses.split('-')
+    try:
+        return len(parts) <= 2 and all(ipaddress.ip_address(part).version == FAMILIES[family]['version']
+                                       for part in parts)
+    except ValueError:
+        return False
+
+def validate_rule_form(fields, ruleset, family='ipv4'):
+    # Same fields as the add rule form, checked before anything runs.
+    # Returns the fields with empty values removed, raises ValueError.
+    form = {key: str(fields[key]).strip() for key in RULE_FORM_FIELDS if fields.get(key) not in (None, '')}
+    unknown = set(fields) - set(RULE_FORM_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    for field, value in form.items():
+        if CONTROL_CHARACTERS.search(value):
+            raise ValueError(f"{field} contains a control character")
+    table = form.setdefault('table', 'filter')
+    if table not in ruleset:
+        raise ValueError(f"Unknown table {table}")
+    if form.get('chain') not in ruleset[table]:
+        raise ValueError(f"No chain {form.get('chain', '')} in {table}")
+    action = form.get('action')
+    if action not in RULE_ACTIONS and action not in ruleset[table]:
+        raise ValueError(f"Unknown action {action}")
+    if action in NAT_ACTIONS:
+        if table != 'nat':
+            raise ValueError(f"{action} only works in the nat table")
+        if NAT_ACTIONS[action] and NAT_ACTIONS[action] not in form:
+            raise ValueError(f"{action} needs {NAT_ACTIONS[action]}")
+    for field in ('source_ip', 'dest_ip'):
+        if field in form:
+            prefix = parse_prefix(form[field])
+            if prefix is None or prefix[0] != FAMILIES[family]['version']:
+                raise ValueError(f"{field} is not an {FAMILIES[family]['label']} address or network: {form[field]}")
+    protocol = form.get('protocol', 'all').lower()
+    if not (protocol in PROTOCOL_NUMBERS or protocol in PORT_PROTOCOLS or protocol == 'all'
+            or (protocol.isdigit() and int(protocol) <= 255)):
+        raise ValueError(f"Unknown protocol {form['protocol']}")
+    if family == 'ipv6' and protocol == 'icmp':
+        raise ValueError("ICMP is protocol ipv6-icmp in IPv6 rules")
+    for field in ('to_source', 'to_destination'):
+        if field in form and not valid_nat_target(form[field], family):
+            raise ValueError(f"{field} is not addr[-addr][:port[-port]]: {form[field]}")
+    for field in ('source_port', 'dest_port'):
+        if field in form:
+            if form.get('protocol') not in PORT_PROTOCOLS:
+                raise ValueError(f"{field} needs protocol {'/'.join(sorted(PORT_PROTOCOLS))}")
+            match = PORT_RANGE.match(form[field])
+            if not match or any(int(port) > 65535 for port in match.groups() if port):
+                raise ValueError(f"{field} is not a port or port range: {form[field]}")
+    for field in ('in_interface', 'out_interface'):
+        if field in form and not INTERFACE_NAME.match(form[field]):
+            raise ValueError(f"{field} is not an interface name: {form[field]}")
+    if 'log_prefix' in form:
+        if action != 'LOG':
+            raise ValueError("log_prefix only goes with the LOG action")
+        if len(form['log_prefix']) > LOG_PREFIX_MAX or any(c in form['log_prefix'] for c in '"\n'):
+            raise ValueError(f"log_prefix is at most {LOG_PREFIX_MAX} characters without quotes")
+    return form
+
+def read_bulk_rules():
+    # JSON list (or {"rules": [...]}), or CSV with a header row, either as
+    # the request body or uploaded as rules_file. Returns (line, fields).
+    if 'rules_file' in request.files:
+        upload = request.files['rules_file']
+        text = upload.read().decode('utf-8', 'replace')
+        is_json = upload.filename.endswith('.json')
+    else:
+        text = request.get_data(as_text=True)
+        is_json = request.is_json or text.lstrip().startswith(('[', '{'))
+    if is_json:
+        data = json.loads(text)
+        rules = data['rules'] if isinstance(data, dict) else data
+        return list(enumerate(rules, 1))
+    reader = csv.DictReader(io.StringIO(text))
+    return [(reader.line_num, {key: value for key, value in row.items() if key is not None})
+            for row in reader]
+
+def bulk_families():
+    return [] if request.args.get('dry_run') in ('1', 'true', 'on') else [request_family()]
+
+@app.route('/api/rules/bulk', methods=['POST'])
+@require_sudo
+@invalidates_rulesets(bulk_families)
+def bulk_add_rules():
+    started = time.perf_counter()
+    try:
+        rows = read_bulk_rules()
+    except Exception as e:
+        return jsonify({'error': f"Invalid rules: {e}"}), 400
+    dry_run = request.args.get('dry_run') in ('1', 'true', 'on')
+    family = request_family()
+    backend = backends[family]
+    ruleset = get_ruleset(family)
+    errors = []
+    valid = []
+    for line, fields in rows:
+        try:
+            if not isinstance(fields, dict):
+                raise ValueError("Expected an object with the rule fields")
+            form = validate_rule_form(fields, ruleset, family)
+            valid.append((line, {'op': 'append', 'family': family, 'table': form['table'], 'chain': form['chain'],
+                                 'spec': format_rule_spec(build_rule_spec(form))}))
+        except ValueError as e:
+            errors.append({'line': line, 'error': str(e)})
+
+    # What the kernel refuses is only known after a test run, drop the
+    # failing rule and test the rest again
+    payload = ''
+    for attempt in range(BULK_MAX_RETRIES + 1):
+        if not valid:
+            break
+        changes = [change for line, change in valid]
+        try:
+            backend.apply(changes, test_only=True)
+            payload = backend.script(changes)
+            break
+        except ChangeError as e:
+            if e.index is None or attempt == BULK_MAX_RETRIES:
+                return jsonify({'error': f"{backend.name} rejected the rules: {e}",
+                                'errors': errors}), 400
+            line, change = valid.pop(e.index)
+            errors.append({'line': line, 'error': f"Rejected by {backend.name} ({e})"})
+    applied = 0
+    if valid and not dry_run:
+        try:
+            backend.apply([change for line, change in valid])
+            applied = len(valid)
+        except ChangeError as e:
+            return jsonify({'error': str(e), 'errors': errors}), 500
+    errors.sort(key=lambda error: error['line'])
+    return jsonify({'received': len(rows), 'valid': len(valid), 'applied': applied, 'dry_run': dry_run,
+                    'errors': errors, 'payload': payload if dry_run else None,
+                    'elapsed_ms': (time.perf_counter() - started) * 1000})
+
+@app.route('/add_rule', methods=['POST'])
+@require_sudo
+@invalidates_ruleset
+def add_rule():
+    try:
+        apply_changes([{'op': 'append', 'family': request_family(), 'table': request.form['table'],
+                        'chain': request.form['chain'], 'spec': format_rule_spec(build_rule_spec(request.form))}])
+        return redirect(index_url())
+    except Exception as e:
+        return f'<div class="status error">Error adding rule: {escape(command_error(e))}</div>'
 
 @app.route('/delete_rule', methods=['POST'])
 @require_sudo
+@invalidates_ruleset
 def delete_rule():
     try:
-        subprocess.check_call([
-            'sudo', 'iptables', 
-            '-t', request.form['table'],
-            '-D', request.form['chain'],
-            request.form['rule_number']
-        ])
-        return redirect('/')
+        apply_changes([{'op': 'delete', 'family': request_family(), 'table': request.form['table'],
+                        'chain': request.form['chain'], 'position': int(request.form['rule_number'])}])
+        return redirect(index_url())
     except Exception as e:
-        return f'<div class="status error">Error deleting rule: {str(e)}</div>'
+        return f'<div class="status error">Error deleting rule: {escape(command_error(e))}</div>'
 
 @app.route('/create_chain', methods=['POST'])
 @require_sudo
+@invalidates_ruleset
 def create_chain():
     try:
-        subprocess.check_call([
-            'sudo', 'iptables',
-            '-t', request.form['table'],
-            '-N', request.form['chain']
-        ])
-        return redirect('/')
+        apply_changes([{'op': 'new_chain', 'family': request_family(), 'table': request.form['table'],
+                        'chain': request.form['chain']}])
+        return redirect(index_url())
     except Exception as e:
-        return f'<div class="status error">Error creating chain: {str(e)}</div>'
+        return f'<div class="status error">Error creating chain: {escape(command_error(e))}</div>'
 
 @app.route('/delete_chain', methods=['POST'])
 @require_sudo
+@invalidates_ruleset
 def delete_chain():
     try:
-        # First flush the chain
-        subprocess.check_call([
-            'sudo', 'iptables',
-            '-t', request.form['table'],
-            '-F', request.form['chain']
-        ])
-        # Then delete it
-        subprocess.check_call([
-            'sudo', 'iptables',
-            '-t', request.form['table'],
-            '-X', request.form['chain']
-        ])
-        return redirect('/')
+        # Flushed first, a chain can only be deleted once it is empty
+        apply_changes([{'op': 'delete_chain', 'family': request_family(), 'table': request.form['table'],
+                        'chain': request.form['chain']}])
+        return redirect(index_url())
     except Exception as e:
-        return f'<div class="status error">Error deleting chain: {str(e)}</div>'
+        return f'<div class="status error">Error deleting chain: {escape(command_error(e))}</div>'
 
 @app.route('/set_policy', methods=['POST'])
 @require_sudo
+@invalidates_ruleset
 def set_policy():
     try:
-        subprocess.check_call([
-            'sudo', 'iptables',
-            '-t', request.form['table'],
-            '-P', request.form['chain'],
-            request.form['policy']
-        ])
-        return redirect('/')
+        apply_changes([{'op': 'policy', 'family': request_family(), 'table': request.form['table'],
+                        'chain': request.form['chain'], 'policy': request.form['policy']}])
+        return redirect(index_url())
     except Exception as e:
-        return f'<div class="status error">Error setting policy: {str(e)}</div>'
+        return f'<div class="status error">Error setting policy: {escape(command_error(e))}</div>'
 
 @app.route('/save_rules', methods=['POST'])
 @require_sudo
 def save_rules():
     try:
-        subprocess.check_call(['sudo', 'iptables-save', '-f', '/etc/iptables/rules.v4'])
-        return '<div class="status success">Rules saved successfully</div>'
+        family = FAMILIES[request_family()]
+        if helper_client is not None:
+            helper_client.save_rules(request_family())
+        else:
+            run_command([family['save'], '-f', family['rules_file']])
+        return f'<div class="status success">{family["label"]} rules saved to {escape(family["rules_file"])}</div>'
+    except Exception as e:
+        return f'<div class="status error">Error saving rules: {escape(command_error(e))}</div>'
+
+def restore_format_errors(text):
+    # Lines the diff can't represent, it only understands iptables-save output
+    bad = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if line.startswith('['):
+            line = line.partition(' ')[2]
+        if line and line != 'COMMIT' and not line.startswith(('#', '*', ':', '-A ')):
+            bad.append(number)
+    return bad
+
+def diff_chain(table, name, live_rules, target_rules):
+    # Deletes and inserts turning the live rules into the target ones. The
+    # opcodes are handled last first so the positions above stay valid;
+    # rules are deleted by spec unless the chain holds the spec more than once.
+    live = [rule['spec'] for rule in live_rules]
+    target = [rule['spec'] for rule in target_rules]
+    counts = Counter(live)
+    opcodes = difflib.SequenceMatcher(None, live, target, autojunk=False).get_opcodes()
+    changes = []
+    removed = []
+    added = []
+    for op, i1, i2, j1, j2 in reversed(opcodes):
+        if op == 'equal':
+            continue
+        for position in range(i2, i1, -1):
+            spec = live[position - 1]
+            changes.append({'op': 'delete', 'table': table, 'chain': name, 'spec': spec,
+                            'position': None if counts[spec] == 1 else position})
+            removed.append(spec)
+        for offset, spec in enumerate(target[j1:j2]):
+            changes.append({'op': 'insert', 'table': table, 'chain': name, 'position': i1 + 1 + offset, 'spec': spec})
+            added.append(spec)
+    moved = Counter(removed) & Counter(added)
+    summary = {'table': table, 'chain': name,
+               'added': list((Counter(added) - moved).elements()),
+               'removed': list((Counter(removed) - moved).elements()),
+               'moved': list(moved.elements()),
+               'unchanged': sum(i2 - i1 for op, i1, i2, j1, j2 in opcodes if op == 'equal')}
+    return changes, summary
+
+def diff_rulesets(live, target):
+    # Minimal change set from the live ruleset to an uploaded one. Tables the
+    # upload leaves out stay as they are, like with iptables-restore; inside a
+    # table new chains come first and removed chains last.
+    changes = []
+    chains = []
+    for table in ordered_tables(target):
+        live_chains = live.get(table, {})
+        target_chains = target[table]
+        created = []
+        edits = []
+        policies = []
+        deleted = []
+        for name in list(target_chains) + [name for name in live_chains if name not in target_chains]:
+            live_chain = live_chains.get(name)
+            target_chain = target_chains.get(name)
+            if target_chain is None and live_chain['policy'] is None:
+                deleted.append({'op': 'delete_chain', 'table': table, 'chain': name})
+                chains.append({'table': table, 'chain': name, 'deleted': True,
+                               'removed': [rule['spec'] for rule in live_chain['rules']]})
+                continue
+            if live_chain is None:
+                created.append({'op': 'new_chain', 'table': table, 'chain': name})
+            # A built-in chain the upload doesn't list is flushed by a full restore
+            chain_changes, summary = diff_chain(table, name, live_chain['rules'] if live_chain else [],
+                                                target_chain['rules'] if target_chain else [])
+            edits.extend(chain_changes)
+            summary['created'] = live_chain is None
+            target_policy = target_chain and target_chain['policy']
+            if target_policy and live_chain and target_policy != live_chain['policy']:
+                policies.append({'op': 'policy', 'table': table, 'chain': name, 'policy': target_policy})
+                summary['policy'] = [live_chain['policy'], target_policy]
+            if chain_changes or summary['created'] or summary.get('policy'):
+                chains.append(summary)
+        changes.extend(created + edits + policies + deleted)
+    return changes, chains
+
+def read_restore_upload():
+    if 'rules_file' not in request.files or request.files['rules_file'].filename == '':
+        raise ValueError("No file uploaded")
+    text = request.files['rules_file'].read().decode('utf-8', 'surrogateescape')
+    bad = restore_format_errors(text)
+    if bad:
+        raise ValueError(f"Not iptables-save output (line {bad[0]}), replace the tables instead")
+    # Diff against the current rules, not a snapshot that may be stale
+    family = request_family()
+    ruleset_caches[family].invalidate()
+    changes, chains = diff_rulesets(ruleset_caches[family].get(), parse_iptables_save(text, family))
+    for change in changes:
+        change['family'] = family
+    return changes, chains
+
+@app.route('/api/restore/preview', methods=['POST'])
+@require_sudo
+def preview_restore():
+    try:
+        changes, chains = read_restore_upload()
     except Exception as e:
-        return f'<div class="status error">Error saving rules: {str(e)}</div>'
+        return jsonify({'error': command_error(e)}), 400
+    return jsonify({'chains': chains, 'changes': len(changes),
+                    'payload': changes_script(changes)})
 
 @app.route('/restore_rules', methods=['POST'])
 @require_sudo
+@invalidates_ruleset
 def restore_rules():
     try:
-        if 'rules_file' not in request.files:
-            return '<div class="status error">No file uploaded</div>'
-            
-        file = request.files['rules_file']
-        if file.filename == '':
-            return '<div class="status error">No file selected</div>'
-            
-        # Save uploaded file temporarily
-        temp_path = '/tmp/iptables_restore.rules'
-        file.save(temp_path)
-        
-        # Restore rules
-        subprocess.check_call(['sudo', 'iptables-restore', temp_path])
+        if request.form.get('replace'):
+            if 'rules_file' not in request.files:
+                return '<div class="status error">No file uploaded</div>'
+
+            file = request.files['rules_file']
+            if file.filename == '':
+                return '<div class="status error">No file selected</div>'
+
+            # Restore rules, every table in the file is rebuilt
+            run_command([FAMILIES[request_family()]['restore']], input=file.read())
+            return redirect(index_url())
+
+        # Only the differences are applied, untouched rules keep their counters
+        changes, chains = read_restore_upload()
+        if changes:
+            apply_changes(changes)
+        return redirect(index_url())
+    except Exception as e:
+        return f'<div class="status error">Error restoring rules: {escape(command_error(e))}</div>'
+
+# Ruleset history, empty IPTABLES_GUI_HISTORY_DIR turns it off. Events
+# beyond the newest HISTORY_KEEP or older than HISTORY_DAYS are pruned.
+HISTORY_DIR = os.environ.get('IPTABLES_GUI_HISTORY_DIR', os.path.expanduser('~/.iptables-gui/history'))
+HISTORY_KEEP = int(os.environ.get('IPTABLES_GUI_HISTORY_KEEP', '500'))
+HISTORY_DAYS = float(os.environ.get('IPTABLES_GUI_HISTORY_DAYS', '90'))
+# Pruning rewrites the event log, it runs once this many events piled up
+HISTORY_PRUNE_EVERY = 50
+
+class SnapshotStore:
+    # Every chain's rules are stored once as a zlib compressed block named by
+    # its hash, a snapshot is a small manifest of block hashes named by its
+    # own hash. Near identical snapshots of a huge ruleset share all blocks
+    # but the changed chains. index.jsonl logs when which snapshot was seen,
+    # listing and diffing never decompress unchanged chains.
+    def __init__(self, path, keep, days):
+        self.path = path
+        self.keep = keep
+        self.days = days
+        self.lock = threading.Lock()
+        self.events = None
+        self.manifests = {}
+
+    def load_events(self):
+        if self.events is None:
+            try:
+                with open(os.path.join(self.path, 'index.jsonl')) as f:
+                    self.events = [json.loads(line) for line in f if line.strip()]
+            except FileNotFoundError:
+                self.events = []
+        return self.events
+
+    def block_path(self, digest):
+        return os.path.join(self.path, 'blocks', digest[:2], digest)
+
+    def manifest_path(self, digest):
+        return os.path.join(self.path, 'snapshots', digest + '.json')
+
+    def write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def record(self, ruleset, reason, family='ipv4'):
+        # Counters are left out, they would make every snapshot unique
+        tables = {}
+        with self.lock:
+            for table in ordered_tables(ruleset):
+                chains = []
+                for name, chain in ruleset[table].items():
+                    text = '\n'.join(rule['spec'] for rule in chain['rules']).encode('utf-8', 'surrogateescape')
+                    digest = hashlib.sha256(text).hexdigest()
+                    path = self.block_path(digest)
+                    if not os.path.exists(path):
+                        self.write_file(path, zlib.compress(text))
+                    chains.append([name, chain['policy'], digest, len(chain['rules'])])
+                tables[table] = chains
+            manifest = json.dumps(tables, sort_keys=True).encode()
+            snapshot = hashlib.sha256(manifest).hexdigest()
+            events = self.load_events()
+            previous = next((event for event in reversed(events) if event.get('family', 'ipv4') == family), None)
+            if previous and previous['snapshot'] == snapshot:
+                return previous
+            if not os.path.exists(self.manifest_path(snapshot)):
+                self.write_file(self.manifest_path(snapshot), manifest)
+            event = {'id': events[-1]['id'] + 1 if events else 1, 'time': time.time(), 'reason': reason,
+                     'family': family, 'snapshot': snapshot, 'chains': sum(len(chains) for chains in tables.values()),
+                     'rules': sum(chain[3] for chains in tables.values() for chain in chains)}
+            with open(os.path.join(self.path, 'index.jsonl'), 'a') as f:
+                f.write(json.dumps(event) + '\n')
+            events.append(event)
+            if event['id'] % HISTORY_PRUNE_EVERY == 0:
+                self.prune()
+            return event
+
+    def prune(self):
+        # Called with the lock held. The newest event always stays.
+        events = self.load_events()
+        oldest = time.time() - self.days * 86400
+        kept = [event for event in events[-self.keep:] if event['time'] >= oldest] or events[-1:]
+        if len(kept) == len(events):
+            return
+        self.write_file(os.path.join(self.path, 'index.jsonl'),
+                        ''.join(json.dumps(event) + '\n' for event in kept).encode())
+        self.events = kept
+        snapshots = {event['snapshot'] for event in kept}
+        blocks = set()
+        for snapshot in snapshots:
+            for chains in self.manifest(snapshot).values():
+                blocks.update(chain[2] for chain in chains)
+        for name in os.listdir(os.path.join(self.path, 'snapshots')):
+            if name[:-len('.json')] not in snapshots:
+                os.unlink(os.path.join(self.path, 'snapshots', name))
+                self.manifests.pop(name[:-len('.json')], None)
+        for directory, _, files in os.walk(os.path.join(self.path, 'blocks')):
+            for name in files:
+                if name not in blocks:
+                    os.unlink(os.path.join(directory, name))
+
+    def manifest(self, snapshot):
+        if snapshot not in self.manifests:
+            with open(self.manifest_path(snapshot)) as f:
+                self.manifests[snapshot] = json.load(f)
+        return self.manifests[snapshot]
+
+    def block(self, digest):
+        with open(self.block_path(digest), 'rb') as f:
+            text = zlib.decompress(f.read()).decode('utf-8', 'surrogateescape')
+        return text.split('\n') if text else []
+
+    def list(self):
+        with self.lock:
+            return list(self.load_events())
+
+    def event(self, event_id):
+        for event in self.list():
+            if event['id'] == event_id:
+                return event
+        raise KeyError(f"No snapshot {event_id} in the history")
+
+    def ruleset(self, snapshot, family='ipv4'):
+        lines = []
+        for table, chains in self.manifest(snapshot).items():
+            lines.append(f'*{table}')
+            lines.extend(f":{name} {policy or '-'} [0:0]" for name, policy, digest, count in chains)
+            for name, policy, digest, count in chains:
+                lines.extend(f'-A {name} {spec}' for spec in self.block(digest))
+            lines.append('COMMIT')
+        return parse_iptables_save('\n'.join(lines), family)
+
+    def diff(self, old, new):
+        # Per chain summaries like the restore preview, chains whose block
+        # didn't change are skipped without being read
+        old_tables = self.manifest(old)
+        new_tables = self.manifest(new)
+        chains = []
+        for table in ordered_tables({**old_tables, **new_tables}):
+            before = {chain[0]: chain for chain in old_tables.get(table, [])}
+            after = {chain[0]: chain for chain in new_tables.get(table, [])}
+            for name in list(after) + [name for name in before if name not in after]:
+                if name in before and name in after and before[name][1:3] == after[name][1:3]:
+                    continue
+                old_rules = [{'spec': spec} for spec in self.block(before[name][2])] if name in before else []
+                new_rules = [{'spec': spec} for spec in self.block(after[name][2])] if name in after else []
+                changes, summary = diff_chain(table, name, old_rules, new_rules)
+                summary['created'] = name not in before
+                summary['deleted'] = name not in after
+                if name in before and name in after and before[name][1] != after[name][1]:
+                    summary['policy'] = [before[name][1], after[name][1]]
+                chains.append(summary)
+        return chains
+
+snapshot_store = SnapshotStore(HISTORY_DIR, HISTORY_KEEP, HISTORY_DAYS) if HISTORY_DIR else None
+
+def record_snapshot(reason, family='ipv4'):
+    if snapshot_store is None:
+        return
+    try:
+        # Read fresh, the cached one can be a TTL old. The route gets it from
+        # the cache afterwards without another dump.
+        ruleset_caches[family].invalidate()
+        snapshot_store.record(ruleset_caches[family].get(), reason, family)
+    except Exception as e:
+        app.logger.warning(f"Could not record ruleset snapshot: {e}")
+
+@app.route('/api/history')
+@require_sudo
+def api_history():
+    if snapshot_store is None:
+        return jsonify({'error': 'History is turned off'}), 404
+    try:
+        limit = max(int(request.args.get('limit', 200)), 1)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid limit: {e}"}), 400
+    return jsonify({'events': snapshot_store.list()[::-1][:limit]})
+
+@app.route('/api/history/diff')
+@require_sudo
+def api_history_diff():
+    try:
+        old = snapshot_store.event(int(request.args['from']))
+        new = snapshot_store.event(int(request.args['to']))
+    except (AttributeError, KeyError, ValueError) as e:
+        return jsonify({'error': f"Invalid snapshots: {e}"}), 400
+    return jsonify({'from': old, 'to': new, 'chains': snapshot_store.diff(old['snapshot'], new['snapshot'])})
+
+def rollback_families():
+    return [snapshot_store.event(int(request.form['id'])).get('family', 'ipv4')]
+
+@app.route('/history/rollback', methods=['POST'])
+@require_sudo
+@invalidates_rulesets(rollback_families)
+def rollback():
+    try:
+        event = snapshot_store.event(int(request.form['id']))
+        family = event.get('family', 'ipv4')
+        # Same minimal diff as a restore, unchanged rules keep their counters.
+        # The snapshot taken before this just read the live rules.
+        changes, chains = diff_rulesets(get_ruleset(family), snapshot_store.ruleset(event['snapshot'], family))
+        if changes:
+            apply_changes([{**change, 'family': family} for change in changes])
+        return redirect(index_url())
+    except Exception as e:
+        return f'<div class="status error">Error rolling back: {escape(command_error(e))}</div>'
+
+# ipset names are at most 31 characters, leave room for the ".new" set
+# a blocklist is loaded into before it is swapped in
+BLOCKLIST_NAME = re.compile(r'^[A-Za-z0-9_-]{1,27}$')
+BLOCKLIST_TARGETS = ['DROP', 'REJECT']
+
+def parse_blocklist(text):
+    # One address or CIDR per line, comments (# or ;) and any further
+    # columns are ignored. Returns IPv4 (first, last) ranges and bad lines.
+    ranges = []
+    errors = []
+    for number, line in enumerate(text.splitlines(), 1):
+        entry = re.split(r'[\s#;,]', line.strip(), 1)[0]
+        if not entry:
+            continue
+        # Uncached, a feed would just evict the rule addresses
+        prefix = parse_prefix.__wrapped__(entry)
+        if prefix is None or prefix[0] != 4:
+            errors.append({'line': number, 'entry': entry[:64]})
+            continue
+        _, address, length = prefix
+        ranges.append((address, address | ((1 << (32 - length)) - 1)))
+    return ranges, errors
+
+def collapse_ranges(ranges, bits=32):
+    # Smallest list of CIDR prefixes covering the union of the ranges
+    prefixes = []
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    for first, last in merged:
+        while first <= last:
+            # Largest aligned block starting at `first` that still fits
+            size = first & -first or 1 << bits
+            while size > last - first + 1:
+                size >>= 1
+            prefixes.append((first, bits - size.bit_length() + 1))
+            first += size
+    return [f"{socket.inet_ntoa(first.to_bytes(4, 'big'))}/{length}" for first, length in prefixes]
+
+def build_ipset_payload(name, prefixes, existing):
+    # Everything goes into a fresh set that is then swapped with the live
+    # one, rules referencing the set never see it half filled or empty
+    temp = name + '.new'
+    maxelem = max(65536, 1 << len(prefixes).bit_length())
+    options = f"hash:net family inet hashsize {max(1024, maxelem // 8)} maxelem {maxelem}"
+    lines = []
+    if temp in existing:
+        lines.append(f"destroy {temp}")
+    lines.append(f"create {temp} {options}")
+    lines.extend(f"add {temp} {prefix}" for prefix in prefixes)
+    if name not in existing:
+        lines.append(f"create {name} {options}")
+    lines.append(f"swap {temp} {name}")
+    lines.append(f"destroy {temp}")
+    return '\n'.join(lines) + '\n'
+
+def list_ipsets():
+    # Set headers only, `-t` leaves out the members
+    sets = []
+    fields = {'Type': 'type', 'Number of entries': 'entries', 'References': 'references',
+              'Size in memory': 'memory'}
+    for line in run_command(['ipset', 'list', '-t']).decode().splitlines():
+        key, _, value = line.partition(':')
+        value = value.strip()
+        if key == 'Name':
+            sets.append({'name': value})
+        elif sets and key in fields:
+            sets[-1][fields[key]] = int(value) if value.isdigit() else value
+    return sets
+
+def blocklist_rules(ruleset, name):
+    rules = []
+    for table in ordered_tables(ruleset):
+        for chain in ruleset[table].values():
+            for rule in chain['rules']:
+                tokens = rule['tokens']
+                if any(tok == '--match-set' and tokens[i + 1:i + 2] == [name] for i, tok in enumerate(tokens)):
+                    rules.append({'table': table, 'chain': chain['name'], 'num': rule['num'], 'spec': rule['spec']})
+    return rules
+
+@app.route('/api/blocklists')
+@require_sudo
+def api_blocklists():
+    try:
+        ruleset = get_ruleset()
+        sets = list_ipsets()
+        for entry in sets:
+            entry['rules'] = blocklist_rules(ruleset, entry['name'])
+        return jsonify({'sets': sets})
+    except Exception as e:
+        return jsonify({'error': command_error(e)}), 500
+
+@app.route('/load_blocklist', methods=['POST'])
+@require_sudo
+@invalidates_ruleset
+def load_blocklist():
+    try:
+        name = request.form['name']
+        if not BLOCKLIST_NAME.match(name):
+            raise ValueError("Set names are 1-27 letters, digits, '_' or '-'")
+        target = request.form.get('action') or 'DROP'
+        if target not in BLOCKLIST_TARGETS:
+            raise ValueError(f"Blocklists can only {' or '.join(BLOCKLIST_TARGETS)}")
+        upload = request.files.get('blocklist_file')
+        if upload and upload.filename:
+            text = upload.read().decode('utf-8', 'replace')
+        else:
+            text = request.form.get('entries', '')
+        ranges, errors = parse_blocklist(text)
+        prefixes = collapse_ranges(ranges)
+        if not prefixes:
+            raise ValueError("No IPv4 addresses or networks found")
+        existing = set(run_command(['ipset', 'list', '-n']).decode().split())
+        run_command(['ipset', 'restore'], input=build_ipset_payload(name, prefixes, existing).encode())
+
+        # One rule references the set, added the first time only
+        chain = request.form.get('chain') or 'INPUT'
+        direction = 'dst' if request.form.get('direction') == 'dst' else 'src'
+        spec = ['-m', 'set', '--match-set', name, direction, '-j', target]
+        if not any(rule['table'] == 'filter' and rule['chain'] == chain
+                   for rule in blocklist_rules(get_ruleset(), name)):
+            apply_changes([{'op': 'insert', 'table': 'filter', 'chain': chain,
+                            'position': 1, 'spec': format_rule_spec(spec)}])
+        skipped = f", skipped {len(errors)} invalid lines (first on line {errors[0]['line']})" if errors else ''
+        return (f'<div class="status success">Loaded {len(ranges)} entries into {escape(name)} '
+                f'as {len(prefixes)} prefixes{escape(skipped)}</div>')
+    except Exception as e:
+        return f'<div class="status error">Error loading blocklist: {escape(command_error(e))}</div>'
+
+@app.route('/delete_blocklist', methods=['POST'])
+@require_sudo
+@invalidates_ruleset
+def delete_blocklist():
+    try:
+        name = request.form['name']
+        # The set can't be destroyed while rules still reference it
+        changes = [{'op': 'delete', 'table': rule['table'], 'chain': rule['chain'], 'spec': rule['spec']}
+                   for rule in blocklist_rules(get_ruleset(), name)]
+        if changes:
+            apply_changes(changes)
+        run_command(['ipset', 'destroy', name])
         return redirect('/')
     except Exception as e:
-        return f'<div class="status error">Error restoring rules: {str(e)}</div>'
+        return f'<div class="status error">Error deleting blocklist: {escape(command_error(e))}</div>'
+
+# Connection tracking table. IPTABLES_GUI_CONNTRACK_FILE reads a saved
+# /proc/net/nf_conntrack or `conntrack -L` dump instead of the live table.
+CONNTRACK_FILE = os.environ.get('IPTABLES_GUI_CONNTRACK_FILE', '')
+CONNTRACK_TTL = float(os.environ.get('IPTABLES_GUI_CONNTRACK_TTL', '10'))
+CONNTRACK_TOP = int(os.environ.get('IPTABLES_GUI_CONNTRACK_TOP', '50'))
+CONNTRACK_PAGE_MAX = 500
+# Per-tuple fields, everything else (mark, use, zone...) belongs to the entry
+CONNTRACK_TUPLE_KEYS = {'src', 'dst', 'sport', 'dport', 'type', 'code', 'id', 'packets', 'bytes'}
+# protocol, state, then the original and reply src/dst/sport/dport. Much
+# cheaper than parse_conntrack_line, for passes over the whole table.
+CONNTRACK_TUPLES = re.compile(r'(?:ipv[46]\s+\d+\s+)?(\S+)\s+\d+\s+\d+\s+(?:([A-Z_]+)\s+)?'
+                              r'src=(\S+) dst=(\S+) (?:sport=(\d+) dport=(\d+) )?'
+                              r'.*?src=(\S+) dst=(\S+) (?:sport=(\d+) dport=(\d+))?')
+
+STREAM_READ_SIZE = 1 << 16
+
+def stream_chunks(argv):
+    # Yields a privileged command's output as it arrives, in pieces of up to
+    # STREAM_READ_SIZE bytes, through the helper if there is one
+    started = time.perf_counter()
+    kind = command_kind(argv)
+    chunks = helper_client.stream(argv) if helper_client is not None else popen_chunks(argv)
+    # A reader that stops early (paging) has the command killed
+    returncode = -9
+    try:
+        for data in chunks:
+            COMMAND_OUTPUT.inc(len(data), kind)
+            yield data
+        returncode = 0
+    except subprocess.CalledProcessError as e:
+        returncode = e.returncode
+        raise
+    finally:
+        chunks.close()
+        COMMAND_SECONDS.observe(time.perf_counter() - started, kind, returncode)
+
+def popen_chunks(argv):
+    cmd = argv if os.geteuid() == 0 else ['sudo'] + argv
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = os.read(process.stdout.fileno(), STREAM_READ_SIZE)
+            if not data:
+                break
+            yield data
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, argv, stderr=process.stderr.read())
+
+def stream_command(argv):
+    # The same line by line
+    chunks = stream_chunks(argv)
+    try:
+        pending = b''
+        for data in chunks:
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode(errors='replace') + '\n'
+        if pending:
+            yield pending.decode(errors='replace')
+    finally:
+        chunks.close()
+
+def conntrack_lines():
+    path = CONNTRACK_FILE
+    if not path and os.access('/proc/net/nf_conntrack', os.R_OK):
+        path = '/proc/net/nf_conntrack'
+    if not path:
+        return stream_command(['conntrack', '-L'])
+    return open_lines(path)
+
+def open_lines(path):
+    with open(path, errors='replace') as f:
+        yield from f
+
+def parse_conntrack_line(line):
+    # "ipv4 2 tcp 6 431999 ESTABLISHED src=.. dst=.. sport=.. dport=.. src=.. ... [ASSURED] mark=0 use=1"
+    # from /proc, the same without the first two fields from conntrack -L.
+    # The first src= starts the original tuple, the second one the reply.
+    tokens = line.split()
+    start = 2 if tokens and tokens[0] in ('ipv4', 'ipv6') else 0
+    if len(tokens) < start + 4:
+        return None
+    entry = {'family': tokens[0] if start else 'ipv4', 'protocol': tokens[start],
+             'timeout': int(tokens[start + 2]) if tokens[start + 2].isdigit() else 0,
+             'state': '', 'original': {}, 'reply': {}, 'flags': []}
+    current = entry['original']
+    for token in tokens[start + 3:]:
+        key, eq, value = token.partition('=')
+        if not eq:
+            if token[0] == '[':
+                entry['flags'].append(token.strip('[]'))
+            elif not current:
+                entry['state'] = token
+        elif key in CONNTRACK_TUPLE_KEYS:
+            if key == 'src' and current:
+                current = entry['reply']
+            current[key] = value
+        else:
+            entry[key] = value
+    return entry
+
+def conntrack_tuples(line):
+    match = CONNTRACK_TUPLES.match(line)
+    return match.groups() if match else None
+
+def conntrack_nat(tuples):
+    # Translation done on the connection, seen from the reply tuple: a
+    # reply from somewhere else than the original destination means DNAT,
+    # a reply to somewhere else than the original source means SNAT. SNAT
+    # is keyed by address only, source ports are per connection.
+    protocol, state, src, dst, sport, dport, reply_src, reply_dst, reply_sport, reply_dport = tuples
+    if (reply_src, reply_sport) != (dst, dport):
+        return f"DNAT {dst}{':' + dport if dport else ''} -> {reply_src}{':' + reply_sport if reply_sport else ''}"
+    if reply_dst != src:
+        return f"SNAT {src} -> {reply_dst}"
+    return None
+
+class TopK:
+    # Space-Saving heavy hitters with batched eviction. Counts are exact
+    # until `capacity` keys are tracked, then all but the largest `k` are
+    # dropped at once. A key seen again starts at the largest count dropped
+    # so far, so a count overestimates by at most the error kept with it.
+    def __init__(self, k, capacity=None):
+        self.k = k
+        self.capacity = capacity or k * 200
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+
+    def add(self, key):
+        counts = self.counts
+        if key in counts:
+            counts[key] += 1
+            return
+        if len(counts) >= self.capacity:
+            self.evict()
+        counts[key] = self.floor + 1
+        if self.floor:
+            self.errors[key] = self.floor
+
+    def evict(self):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        self.floor = max(self.floor, ranked[self.k][1])
+        self.counts = dict(ranked[:self.k])
+        self.errors = {key: self.errors[key] for key in self.counts if key in self.errors}
+
+    def top(self, n=None):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:n or self.k]
+        return [{'key': key, 'count': count, 'error': self.errors.get(key, 0)} for key, count in ranked]
+
+class CountMinSketch:
+    # Approximate count of any key, not only the heavy hitters, in
+    # depth x width counters. Estimates never undercount. The row positions
+    # come from one hash of the key (h1 + i * h2).
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def add(self, key):
+        h = hash(key)
+        position, step = h & 0xffffffff, (h >> 32) | 1
+        for row in self.rows:
+            row[position % self.width] += 1
+            position += step
+
+    def estimate(self, key):
+        h = hash(key)
+        position, step = h & 0xffffffff, (h >> 32) | 1
+        counts = []
+        for row in self.rows:
+            counts.append(row[position % self.width])
+            position += step
+        return min(counts)
+
+def summarize_conntrack():
+    # One pass over the table, memory bounded by the top-K tables and the
+    # sketches whatever the number of entries
+    started = time.perf_counter()
+    total = 0
+    protocols = Counter()
+    states = Counter()
+    top = {name: TopK(CONNTRACK_TOP) for name in ('source', 'destination', 'nat')}
+    sketches = {name: CountMinSketch() for name in ('source', 'destination')}
+    for line in conntrack_lines():
+        tuples = conntrack_tuples(line)
+        if tuples is None:
+            continue
+        total += 1
+        protocols[tuples[0]] += 1
+        if tuples[1]:
+            states[tuples[1]] += 1
+        top['source'].add(tuples[2])
+        top['destination'].add(tuples[3])
+        sketches['source'].add(tuples[2])
+        sketches['destination'].add(tuples[3])
+        nat = conntrack_nat(tuples)
+        if nat:
+            top['nat'].add(nat)
+    return {'total': total, 'protocols': dict(protocols.most_common()), 'states': dict(states.most_common()),
+            'top': {name: counter.top() for name, counter in top.items()},
+            'sketches': sketches, 'elapsed_ms': (time.perf_counter() - started) * 1000, 'time': time.time()}
+
+conntrack_cache = RulesetCache(summarize_conntrack, CONNTRACK_TTL)
+
+def conntrack_filter(args):
+    # Predicate on conntrack_tuples for the raw listing, all given fields
+    # have to match. Addresses match either side of the NAT.
+    wanted = {name: args[name] for name in ('source', 'destination', 'protocol', 'state', 'port') if args.get(name)}
+
+    def matches(tuples):
+        protocol, state, src, dst, sport, dport, reply_src, reply_dst, reply_sport, reply_dport = tuples
+        return (('source' not in wanted or wanted['source'] in (src, reply_dst))
+                and ('destination' not in wanted or wanted['destination'] in (dst, reply_src))
+                and ('protocol' not in wanted or wanted['protocol'] == protocol)
+                and ('state' not in wanted or wanted['state'].upper() == state)
+                and ('port' not in wanted or wanted['port'] in (sport, dport)))
+    return matches
+
+def matching_conntrack(lines, matches):
+    # Entries are only parsed in full for the page that is shown
+    for line in lines:
+        tuples = conntrack_tuples(line)
+        if tuples is not None and matches(tuples):
+            yield line, tuples
+
+@app.route('/api/conntrack/summary')
+@require_sudo
+def api_conntrack_summary():
+    if request.args.get('refresh'):
+        conntrack_cache.invalidate()
+    try:
+        summary = conntrack_cache.get()
+    except Exception as e:
+        return jsonify({'error': command_error(e)}), 500
+    result = {key: value for key, value in summary.items() if key != 'sketches'}
+    # Estimated entries for any address, heavy hitter or not
+    address = request.args.get('address')
+    if address:
+        result['address'] = {'address': address,
+                             'as_source': summary['sketches']['source'].estimate(address),
+                             'as_destination': summary['sketches']['destination'].estimate(address)}
+    return jsonify(result)
+
+@app.route('/api/conntrack')
+@require_sudo
+def api_conntrack():
+    # A page of raw entries, read up to the page and no further
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 100)), 1), CONNTRACK_PAGE_MAX)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    matches = conntrack_filter(request.args)
+    lines = conntrack_lines()
+    try:
+        page = list(itertools.islice(matching_conntrack(lines, matches), offset, offset + limit + 1))
+    except Exception as e:
+        return jsonify({'error': command_error(e)}), 500
+    finally:
+        lines.close()
+    entries = []
+    for line, tuples in page[:limit]:
+        entry = parse_conntrack_line(line)
+        entry['nat'] = conntrack_nat(tuples)
+        entries.append(entry)
+    return jsonify({'offset': offset, 'limit': limit, 'entries': entries,
+                    'next': offset + limit if len(page) > limit else None})
+
+# Kernel log ingestion for LOG rules. IPTABLES_GUI_KERNEL_LOG is a log
+# file to follow or "journal" for journalctl -k; kern.log when there is one.
+KERNEL_LOG = os.environ.get('IPTABLES_GUI_KERNEL_LOG',
+                            '/var/log/kern.log' if os.path.exists('/var/log/kern.log') else 'journal')
+LOG_BUCKET_SECONDS = float(os.environ.get('IPTABLES_GUI_LOG_BUCKET', '60'))
+LOG_BUCKETS = int(os.environ.get('IPTABLES_GUI_LOG_BUCKETS', '15'))
+LOG_READ_SIZE = 1 << 20
+LOG_POLL_INTERVAL = 0.25
+LOG_RECENT = 100
+LOG_PREFIX_MAX = 29
+# "... kernel: [ 123.456] DROP-IN: IN=eth0 OUT= MAC=.. SRC=.. DST=.. LEN=.. ... PROTO=TCP SPT=.. DPT=.."
+NETFILTER_LOG = re.compile(rb'(?:.*?kernel: )?(?:\[\s*\d+\.\d+\]\s*)?(.*?)IN=(\S*) OUT=(\S*) (?:.*? )?'
+                           rb'SRC=(\S+) DST=(\S+) .*?PROTO=(\w+)(?: SPT=(\d+) DPT=(\d+))?')
+# Built-in chains a packet logged with/without IN= and OUT= can have been in
+LOG_HOOK_CHAINS = {(True, False): {'PREROUTING', 'INPUT'},
+                   (True, True): {'FORWARD', 'POSTROUTING'},
+                   (False, True): {'OUTPUT', 'POSTROUTING'}}
+
+def log_rule_index(ruleset):
+    # --log-prefix (stripped, as the kernel prints it) -> the LOG rules using it
+    index = {}
+    for table, chains in ruleset.items():
+        for name, chain in chains.items():
+            for rule in chain['rules']:
+                if rule['target'] != 'LOG':
+                    continue
+                tokens = rule['tokens']
+                prefix = tokens[tokens.index('--log-prefix') + 1].strip() if '--log-prefix' in tokens else ''
+                index.setdefault(prefix, []).append({'key': (table, name, rule['spec']), 'table': table,
+                                                     'chain': name, 'num': rule['num'], 'prefix': prefix,
+                                                     'compiled': compile_rule(rule)})
+    return index
+
+def match_log_rule(candidates, inside, outside, src, dst, proto, sport, dport):
+    # Rules sharing a prefix are told apart by the chains the packet could
+    # have been in, then by their matches
+    if len(candidates) == 1:
+        return candidates[0]
+    hooks = LOG_HOOK_CHAINS.get((bool(inside), bool(outside)), set())
+    narrowed = [rule for rule in candidates if rule['chain'] not in BUILTIN_CHAINS or rule['chain'] in hooks]
+    if len(narrowed) > 1:
+        try:
+            packet = {'src': parse_prefix(src)[:2], 'dst': parse_prefix(dst)[:2],
+                      'proto': int(proto) if proto.isdigit() else PROTOCOL_NUMBERS[proto.lower()],
+                      'sport': int(sport) if sport else None, 'dport': int(dport) if dport else None,
+                      'in': inside or None, 'out': outside or None, 'state': 'NEW'}
+            narrowed = [rule for rule in narrowed if rule_matches(rule['compiled'], packet)] or narrowed
+        except (KeyError, TypeError, ValueError):
+            pass
+    return (narrowed or candidates)[0]
+
+class LogAggregator:
+    # Rolling LOG counts per rule and per source over `buckets` buckets of
+    # `bucket_seconds`. Memory is bounded by the bucket count and the top-K
+    # capacities, not by the log volume.
+    def __init__(self, bucket_seconds, buckets):
+        self.bucket_seconds = bucket_seconds
+        self.lock = threading.Lock()
+        self.buckets = deque(maxlen=buckets)
+        self.recent = deque(maxlen=LOG_RECENT)
+        self.unmatched = TopK(20)
+
+    def bucket(self, now):
+        start = now - now % self.bucket_seconds
+        if not self.buckets or self.buckets[-1]['start'] != start:
+            self.buckets.append({'start': start, 'lines': 0, 'rules': Counter(), 'last_seen': {},
+                                 'sources': TopK(50, 2000), 'rule_sources': TopK(100, 4000)})
+        return self.buckets[-1]
+
+    def add(self, events, lines, now):
+        with self.lock:
+            bucket = self.bucket(now)
+            bucket['lines'] += lines
+            rules, last_seen = bucket['rules'], bucket['last_seen']
+            sources, rule_sources = bucket['sources'], bucket['rule_sources']
+            for key, prefix, inside, outside, src, dst, proto, sport, dport in events:
+                if key is None:
+                    self.unmatched.add(prefix)
+                    continue
+                rules[key] += 1
+                last_seen[key] = now
+                sources.add(src)
+                rule_sources.add((key, src))
+            self.recent.extend({'time': now, 'rule': key, 'prefix': prefix, 'in': inside, 'out': outside,
+                                'src': src, 'dst': dst, 'proto': proto, 'sport': sport, 'dport': dport}
+                               for key, prefix, inside, outside, src, dst, proto, sport, dport in events[-LOG_RECENT:])
+
+    def snapshot(self, now):
+        # Merged over the buckets still inside the window, oldest first
+        with self.lock:
+            window = [bucket for bucket in self.buckets
+                      if bucket['start'] > now - self.bucket_seconds * self.buckets.maxlen]
+            rules = Counter()
+            last_seen = {}
+            sources = Counter()
+            source_errors = Counter()
+            rule_sources = {}
+            for bucket in window:
+                rules.update(bucket['rules'])
+                last_seen.update(bucket['last_seen'])
+                sources.update(bucket['sources'].counts)
+                source_errors.update(bucket['sources'].errors)
+                for (key, src), count in bucket['rule_sources'].counts.items():
+                    rule_sources.setdefault(key, Counter())[src] += count
+            current = window[-1] if window and window[-1]['start'] == now - now % self.bucket_seconds else None
+            series = {key: [bucket['rules'].get(key, 0) for bucket in window] for key in rules}
+            return {'lines_per_second': current['lines'] / max(now - current['start'], 1) if current else 0,
+                    'rules': [{'key': key, 'count': count, 'last_seen': last_seen.get(key), 'series': series[key],
+                               'sources': [{'src': src, 'count': n}
+                                           for src, n in rule_sources.get(key, Counter()).most_common(5)]}
+                              for key, count in rules.most_common()],
+                    'sources': [{'src': src, 'count': count, 'error': source_errors[src]}
+                                for src, count in sources.most_common(20)],
+                    'unmatched': self.unmatched.top(),
+                    'recent': [dict(event) for event in self.recent]}
+
+class LogIngester:
+    # Follows the kernel log on one thread, started by the first client of
+    # the log panel. Lines are read and parsed in large chunks so a burst of
+    # logging is caught up with in a few passes instead of line by line.
+    def __init__(self, source, aggregator):
+        self.source = source
+        self.aggregator = aggregator
+        self.lock = threading.Lock()
+        self.thread = None
+        self.error = None
+        self.lines = 0
+        self.matched = 0
+        self.behind = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                chunks = self.follow_journal() if self.source == 'journal' else self.follow_file(self.source)
+                for lines in chunks:
+                    self.process(lines)
+                    self.error = None
+            except Exception as e:
+                self.error = command_error(e)
+                time.sleep(5)
+
+    def follow_file(self, path):
+        # Like tail -F: new lines only, reopened when the log is rotated
+        f = open(path, 'rb')
+        try:
+            f.seek(0, os.SEEK_END)
+            pending = b''
+            while True:
+                data = f.read(LOG_READ_SIZE)
+                if data:
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                    self.behind = max(os.fstat(f.fileno()).st_size - f.tell(), 0)
+                    yield lines
+                    continue
+                time.sleep(LOG_POLL_INTERVAL)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if stat.st_ino != os.fstat(f.fileno()).st_ino or stat.st_size < f.tell():
+                    f.close()
+                    f = open(path, 'rb')
+                    pending = b''
+        finally:
+            f.close()
+
+    def follow_journal(self):
+        # Each piece is whatever journalctl had written, through the helper
+        # or sudo like every other privileged command
+        pending = b''
+        for data in stream_chunks(KERNEL_JOURNAL):
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            yield lines
+        raise RuntimeError("journalctl exited")
+
+    def process(self, lines):
+        try:
+            index = ruleset_cache.derived('log_rules', log_rule_index)
+        except Exception:
+            index = {}
+        events = []
+        for line in lines:
+            if b'SRC=' not in line:
+                continue
+            match = NETFILTER_LOG.match(line)
+            if match is None:
+                continue
+            prefix, inside, outside, src, dst, proto, sport, dport = (
+                value.decode(errors='replace') if value is not None else None for value in match.groups())
+            prefix = prefix.strip()
+            candidates = index.get(prefix)
+            rule = match_log_rule(candidates, inside, outside, src, dst, proto, sport, dport) if candidates else None
+            events.append((rule['key'] if rule else None, prefix, inside, outside, src, dst, proto, sport, dport))
+        self.lines += len(lines)
+        self.matched += sum(1 for event in events if event[0] is not None)
+        self.aggregator.add(events, len(lines), time.time())
+
+log_ingester = LogIngester(KERNEL_LOG, LogAggregator(LOG_BUCKET_SECONDS, LOG_BUCKETS))
+
+@app.route('/api/logs')
+@require_sudo
+def api_logs():
+    log_ingester.start()
+    now = time.time()
+    snapshot = log_ingester.aggregator.snapshot(now)
+    # Rules are identified by table, chain and spec, numbered as they are now
+    numbers = {rule['key']: rule['num'] for rules in ruleset_cache.derived('log_rules', log_rule_index).values()
+               for rule in rules}
+    for rule in snapshot['rules']:
+        table, chain, spec = rule.pop('key')
+        rule.update({'table': table, 'chain': chain, 'spec': spec, 'num': numbers.get((table, chain, spec))})
+    for event in snapshot['recent']:
+        if event['rule'] is not None:
+            event['rule'] = {'table': event['rule'][0], 'chain': event['rule'][1],
+                             'num': numbers.get(event['rule'])}
+    return jsonify({**snapshot, 'source': log_ingester.source, 'error': log_ingester.error,
+                    'lines_total': log_ingester.lines, 'matched_total': log_ingester.matched,
+                    'behind_bytes': log_ingester.behind, 'bucket_seconds': LOG_BUCKET_SECONDS})
+
+# Agent API, served to a fleet manager. Off unless a token is set.
+AGENT_TOKEN = os.environ.get('IPTABLES_GUI_AGENT_TOKEN', '')
+# Fleet manager: JSON file listing the agents, see load_fleet
+FLEET_FILE = os.environ.get('IPTABLES_GUI_FLEET', '')
+FLEET_CONCURRENCY = int(os.environ.get('IPTABLES_GUI_FLEET_CONCURRENCY', '16'))
+FLEET_TIMEOUT = float(os.environ.get('IPTABLES_GUI_FLEET_TIMEOUT', '10'))
+
+agent_api = Blueprint('agent', __name__, url_prefix='/agent')
+
+@agent_api.before_request
+def require_agent_token():
+    if not AGENT_TOKEN:
+        return jsonify({'error': 'Agent API is disabled'}), 403
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), AGENT_TOKEN.encode()):
+        return jsonify({'error': 'Invalid agent token'}), 401
+
+def ruleset_summary(ruleset):
+    # Rules and policies without counters, what fleet drift is computed on
+    tables = {table: {name: {'policy': chain['policy'], 'rules': [rule['spec'] for rule in chain['rules']]}
+                      for name, chain in ruleset[table].items()}
+              for table in ordered_tables(ruleset)}
+    digest = hashlib.sha256(json.dumps(tables, sort_keys=True).encode()).hexdigest()
+    return tables, digest
+
+@agent_api.route('/ruleset')
+def agent_ruleset():
+    try:
+        tables, digest = ruleset_summary(ruleset_cache.get())
+    except Exception as e:
+        return jsonify({'error': command_error(e)}), 500
+    return jsonify({'hostname': socket.gethostname(), 'hash': digest, 'tables': tables})
+
+def agent_families():
+    data = request.get_json(force=True, silent=True) or {}
+    return [] if data.get('dry_run') else list(family_changes(data.get('changes', [])))
+
+@agent_api.route('/apply', methods=['POST'])
+@invalidates_rulesets(agent_families)
+def agent_apply():
+    data = request.get_json(force=True)
+    try:
+        apply_changes(data['changes'], test_only=bool(data.get('dry_run')))
+    except Exception as e:
+        return jsonify({'error': command_error(e)}), 400
+    return jsonify({'ok': True, 'dry_run': bool(data.get('dry_run'))})
+
+app.register_blueprint(agent_api)
+
+class AgentRequestHandler(WSGIRequestHandler):
+    # Keep-alive, so the manager's pooled connections get reused
+    protocol_version = 'HTTP/1.1'
+
+class FleetHost:
+    # One agent, with a pool of idle keep-alive connections to it
+    def __init__(self, name, url, token, groups):
+        self.name = name
+        self.url = url
+        self.token = token
+        self.groups = groups
+        parts = urllib.parse.urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.base = parts.path.rstrip('/')
+        self.idle = queue.LifoQueue()
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'}
+        for attempt in range(2):
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self.connection_class(self.netloc, timeout=FLEET_TIMEOUT)
+                reused = False
+            try:
+                conn.request(method, self.base + path, body=data, headers=headers)
+                response = conn.getresponse()
+                payload = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                # The agent may have dropped an idle connection, retry on a new one
+                if reused and not attempt:
+                    continue
+                raise
+            self.idle.put(conn)
+            result = json.loads(payload) if payload else {}
+            if response.status != 200:
+                raise RuntimeError(result.get('error') or f"HTTP {response.status}")
+            return result
+
+def load_fleet(path):
+    # {"token": "...", "hosts": [{"name": "fw1", "url": "http://10.0.0.1:5001",
+    #   "groups": ["dmz"], "token": "..."}]}, a host's token overrides the shared one
+    with open(path) as f:
+        config = json.load(f)
+    return [FleetHost(host.get('name') or host['url'], host['url'], host.get('token', config.get('token', '')),
+                      host.get('groups', []))
+            for host in config['hosts']]
+
+def fan_out(hosts, call, concurrency=FLEET_CONCURRENCY):
+    # Runs call(host) on every host at once (up to `concurrency`), results in
+    # host order with per-host errors and timings
+    def timed(host):
+        started = time.perf_counter()
+        result = {'host': host.name}
+        try:
+            result.update(call(host))
+            result['ok'] = True
+        except Exception as e:
+            result.update(ok=False, error=str(e))
+        result['elapsed_ms'] = (time.perf_counter() - started) * 1000
+        return result
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(hosts))), thread_name_prefix='fleet') as executor:
+        return list(executor.map(timed, hosts))
+
+def fleet_drift(rulesets):
+    # Policies and rules that are not the same on every host
+    hosts = sorted(rulesets)
+    policies = {}
+    rules = {}
+    for host, tables in rulesets.items():
+        for table, chains in tables.items():
+            for name, chain in chains.items():
+                policies.setdefault((table, name), {})[host] = chain['policy'] or '-'
+                for spec in chain['rules']:
+                    rules.setdefault((table, name, spec), set()).add(host)
+    policy_drift = [{'table': table, 'chain': name, 'policies': {host: by_host.get(host, 'missing') for host in hosts}}
+                    for (table, name), by_host in policies.items()
+                    if len(by_host) < len(hosts) or len(set(by_host.values())) > 1]
+    rule_drift = [{'table': table, 'chain': name, 'spec': spec, 'present': sorted(present),
+                   'missing': [host for host in hosts if host not in present]}
+                  for (table, name, spec), present in rules.items() if len(present) < len(hosts)]
+    return {'policies': policy_drift, 'rules': rule_drift}
+
+fleet = load_fleet(FLEET_FILE) if FLEET_FILE else []
+
+@app.route('/api/fleet/rulesets')
+@require_sudo
+def fleet_rulesets():
+    results = fan_out(fleet, lambda host: host.request('GET', '/agent/ruleset'))
+    rulesets = {result['host']: result.pop('tables') for result in results if result['ok']}
+    for result in results:
+        if result['ok']:
+            result['rules'] = sum(len(chain['rules']) for chains in rulesets[result['host']].values()
+                                  for chain in chains.values())
+    return jsonify({'hosts': results, 'drift': fleet_drift(rulesets)})
+
+@app.route('/api/fleet/push', methods=['POST'])
+@require_sudo
+def fleet_push():
+    # Pushes the pending change set to every host of a group
+    group = request.form.get('group', '')
+    hosts = [host for host in fleet if not group or group in host.groups]
+    # The changes themselves are sent, every agent writes them with its own backend
+    changes = pending_changes.list()
+    if not changes:
+        return jsonify({'error': 'No pending changes to push'}), 400
+    if not hosts:
+        return jsonify({'error': f"No hosts in group {group}"}), 400
+    try:
+        concurrency = min(max(int(request.form.get('concurrency') or FLEET_CONCURRENCY), 1), FLEET_CONCURRENCY)
+    except ValueError:
+        return jsonify({'error': 'concurrency must be a number'}), 400
+    dry_run = request.form.get('dry_run') in ('1', 'true', 'on')
+    results = fan_out(hosts, lambda host: host.request('POST', '/agent/apply',
+                                                       {'changes': changes, 'dry_run': dry_run}), concurrency)
+    return jsonify({'group': group, 'dry_run': dry_run, 'changes': changes, 'results': results})
+
+# Request threads in production mode, and how many accepted connections
+# may wait for one before the server stops accepting more
+BACKLOG = int(os.environ.get('IPTABLES_GUI_BACKLOG', '64'))
+
+class PooledWSGIServer(BaseWSGIServer):
+    # Handles connections on a fixed pool of threads instead of one thread
+    # per connection. Live counter streams hold a worker each, at most
+    # COUNTER_STREAMS of them.
+    def __init__(self, host, port, app, workers, backlog, handler=None):
+        super().__init__(host, port, app, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='request')
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    parser = argparse.ArgumentParser(description='Web GUI to manage iptables')
+    parser.add_argument('--helper', action='store_true',
+                        help='run the privileged helper instead of the web app (as root)')
+    parser.add_argument('--socket', default=os.environ.get('IPTABLES_GUI_HELPER_SOCKET'),
+                        help='unix socket of the privileged helper')
+    parser.add_argument('--user', help='user the web app runs as, allowed to use the helper')
+    parser.add_argument('--production', action='store_true',
+                        help='serve on a bounded thread pool without the debugger')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--agent', action='store_true',
+                        help='only serve the agent API for a fleet manager (needs IPTABLES_GUI_AGENT_TOKEN)')
+    parser.add_argument('--fleet', help='JSON file listing the agents this instance manages')
+    args = parser.parse_args()
+    if args.helper:
+        if not args.socket:
+            parser.error('--helper needs --socket')
+        run_helper(args.socket, args.user)
+        sys.exit(0)
+    if args.socket:
+        helper_client = HelperClient(args.socket)
+    if args.fleet:
+        fleet = load_fleet(args.fleet)
+    if args.agent:
+        if not AGENT_TOKEN:
+            parser.error('--agent needs IPTABLES_GUI_AGENT_TOKEN')
+        agent_app = Flask('iptables_gui_agent')
+        agent_app.register_blueprint(agent_api)
+        print(f"agent API on port {args.port}")
+        PooledWSGIServer('0.0.0.0', args.port, agent_app, WORKERS, BACKLOG, AgentRequestHandler).serve_forever()
+    elif args.production:
+        print(f"serving on port {args.port} with {WORKERS} workers")
+        PooledWSGIServer('0.0.0.0', args.port, app, WORKERS, BACKLOG).serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=args.port, debug=True)
@@ -0,0 +1,95 @@
+# Stand-ins for sudo and the iptables tools, on PATH before iptables_gui is
+# imported. The save commands print the rules the test wrote with
+# write_rules, `nft -j list ruleset` prints nft.json and conntrack the table
+# of write_conntrack, every other command logs its command line (and its
+# input) and succeeds.
+import os
+import sys
+import tempfile
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+STUB_DIR = tempfile.mkdtemp(prefix='iptables-gui-test-')
+STUB = '''#!/bin/sh
+echo "{name} $*" >> "{dir}/calls.log"
+{body}
+'''
+STUBS = {
+    'sudo': '[ "$1" = "-n" ] && shift\nexec "$@"',
+    'iptables-save': 'cat "{dir}/rules.v4"',
+    'ip6tables-save': 'cat "{dir}/rules.v6"',
+    'iptables-restore': 'cat >> "{dir}/restore.log"',
+    'ip6tables-restore': 'cat >> "{dir}/restore.log"',
+    'iptables': '[ "$1" = "-V" ] && echo "iptables v1.8.7 (legacy)"\nexit 0',
+    'ip6tables': '[ "$1" = "-V" ] && echo "ip6tables v1.8.7 (legacy)"\nexit 0',
+    'ipset': 'exit 0',
+    'conntrack': 'cat "{dir}/conntrack.txt"',
+    'journalctl': 'echo "[12.5] ssh: IN=eth0 OUT= SRC=10.0.0.1 DST=10.0.0.2 PROTO=TCP SPT=40000 DPT=22"',
+    'nft': '[ "$1" = "-j" ] && exec cat "{dir}/nft.json"\ncat >> "{dir}/restore.log"',
+}
+EMPTY_RULES = '*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\nCOMMIT\n'
+
+for name, body in STUBS.items():
+    path = os.path.join(STUB_DIR, name)
+    with open(path, 'w') as f:
+        f.write(STUB.format(name=name, dir=STUB_DIR, body=body.format(dir=STUB_DIR)))
+    os.chmod(path, 0o755)
+for name in ('rules.v4', 'rules.v6'):
+    with open(os.path.join(STUB_DIR, name), 'w') as f:
+        f.write(EMPTY_RULES)
+open(os.path.join(STUB_DIR, 'conntrack.txt'), 'w').close()
+os.environ.update(PATH=STUB_DIR + os.pathsep + os.environ['PATH'], IPTABLES_GUI_BACKEND='iptables',
+                  IPTABLES_GUI_HISTORY_DIR='', IPTABLES_GUI_KERNEL_LOG=os.devnull,
+                  IPTABLES_GUI_CONNTRACK_FILE=os.path.join(STUB_DIR, 'conntrack.txt'))
+
+import iptables_gui  # noqa: E402
+
+
+def read_stub_file(name):
+    path = os.path.join(STUB_DIR, name)
+    if not os.path.exists(path):
+        return ''
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def write_rules():
+    # Replaces what iptables-save (ip6tables-save) prints and drops the cache
+    def write(text, family='ipv4'):
+        with open(os.path.join(STUB_DIR, 'rules.v4' if family == 'ipv4' else 'rules.v6'), 'w') as f:
+            f.write(text)
+        iptables_gui.ruleset_caches[family].invalidate()
+    yield write
+    for family in ('ipv4', 'ipv6'):
+        write(EMPTY_RULES, family)
+
+
+@pytest.fixture
+def write_conntrack():
+    # Replaces the connection table read through IPTABLES_GUI_CONNTRACK_FILE
+    def write(text):
+        with open(os.path.join(STUB_DIR, 'conntrack.txt'), 'w') as f:
+            f.write(text)
+        iptables_gui.conntrack_cache.invalidate()
+    yield write
+    write('')
+
+
+@pytest.fixture
+def calls():
+    # Commands run and restore payloads written since the test started
+    for name in ('calls.log', 'restore.log'):
+        open(os.path.join(STUB_DIR, name), 'w').close()
+    return lambda: {'commands': read_stub_file('calls.log').splitlines(),
+                    'restore': read_stub_file('restore.log')}
+
+
+@pytest.fixture
+def client():
+    iptables_gui.pending_changes.clear()
+    yield iptables_gui.app.test_client()
+    iptables_gui.pending_changes.clear()
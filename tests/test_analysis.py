@@ -0,0 +1,114 @@
+import random
+
+from iptables_gui import (PacketSimulator, analyze_ruleset, cleanup_changes, compile_rule, parse_iptables_save,
+                          parse_packet, rule_shape, ShapeIndex)
+
+SOURCES = [None, '10.2.0.0/16', '10.2.0.0/24', '10.0.0.0/8', '192.168.1.0/24']
+PORTS = [None, '22', '80', '22,80', '80:443']
+TARGETS = ['ACCEPT', 'DROP', 'REJECT']
+PACKETS = [parse_packet({'src': src, 'dst': '198.51.100.1', 'protocol': protocol, 'dport': port,
+                         'in_interface': 'eth0', 'hook': 'input'})
+           for src in ('10.2.0.1', '10.2.5.1', '10.3.0.1', '192.168.1.1', '203.0.113.1')
+           for protocol in ('tcp', 'udp')
+           for port in ('22', '80', '443', '8080')]
+
+
+def random_spec(rng):
+    spec = []
+    source = rng.choice(SOURCES)
+    if source:
+        spec += ['-s', source]
+    protocol = rng.choice([None, 'tcp', 'udp', 'udp'])
+    if protocol:
+        spec += ['-p', protocol]
+        port = rng.choice(PORTS)
+        if port and ',' in port:
+            spec += ['-m', 'multiport', '--dports', port]
+        elif port:
+            spec += ['-m', protocol, '--dport', port]
+    return ' '.join(spec + ['-j', rng.choice(TARGETS)])
+
+
+def chain_ruleset(specs, policy='ACCEPT'):
+    lines = ['*filter', f':INPUT {policy} [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]']
+    lines += [f'-A INPUT {spec}' for spec in specs]
+    return parse_iptables_save('\n'.join(lines + ['COMMIT']) + '\n')
+
+
+def apply_to_specs(specs, changes):
+    specs = list(specs)
+    for change in changes:
+        if change['op'] == 'delete':
+            if change['position']:
+                del specs[change['position'] - 1]
+            else:
+                specs.remove(change['spec'])
+        else:
+            specs.insert(change['position'] - 1, change['spec'])
+    return specs
+
+
+def verdicts(ruleset):
+    simulator = PacketSimulator(ruleset)
+    return [simulator.trace(packet)['verdict'] for packet in PACKETS]
+
+
+def test_multiport_rule_is_not_redundant_by_a_later_rule_with_a_port_inside():
+    ruleset = chain_ruleset(['-s 10.2.0.0/16 -p udp -m multiport --dports 22,80 -j REJECT',
+                             '-p udp -m udp --dport 22 -j DROP',
+                             '-s 10.2.0.0/16 -j REJECT'])
+    assert analyze_ruleset(ruleset)['chains'] == []
+
+
+def test_overlapping_finds_single_ports_inside_a_range():
+    ruleset = chain_ruleset(['-p udp -m udp --dport 22 -j DROP',
+                             '-p udp -m udp --dport 8080 -j DROP',
+                             '-p udp -m multiport --dports 22,80 -j ACCEPT'])
+    shapes = [rule_shape(i, compile_rule(rule)) for i, rule in enumerate(ruleset['filter']['INPUT']['rules'])]
+    index = ShapeIndex(shapes)
+    assert index.first_later_overlap(dict(shapes[2], pos=-1))['num'] == 1
+    assert index.last_earlier_blocker(shapes[2])['num'] == 1
+
+
+def test_shadowed_and_redundant_rules():
+    ruleset = chain_ruleset(['-s 10.0.0.0/8 -j DROP',
+                             '-s 10.2.0.0/16 -p tcp -m tcp --dport 22 -j ACCEPT',
+                             '-s 192.168.1.0/24 -j ACCEPT',
+                             '-p tcp -m tcp --dport 80 -j ACCEPT'])
+    chain, = analyze_ruleset(ruleset)['chains']
+    assert chain['shadowed'] == [{'num': 2, 'target': 'ACCEPT', 'by': 1, 'by_target': 'DROP', 'conflict': True}]
+    assert chain['redundant'] == [{'num': 4, 'target': 'ACCEPT', 'by': 'policy'}]
+
+
+def test_snat_to_another_address_is_not_redundant():
+    ruleset = parse_iptables_save('*nat\n:POSTROUTING ACCEPT [0:0]\n'
+                                  '-A POSTROUTING -s 10.0.0.0/24 -j SNAT --to-source 1.1.1.1\n'
+                                  '-A POSTROUTING -j SNAT --to-source 2.2.2.2\n'
+                                  '-A POSTROUTING -s 10.0.0.0/24 -j SNAT --to-source 2.2.2.2\nCOMMIT\n')
+    chain, = analyze_ruleset(ruleset)['chains']
+    assert chain['redundant'] == []
+    # The first rule takes all of the third's packets to another address
+    assert chain['shadowed'] == [{'num': 3, 'target': 'SNAT', 'by': 1, 'by_target': 'SNAT', 'conflict': True}]
+
+
+def test_reject_with_another_reply_is_not_redundant():
+    ruleset = chain_ruleset(['-p tcp -m tcp --dport 22 -j REJECT --reject-with tcp-reset',
+                             '-p tcp -j REJECT --reject-with icmp-port-unreachable',
+                             '-p tcp -m tcp --dport 80 -j REJECT --reject-with icmp-port-unreachable'])
+    chain, = analyze_ruleset(ruleset)['chains']
+    assert chain['redundant'] == []
+    assert [item['conflict'] for item in chain['shadowed']] == [False]
+    ruleset = chain_ruleset(['-p tcp -m tcp --dport 22 -j REJECT --reject-with tcp-reset',
+                             '-p tcp -m tcp --dport 22 -j REJECT --reject-with icmp-port-unreachable'])
+    chain, = analyze_ruleset(ruleset)['chains']
+    assert chain['shadowed'] == [{'num': 2, 'target': 'REJECT', 'by': 1, 'by_target': 'REJECT', 'conflict': True}]
+
+
+def test_cleanup_preserves_verdicts():
+    rng = random.Random(9)
+    for _ in range(300):
+        specs = [random_spec(rng) for _ in range(rng.randrange(2, 12))]
+        ruleset = chain_ruleset(specs, rng.choice(['ACCEPT', 'DROP']))
+        changes = cleanup_changes(analyze_ruleset(ruleset), ['shadowed', 'redundant', 'mergeable'])
+        cleaned = chain_ruleset(apply_to_specs(specs, changes), ruleset['filter']['INPUT']['policy'])
+        assert verdicts(cleaned) == verdicts(ruleset), specs
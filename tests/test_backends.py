@@ -0,0 +1,166 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+import iptables_gui
+from conftest import STUB_DIR
+from iptables_gui import (ChangeError, LegacyBackend, NftablesBackend, build_restore_script, detect_backend,
+                          nft_rule_spec, nft_statement)
+
+RULES = ('*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n'
+         '[5:300] -A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\nCOMMIT\n')
+CHANGES = [{'op': 'new_chain', 'table': 'filter', 'chain': 'WEB'},
+           {'op': 'append', 'table': 'filter', 'chain': 'WEB', 'spec': '-p tcp -m tcp --dport 80 -j ACCEPT'},
+           {'op': 'policy', 'table': 'filter', 'chain': 'INPUT', 'policy': 'DROP'},
+           {'op': 'append', 'table': 'nat', 'chain': 'POSTROUTING', 'spec': '-o eth0 -j MASQUERADE'}]
+
+
+def nft_rule(chain, handle, *expr, comment=None):
+    rule = {'family': 'ip', 'table': 'filter', 'chain': chain, 'handle': handle, 'expr': list(expr)}
+    if comment:
+        rule['comment'] = comment
+    return {'rule': rule}
+
+
+def tcp_dport(port):
+    return {'match': {'op': '==', 'left': {'payload': {'protocol': 'tcp', 'field': 'dport'}}, 'right': port}}
+
+
+NFT_RULESET = {'nftables': [
+    {'metainfo': {'json_schema_version': 1}},
+    {'table': {'family': 'ip', 'name': 'filter', 'handle': 1}},
+    {'chain': {'family': 'ip', 'table': 'filter', 'name': 'INPUT', 'handle': 1, 'type': 'filter', 'hook': 'input',
+               'prio': 0, 'policy': 'accept'}},
+    {'chain': {'family': 'ip', 'table': 'filter', 'name': 'WEB', 'handle': 2}},
+    {'chain': {'family': 'ip6', 'table': 'filter', 'name': 'INPUT', 'handle': 1, 'type': 'filter',
+               'hook': 'input', 'prio': 0, 'policy': 'drop'}},
+    nft_rule('INPUT', 4,
+             {'match': {'op': '==', 'left': {'meta': {'key': 'l4proto'}}, 'right': 'tcp'}}, tcp_dport(22),
+             {'counter': {'packets': 5, 'bytes': 300}}, {'accept': None}),
+    nft_rule('INPUT', 5,
+             {'match': {'op': '!=', 'left': {'payload': {'protocol': 'ip', 'field': 'saddr'}},
+                        'right': {'prefix': {'addr': '10.0.0.0', 'len': 8}}}},
+             {'match': {'op': '==', 'left': {'meta': {'key': 'iifname'}}, 'right': 'eth*'}},
+             {'counter': {'packets': 0, 'bytes': 0}}, {'jump': {'target': 'WEB'}}, comment='to web'),
+    nft_rule('WEB', 6,
+             {'match': {'op': '==', 'left': {'meta': {'key': 'l4proto'}}, 'right': 'tcp'}},
+             {'match': {'op': '==', 'left': {'payload': {'protocol': 'tcp', 'field': 'dport'}},
+                        'right': {'set': [80, 443, {'range': [8000, 8080]}]}}},
+             {'match': {'op': 'in', 'left': {'ct': {'key': 'state'}}, 'right': ['new', 'established']}},
+             {'limit': {'rate': 10, 'per': 'second', 'burst': 20}},
+             {'counter': {'packets': 1, 'bytes': 60}}, {'reject': {'type': 'tcp reset'}}),
+]}
+
+
+@pytest.fixture
+def write_nft():
+    def write(ruleset):
+        with open(os.path.join(STUB_DIR, 'nft.json'), 'w') as f:
+            json.dump(ruleset, f)
+    yield write
+    os.remove(os.path.join(STUB_DIR, 'nft.json'))
+
+
+def test_restore_script_groups_tables():
+    payload, sources = build_restore_script(CHANGES)
+    assert payload.splitlines() == ['*filter', '-N WEB', '-A WEB -p tcp -m tcp --dport 80 -j ACCEPT',
+                                    '-P INPUT DROP', 'COMMIT', '*nat', '-A POSTROUTING -o eth0 -j MASQUERADE',
+                                    'COMMIT']
+    # Line numbers as iptables-restore reports them
+    assert sources == [None, None, 0, 1, 2, None, None, 3, None]
+
+
+def test_legacy_apply_tests_the_payload_first(calls):
+    LegacyBackend('ipv4').apply(CHANGES)
+    log = calls()
+    assert log['commands'] == ['iptables-restore -w 10 --noflush --test', 'iptables-restore -w 10 --noflush']
+    assert log['restore'] == build_restore_script(CHANGES)[0] * 2
+
+
+def test_legacy_apply_runs_one_change_as_a_plain_command(calls):
+    LegacyBackend('ipv6').apply([{'op': 'delete_chain', 'table': 'filter', 'chain': 'WEB'}])
+    assert calls()['commands'] == ['ip6tables -w 10 -t filter -F WEB', 'ip6tables -w 10 -t filter -X WEB']
+
+
+def test_legacy_apply_points_at_the_failing_change(monkeypatch):
+    def fail(argv, input=None):
+        raise subprocess.CalledProcessError(1, argv, stderr=b'iptables-restore: line 7 failed')
+    monkeypatch.setattr(iptables_gui, 'run_command', fail)
+    with pytest.raises(ChangeError) as error:
+        LegacyBackend('ipv4').apply(CHANGES)
+    assert error.value.index == 3
+
+
+def test_nft_rule_spec_matches_iptables_save():
+    specs = [nft_rule_spec(item['rule']['expr'], item['rule'].get('comment'))
+             for item in NFT_RULESET['nftables'] if 'rule' in item]
+    assert specs == [
+        ('-p tcp -m tcp --dport 22 -j ACCEPT', 5, 300),
+        ('! -s 10.0.0.0/8 -i eth+ -m comment --comment "to web" -j WEB', 0, 0),
+        ('-p tcp -m multiport --dports 80,443,8000:8080 -m conntrack --ctstate NEW,ESTABLISHED '
+         '-m limit --limit 10/sec --limit-burst 20 -j REJECT --reject-with tcp-reset', 1, 60)]
+    with pytest.raises(ValueError):
+        nft_rule_spec([{'xt': {'type': 'match', 'name': 'recent'}}, {'accept': None}])
+
+
+@pytest.mark.parametrize('spec, statement', [
+    ('-p tcp -m tcp --dport 22 -j ACCEPT', 'meta l4proto tcp tcp dport 22 counter accept'),
+    ('! -s 10.0.0.0/8 -i eth+ -m comment --comment "to web" -j WEB',
+     'ip saddr != 10.0.0.0/8 iifname "eth*" counter jump WEB comment "to web"'),
+    ('-p udp -m multiport --dports 53,1000:2000 -m conntrack --ctstate NEW -j DROP',
+     'meta l4proto udp udp dport { 53, 1000-2000 } ct state { new } counter drop'),
+    ('-m limit --limit 5/min --limit-burst 10 -j LOG --log-prefix "in: " --log-level 4',
+     'limit rate 5/minute burst 10 packets counter log prefix "in: " level warn'),
+    ('-p tcp -j REJECT --reject-with tcp-reset', 'meta l4proto tcp counter reject with tcp reset'),
+])
+def test_nft_statement(spec, statement):
+    assert nft_statement(spec, {'WEB'}) == statement
+
+
+def test_nft_statement_refuses_what_has_no_translation():
+    for spec in ('-m recent --rcheck -j DROP', '--dport 22 -j ACCEPT', '-j NOWHERE', '-p tcp ! -m tcp -j DROP'):
+        with pytest.raises(ValueError):
+            nft_statement(spec, {'WEB'})
+
+
+def test_nftables_dump_and_handles(write_nft, calls):
+    write_nft(NFT_RULESET)
+    backend = NftablesBackend('ipv4', LegacyBackend('ipv4'))
+    ruleset = backend.load()
+    assert list(ruleset['filter']) == ['INPUT', 'WEB']
+    assert ruleset['filter']['INPUT']['policy'] == 'ACCEPT'
+    assert ruleset['filter']['WEB']['policy'] is None
+    assert [(rule['handle'], rule['packets']) for rule in ruleset['filter']['INPUT']['rules']] == [(4, 5), (5, 0)]
+    backend.apply([{'op': 'insert', 'table': 'filter', 'chain': 'INPUT', 'position': 2, 'spec': '-j DROP'},
+                   {'op': 'delete', 'table': 'filter', 'chain': 'INPUT', 'spec': '-p tcp -m tcp --dport 22 -j ACCEPT'},
+                   {'op': 'append', 'table': 'filter', 'chain': 'WEB', 'spec': '-j RETURN'},
+                   {'op': 'policy', 'table': 'filter', 'chain': 'INPUT', 'policy': 'DROP'}])
+    assert calls()['restore'].splitlines() == [
+        'insert rule ip filter INPUT position 5 counter drop',
+        'delete rule ip filter INPUT handle 4',
+        'add rule ip filter WEB counter return',
+        'add chain ip filter INPUT { type filter hook input priority 0; policy drop; }']
+    assert not any(command.startswith('iptables') for command in calls()['commands'])
+
+
+def test_nftables_falls_back_to_legacy(write_nft, write_rules, calls):
+    ruleset = json.loads(json.dumps(NFT_RULESET))
+    ruleset['nftables'][-1]['rule']['expr'].insert(0, {'xt': {'type': 'match', 'name': 'recent'}})
+    write_nft(ruleset)
+    write_rules(RULES)
+    backend = NftablesBackend('ipv4', LegacyBackend('ipv4'))
+    assert [rule['spec'] for rule in backend.load()['filter']['INPUT']['rules']] == [
+        '-p tcp -m tcp --dport 22 -j ACCEPT']
+    backend.apply(CHANGES[:2])
+    assert calls()['restore'] == build_restore_script(CHANGES[:2])[0] * 2
+
+
+def test_detect_backend():
+    assert isinstance(detect_backend('iptables'), LegacyBackend)
+    assert isinstance(detect_backend('nftables', 'ipv6'), NftablesBackend)
+    # The stand-in iptables reports the legacy variant
+    assert isinstance(detect_backend('auto'), LegacyBackend)
+    with pytest.raises(ValueError, match='Unknown backend'):
+        detect_backend('pf')
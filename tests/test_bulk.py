@@ -0,0 +1,49 @@
+import pytest
+
+from iptables_gui import parse_iptables_save, valid_nat_target, validate_rule_form
+
+RULES = ('*nat\n:PREROUTING ACCEPT [0:0]\n:POSTROUTING ACCEPT [0:0]\nCOMMIT\n'
+         '*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\nCOMMIT\n')
+
+
+@pytest.mark.parametrize('fields, error', [
+    ({'chain': 'INPUT', 'action': 'ACCEPT', 'protocol': 'tcp -F INPUT'}, 'Unknown protocol'),
+    ({'chain': 'INPUT', 'action': 'LOG', 'log_prefix': 'a\r\n-F INPUT'}, 'control character'),
+    ({'chain': 'INPUT', 'action': 'ACCEPT', 'protocol': 'tcp', 'dest_port': '70000'}, 'not a port'),
+    ({'table': 'nat', 'chain': 'PREROUTING', 'action': 'DNAT', 'protocol': 'tcp',
+      'to_destination': '10.0.0.1\n-F INPUT'}, 'control character'),
+    ({'table': 'nat', 'chain': 'PREROUTING', 'action': 'DNAT', 'to_destination': '10.0.0.1 -j ACCEPT'},
+     'addr[-addr][:port[-port]]'),
+    ({'table': 'nat', 'chain': 'POSTROUTING', 'action': 'SNAT'}, 'needs to_source'),
+    ({'chain': 'INPUT', 'action': 'DNAT', 'to_destination': '10.0.0.1'}, 'only works in the nat table'),
+])
+def test_validate_rule_form_refuses(fields, error):
+    with pytest.raises(ValueError, match=error.replace('[', r'\[').replace(']', r'\]')):
+        validate_rule_form(fields, parse_iptables_save(RULES))
+
+
+@pytest.mark.parametrize('value, family, valid', [
+    ('10.0.0.1', 'ipv4', True),
+    ('10.0.0.1-10.0.0.9:80-90', 'ipv4', True),
+    (':8080', 'ipv4', True),
+    ('10.0.0.1:', 'ipv4', False),
+    ('10.0.0.1:65536', 'ipv4', False),
+    ('10.0.0.1-10.0.0.2-10.0.0.3', 'ipv4', False),
+    ('2001:db8::1', 'ipv4', False),
+    ('2001:db8::1', 'ipv6', True),
+    ('[2001:db8::1]:443', 'ipv6', True),
+    ('[2001:db8::1', 'ipv6', False),
+])
+def test_valid_nat_target(value, family, valid):
+    assert valid_nat_target(value, family) == valid
+
+
+def test_bulk_import_applies_nothing_invalid(client, write_rules, calls):
+    write_rules(RULES)
+    rows = [{'chain': 'INPUT', 'action': 'ACCEPT', 'protocol': 'tcp', 'dest_port': '22'},
+            {'table': 'nat', 'chain': 'PREROUTING', 'action': 'DNAT', 'protocol': 'tcp', 'dest_port': '80',
+             'to_destination': '10.0.0.1\n-F INPUT'}]
+    result = client.post('/api/rules/bulk', json=rows).get_json()
+    assert (result['valid'], result['applied']) == (1, 1)
+    assert [error['line'] for error in result['errors']] == [2]
+    assert '-F INPUT' not in calls()['restore']
@@ -0,0 +1,99 @@
+import random
+from collections import Counter
+
+from benchmark import synthetic_conntrack
+from iptables_gui import CountMinSketch, TopK, conntrack_nat, conntrack_tuples, parse_conntrack_line
+
+PROC_LINE = ('ipv4     2 tcp      6 431999 ESTABLISHED src=10.0.0.5 dst=93.184.216.34 sport=40000 dport=443 '
+             'src=93.184.216.34 dst=203.0.113.1 sport=443 dport=40000 [ASSURED] mark=0 zone=0 use=2')
+DNAT_LINE = ('tcp      6 117 TIME_WAIT src=198.51.100.7 dst=203.0.113.1 sport=51000 dport=443 '
+             'src=10.9.0.2 dst=198.51.100.7 sport=8443 dport=51000 [ASSURED] mark=0 use=1')
+UDP_LINE = ('ipv4     2 udp      17 29 src=10.0.0.5 dst=10.0.0.53 sport=5353 dport=53 '
+            '[UNREPLIED] src=10.0.0.53 dst=10.0.0.5 sport=53 dport=5353 mark=0 use=1')
+ICMP_LINE = ('ipv4     2 icmp     1 29 src=10.0.0.5 dst=10.0.0.1 type=8 code=0 id=7 '
+             'src=10.0.0.1 dst=10.0.0.5 type=0 code=0 id=7 mark=0 use=1')
+
+
+def test_parse_conntrack_line():
+    entry = parse_conntrack_line(PROC_LINE)
+    assert (entry['family'], entry['protocol'], entry['timeout'], entry['state']) == ('ipv4', 'tcp', 431999,
+                                                                                    'ESTABLISHED')
+    assert entry['original'] == {'src': '10.0.0.5', 'dst': '93.184.216.34', 'sport': '40000', 'dport': '443'}
+    assert entry['reply'] == {'src': '93.184.216.34', 'dst': '203.0.113.1', 'sport': '443', 'dport': '40000'}
+    assert entry['flags'] == ['ASSURED']
+    assert (entry['mark'], entry['zone']) == ('0', '0')
+    # conntrack -L leaves out the family columns
+    entry = parse_conntrack_line(DNAT_LINE)
+    assert (entry['family'], entry['protocol'], entry['state']) == ('ipv4', 'tcp', 'TIME_WAIT')
+    entry = parse_conntrack_line(UDP_LINE)
+    assert (entry['state'], entry['flags'], entry['reply']['src']) == ('', ['UNREPLIED'], '10.0.0.53')
+    assert parse_conntrack_line(ICMP_LINE)['original']['type'] == '8'
+    assert parse_conntrack_line('') is None
+
+
+def test_conntrack_tuples_and_nat():
+    assert conntrack_tuples(PROC_LINE) == ('tcp', 'ESTABLISHED', '10.0.0.5', '93.184.216.34', '40000', '443',
+                                           '93.184.216.34', '203.0.113.1', '443', '40000')
+    assert conntrack_nat(conntrack_tuples(PROC_LINE)) == 'SNAT 10.0.0.5 -> 203.0.113.1'
+    assert conntrack_nat(conntrack_tuples(DNAT_LINE)) == 'DNAT 203.0.113.1:443 -> 10.9.0.2:8443'
+    assert conntrack_nat(conntrack_tuples(UDP_LINE)) is None
+    assert conntrack_nat(conntrack_tuples(ICMP_LINE)) is None
+    assert conntrack_tuples('conntrack v1.4.6 (conntrack-tools): 3 flow entries have been shown.') is None
+
+
+def test_top_k_matches_exact_counts_for_the_heavy_hitters():
+    rng = random.Random(1)
+    keys = [f'10.0.0.{int(rng.paretovariate(1.1)) % 2000}' for _ in range(50000)]
+    top = TopK(10, 200)
+    for key in keys:
+        top.add(key)
+    exact = Counter(keys)
+    for item in top.top():
+        # Never under, over by at most the error it carries
+        assert exact[item['key']] <= item['count'] <= exact[item['key']] + item['error']
+    assert [item['key'] for item in top.top(3)] == [key for key, count in exact.most_common(3)]
+
+
+def test_count_min_sketch_never_undercounts():
+    sketch = CountMinSketch(width=64)
+    keys = [f'key{i % 300}' for i in range(3000)]
+    for key in keys:
+        sketch.add(key)
+    assert all(sketch.estimate(key) >= count for key, count in Counter(keys).items())
+
+
+def test_summary_of_a_synthetic_table(client, write_conntrack):
+    text = synthetic_conntrack(2000)
+    write_conntrack(text)
+    summary = client.get('/api/conntrack/summary').get_json()
+    lines = text.splitlines()
+    assert summary['total'] == len(lines)
+    assert summary['protocols'] == dict(Counter(line.split()[2] for line in lines))
+    sources = Counter(conntrack_tuples(line)[2] for line in lines)
+    assert summary['top']['source'][0] == {'key': sources.most_common(1)[0][0],
+                                           'count': sources.most_common(1)[0][1], 'error': 0}
+    nat = Counter(conntrack_nat(conntrack_tuples(line)) for line in lines)
+    nat.pop(None, None)
+    assert summary['top']['nat'][0]['count'] == nat.most_common(1)[0][1]
+
+
+def test_conntrack_paging(client, write_conntrack):
+    text = synthetic_conntrack(250)
+    write_conntrack(text)
+    lines = text.splitlines()
+    seen = []
+    offset = 0
+    while offset is not None:
+        page = client.get(f'/api/conntrack?offset={offset}&limit=100').get_json()
+        seen.extend(page['entries'])
+        offset = page['next']
+    assert len(seen) == len(lines)
+    assert [entry['original']['sport'] for entry in seen] == [parse_conntrack_line(line)['original']['sport']
+                                                              for line in lines]
+    dnat = client.get('/api/conntrack?destination=203.0.113.1&limit=500').get_json()
+    assert dnat['next'] is None
+    assert len(dnat['entries']) == sum(1 for line in lines if conntrack_tuples(line)[3] == '203.0.113.1')
+    assert all(entry['nat'].startswith('DNAT 203.0.113.1:443 -> 10.9.0.') for entry in dnat['entries'])
+    assert client.get('/api/conntrack?limit=10000').get_json()['limit'] == 500
+    assert client.get('/api/conntrack?offset=x').status_code == 400
+    assert client.get('/api/conntrack?limit=ten').status_code == 400
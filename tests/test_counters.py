@@ -0,0 +1,47 @@
+import threading
+
+import iptables_gui
+from conftest import EMPTY_RULES
+
+
+def test_counter_streams_are_capped(client):
+    streams = [client.get('/api/counters/stream') for _ in range(iptables_gui.COUNTER_STREAMS)]
+    assert all(stream.status_code == 200 for stream in streams)
+    refused = client.get('/api/counters/stream')
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After']
+    streams.pop().close()
+    reopened = client.get('/api/counters/stream')
+    assert reopened.status_code == 200
+    for stream in streams + [reopened]:
+        stream.close()
+    last = client.get('/api/counters/stream')
+    assert last.status_code == 200
+    last.close()
+
+
+def test_reads_after_a_write_do_not_join_an_earlier_read(monkeypatch, write_rules):
+    # The first save sees the rules as they were when it started and is held
+    # until the write is done
+    started = threading.Event()
+    release = threading.Event()
+    execute = iptables_gui.execute_command
+
+    def slow_save(argv, input=None):
+        output = execute(argv, input)
+        if not started.is_set():
+            started.set()
+            release.wait(5)
+        return output
+    monkeypatch.setattr(iptables_gui, 'execute_command', slow_save)
+    before = {}
+    reader = threading.Thread(target=lambda: before.update(output=iptables_gui.run_command(['iptables-save', '-c'])))
+    reader.start()
+    assert started.wait(5)
+    write_rules(EMPTY_RULES.replace(':INPUT ACCEPT', ':INPUT DROP'))
+    iptables_gui.run_command(['iptables', '-P', 'INPUT', 'DROP'])
+    after = iptables_gui.run_command(['iptables-save', '-c'])
+    release.set()
+    reader.join()
+    assert b':INPUT ACCEPT' in before['output']
+    assert b':INPUT DROP' in after
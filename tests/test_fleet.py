@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+from flask import Flask
+from werkzeug.serving import make_server
+
+import iptables_gui
+from iptables_gui import AgentRequestHandler, FleetHost, agent_api, fan_out, fleet_drift
+
+RULES = ('*filter\n:INPUT DROP [0:0]\n:FORWARD DROP [0:0]\n:OUTPUT ACCEPT [0:0]\n'
+         '-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\nCOMMIT\n')
+
+
+@pytest.fixture
+def agents(monkeypatch, write_rules):
+    # Agent stand-ins: the agent blueprint served on local ports, the way
+    # --agent serves it
+    monkeypatch.setattr(iptables_gui, 'AGENT_TOKEN', 'secret')
+    write_rules(RULES)
+    servers = []
+    for i in range(3):
+        agent_app = Flask(f'agent{i}')
+        agent_app.register_blueprint(agent_api)
+        server = make_server('127.0.0.1', 0, agent_app, threaded=True, request_handler=AgentRequestHandler)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+    hosts = [FleetHost(f'fw{i}', f'http://127.0.0.1:{server.server_port}', 'secret', ['dmz'] if i else ['core'])
+             for i, server in enumerate(servers)]
+    yield hosts
+    for server in servers:
+        server.shutdown()
+
+
+def test_fan_out_keeps_host_order_and_runs_hosts_at_once():
+    hosts = [FleetHost(f'fw{i}', 'http://127.0.0.1:1', '', []) for i in range(8)]
+
+    def call(host):
+        time.sleep(0.2)
+        if host.name == 'fw3':
+            raise RuntimeError('unreachable')
+        return {'value': host.name}
+    started = time.perf_counter()
+    results = fan_out(hosts, call, concurrency=8)
+    assert time.perf_counter() - started < 1
+    assert [result['host'] for result in results] == [host.name for host in hosts]
+    assert [result['ok'] for result in results] == [i != 3 for i in range(8)]
+    assert results[3]['error'] == 'unreachable'
+    assert fan_out([], call) == []
+
+
+def test_fleet_drift():
+    base = {'filter': {'INPUT': {'policy': 'DROP', 'rules': ['-p tcp -m tcp --dport 22 -j ACCEPT']}}}
+    drifted = {'filter': {'INPUT': {'policy': 'ACCEPT', 'rules': ['-p tcp -m tcp --dport 22 -j ACCEPT',
+                                                                 '-p tcp -m tcp --dport 80 -j ACCEPT']}}}
+    drift = fleet_drift({'fw1': base, 'fw2': base, 'fw3': drifted})
+    assert drift['policies'] == [{'table': 'filter', 'chain': 'INPUT',
+                                  'policies': {'fw1': 'DROP', 'fw2': 'DROP', 'fw3': 'ACCEPT'}}]
+    assert drift['rules'] == [{'table': 'filter', 'chain': 'INPUT', 'spec': '-p tcp -m tcp --dport 80 -j ACCEPT',
+                               'present': ['fw3'], 'missing': ['fw1', 'fw2']}]
+    assert fleet_drift({'fw1': base, 'fw2': base}) == {'policies': [], 'rules': []}
+
+
+def test_fleet_rulesets_from_agents(client, agents, monkeypatch):
+    bad_token = FleetHost('badtoken', agents[0].url, 'wrong', [])
+    down = FleetHost('down', 'http://127.0.0.1:9', 'secret', [])
+    monkeypatch.setattr(iptables_gui, 'fleet', agents + [bad_token, down])
+    data = client.get('/api/fleet/rulesets').get_json()
+    assert [(host['host'], host['ok']) for host in data['hosts']] == [
+        ('fw0', True), ('fw1', True), ('fw2', True), ('badtoken', False), ('down', False)]
+    assert data['hosts'][0]['rules'] == 1
+    assert data['hosts'][3]['error'] == 'Invalid agent token'
+    assert data['drift'] == {'policies': [], 'rules': []}
+    # The pooled keep-alive connection is reused
+    assert agents[0].idle.qsize() == 1
+
+
+def test_fleet_push_to_a_group(client, agents, monkeypatch, calls):
+    monkeypatch.setattr(iptables_gui, 'fleet', agents)
+    client.post('/stage/add_rule', data={'table': 'filter', 'chain': 'INPUT', 'action': 'ACCEPT',
+                                         'protocol': 'tcp', 'dest_port': '443'})
+    client.post('/stage/add_rule', data={'table': 'filter', 'chain': 'INPUT', 'action': 'ACCEPT',
+                                         'protocol': 'tcp', 'dest_port': '8443'})
+    data = client.post('/api/fleet/push', data={'group': 'dmz', 'dry_run': '1'}).get_json()
+    assert [result['host'] for result in data['results']] == ['fw1', 'fw2']
+    assert all(result['ok'] and result['dry_run'] for result in data['results'])
+    assert calls()['restore'].count('-A INPUT -p tcp --dport 443 -j ACCEPT') == 2
+    assert not any(command == 'iptables-restore -w 10 --noflush' for command in calls()['commands'])
+
+
+@pytest.mark.parametrize('form, error', [
+    ({}, 'No pending changes to push'),
+    ({'concurrency': 'lots'}, 'concurrency must be a number'),
+    ({'group': 'nowhere'}, 'No hosts in group nowhere'),
+])
+def test_fleet_push_refuses(client, agents, monkeypatch, form, error):
+    monkeypatch.setattr(iptables_gui, 'fleet', agents)
+    if form:
+        client.post('/stage/add_rule', data={'table': 'filter', 'chain': 'INPUT', 'action': 'ACCEPT'})
+    response = client.post('/api/fleet/push', data=form)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == error
@@ -0,0 +1,89 @@
+import os
+import threading
+
+import pytest
+
+import iptables_gui
+from conftest import EMPTY_RULES
+from iptables_gui import HelperClient, HelperServer, helper_refusal
+
+RULE_LINES = '*filter\n:INPUT ACCEPT [0:0]\n-A INPUT -p tcp -m comment --comment "ssh -- Main" -j ACCEPT\nCOMMIT\n'
+
+
+@pytest.mark.parametrize('argv, data', [
+    (['iptables-save', '-c'], None),
+    (['iptables', '-w', '10', '-t', 'filter', '-A', 'INPUT', '-p', 'tcp', '-m', 'statistic', '--mode', 'random',
+      '--probability', '0.5', '-j', 'DROP'], None),
+    (['ip6tables', '-t', 'nat', '-D', 'PREROUTING', '3'], None),
+    (['iptables-restore', '-w', '10', '--noflush', '--test'], RULE_LINES),
+    (['iptables-restore', '-w', '10'], RULE_LINES),
+    (['nft', '-f', '-'], 'add rule ip filter INPUT counter accept\n'),
+    (['ipset', 'restore'], 'create bad.new hash:net family inet\nadd bad.new 10.0.0.0/8\nswap bad.new bad\n'),
+    (['ipset', 'destroy', 'bad.new'], None),
+    (['conntrack', '-L'], None),
+])
+def test_helper_runs_what_the_app_sends(argv, data):
+    assert helper_refusal(argv, data) is None
+
+
+@pytest.mark.parametrize('argv, data', [
+    (['sh', '-c', 'id'], None),
+    (['iptables', '--modprobe=/tmp/x', '-t', 'filter', '-A', 'INPUT', '-j', 'DROP'], None),
+    (['iptables', '-t', 'filter', '-A', 'INPUT', '--modp', '/tmp/x', '-j', 'DROP'], None),
+    (['iptables', '-t', 'filter', '-A', 'INPUT', '-vM/tmp/x', '-j', 'DROP'], None),
+    (['iptables', '-t', 'filter', '-A', 'INPUT', '-m', '../../tmp/x', '-j', 'DROP'], None),
+    (['iptables', '-L', '-n'], None),
+    (['iptables', '-t', 'filter', '-A', 'INPUT; id', '-j', 'DROP'], None),
+    (['iptables-save', '-f', '/etc/shadow'], None),
+    (['iptables-restore', '-M', '/tmp/x'], None),
+    (['iptables-restore', '--noflush'], '*filter\n-A INPUT -M /tmp/x -j DROP\nCOMMIT\n'),
+    (['iptables-restore', '--noflush'], '*filter\n-A INPUT --modprobe=/tmp/x -j DROP\nCOMMIT\n'),
+    (['nft', '-f', '/etc/nftables.conf'], None),
+    (['nft', '-f', '-'], 'include "/etc/shadow"\n'),
+    (['nft', '-f', '-'], 'add rule ip filter INPUT accept; include "/etc/shadow"\n'),
+    (['ipset', 'save', '-file', '/etc/shadow'], None),
+    (['ipset', 'restore'], 'add bad 10.0.0.1 -file /etc/shadow\n'),
+    (['ipset', 'destroy', '../x'], None),
+])
+def test_helper_refuses_anything_else(argv, data):
+    assert helper_refusal(argv, data)
+
+
+@pytest.fixture
+def helper(tmp_path):
+    server = HelperServer(str(tmp_path / 'helper.sock'), [os.getuid()])
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield HelperClient(str(tmp_path / 'helper.sock'))
+    server.shutdown()
+    server.server_close()
+
+
+def test_helper_round_trip(helper, monkeypatch, tmp_path, write_rules):
+    write_rules(EMPTY_RULES)
+    returncode, stdout, stderr = helper.run(['iptables-save', '-c'])
+    assert (returncode, stdout.decode()) == (0, EMPTY_RULES)
+    with pytest.raises(PermissionError, match='modprobe'):
+        helper.run(['iptables', '-t', 'filter', '-A', 'INPUT', '--modprobe=/bin/sh', '-j', 'DROP'])
+    # save_rules writes the family's rules file, the client names no path
+    rules_file = tmp_path / 'rules.v4'
+    monkeypatch.setitem(iptables_gui.FAMILIES['ipv4'], 'rules_file', str(rules_file))
+    helper.save_rules('ipv4')
+    assert rules_file.read_text() == EMPTY_RULES
+
+
+def test_helper_streams_output(helper, monkeypatch, write_conntrack):
+    write_conntrack('ipv4 2 tcp 6 10 ESTABLISHED src=10.0.0.1 dst=10.0.0.2 sport=1 dport=22\n' * 3)
+    monkeypatch.setattr(iptables_gui, 'helper_client', helper)
+    assert len(list(iptables_gui.stream_command(['conntrack', '-L']))) == 3
+    with pytest.raises(PermissionError):
+        list(iptables_gui.stream_command(['journalctl', '-k', '-f', '-D', '/tmp']))
+
+
+def test_journal_is_read_through_the_helper(helper, monkeypatch):
+    monkeypatch.setattr(iptables_gui, 'helper_client', helper)
+    ingester = iptables_gui.LogIngester('journal', None)
+    chunks = ingester.follow_journal()
+    assert next(chunks) == [b'[12.5] ssh: IN=eth0 OUT= SRC=10.0.0.1 DST=10.0.0.2 PROTO=TCP SPT=40000 DPT=22']
+    with pytest.raises(RuntimeError, match='journalctl exited'):
+        next(chunks)
@@ -0,0 +1,48 @@
+import pytest
+
+import iptables_gui
+from conftest import STUB_DIR
+
+RULES = '*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n{rules}COMMIT\n'
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    store = iptables_gui.SnapshotStore(str(tmp_path), 500, 90)
+    monkeypatch.setattr(iptables_gui, 'snapshot_store', store)
+    return store
+
+
+def test_snapshots_are_read_fresh_for_the_written_family(client, write_rules, history):
+    write_rules(RULES.format(rules=''), 'ipv6')
+    iptables_gui.get_ruleset('ipv6')
+    # Changed behind the cache's back
+    with open(f'{STUB_DIR}/rules.v6', 'w') as f:
+        f.write(RULES.format(rules='-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\n'))
+    client.post('/add_rule', data={'family': 'ipv6', 'table': 'filter', 'chain': 'INPUT', 'action': 'DROP'})
+    event, = history.list()
+    assert (event['family'], event['reason'], event['rules']) == ('ipv6', 'before add_rule', 1)
+
+
+def test_dry_runs_leave_no_snapshot(client, write_rules, history):
+    write_rules(RULES.format(rules=''))
+    response = client.post('/api/rules/bulk?dry_run=1', json=[{'chain': 'INPUT', 'action': 'ACCEPT'}])
+    assert response.get_json()['dry_run']
+    assert history.list() == []
+
+
+def test_rollback_writes_the_family_of_the_snapshot(client, write_rules, history, calls):
+    write_rules(RULES.format(rules='-A INPUT -s 2001:db8::/32 -j DROP\n'), 'ipv6')
+    event = history.record(iptables_gui.get_ruleset('ipv6'), 'test', 'ipv6')
+    write_rules(RULES.format(rules=''), 'ipv6')
+    history.record(iptables_gui.get_ruleset('ipv4'), 'test', 'ipv4')
+    response = client.post('/history/rollback', data={'id': event['id'], 'family': 'ipv6'})
+    # Back on the tab the rollback was made from
+    assert response.headers['Location'] == '/?family=ipv6'
+    assert any(command.startswith('ip6tables ') and command.endswith('INPUT 1 -s 2001:db8::/32 -j DROP')
+               for command in calls()['commands'])
+
+
+def test_history_limit_is_validated(client, history):
+    assert client.get('/api/history?limit=ten').status_code == 400
+    assert client.get('/api/history?limit=5').get_json() == {'events': []}
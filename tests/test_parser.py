@@ -0,0 +1,67 @@
+from iptables_gui import parse_iptables_save, parse_rule_spec
+
+SAVE = """# Generated by iptables-save v1.8.7
+*nat
+:PREROUTING ACCEPT [12:720]
+:POSTROUTING ACCEPT [3:180]
+[4:240] -A PREROUTING -d 203.0.113.1/32 -p tcp -m tcp --dport 443 -j DNAT --to-destination 10.9.0.2:8443
+[9:540] -A POSTROUTING -s 10.0.0.0/8 -o eth0 -j MASQUERADE
+COMMIT
+*filter
+:INPUT DROP [100:6000]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:SSH - [0:0]
+[50:3000] -A INPUT -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
+[7:420] -A INPUT ! -s 10.0.0.0/8 -i eth0 -p tcp -m multiport --dports 22,2222 -g SSH
+[0:0] -A INPUT -f -j DROP
+[2:120] -A SSH -m comment --comment "rate limit ssh" -j ACCEPT
+COMMIT
+"""
+
+
+def test_parse_tables_chains_and_counters():
+    ruleset = parse_iptables_save(SAVE)
+    assert list(ruleset) == ['nat', 'filter']
+    assert list(ruleset['filter']) == ['INPUT', 'FORWARD', 'OUTPUT', 'SSH']
+    chain = ruleset['filter']['INPUT']
+    assert (chain['policy'], chain['packets'], chain['bytes']) == ('DROP', 100, 6000)
+    assert ruleset['filter']['SSH']['policy'] is None
+    assert [(rule['num'], rule['packets'], rule['bytes']) for rule in chain['rules']] == [(1, 50, 3000), (2, 7, 420),
+                                                                                        (3, 0, 0)]
+    dnat = ruleset['nat']['PREROUTING']['rules'][0]
+    assert (dnat['destination'], dnat['protocol'], dnat['dport'], dnat['target']) == ('203.0.113.1/32', 'tcp',
+                                                                                    '443', 'DNAT')
+    assert dnat['extra'] == '-m tcp --dport 443 --to-destination 10.9.0.2:8443'
+
+
+def test_parse_rule_spec_fields():
+    rule = parse_rule_spec('! -s 10.0.0.0/8 -i eth0 -p tcp -m multiport --dports 22,2222 -g SSH')
+    assert (rule['source'], rule['destination'], rule['in_interface'], rule['out_interface']) == (
+        '!10.0.0.0/8', '0.0.0.0/0', 'eth0', '*')
+    assert (rule['protocol'], rule['dport'], rule['target'], rule['goto']) == ('tcp', '22,2222', 'SSH', True)
+    assert rule['matches'] == ['multiport']
+    assert parse_rule_spec('-f -j DROP')['opt'] == '-f'
+    assert parse_rule_spec('! -f -j DROP')['opt'] == '!f'
+    negated = parse_rule_spec('-p tcp -m tcp ! --dport 22 -j ACCEPT')
+    assert (negated['dport'], negated['extra']) == ('!22', '-m tcp ! --dport 22')
+    assert parse_rule_spec('-j ACCEPT', 'ipv6')['source'] == '::/0'
+
+
+def test_parse_quoted_comment():
+    rule = parse_iptables_save(SAVE)['filter']['SSH']['rules'][0]
+    assert rule['tokens'] == ['-m', 'comment', '--comment', 'rate limit ssh', '-j', 'ACCEPT']
+    assert rule['spec'] == '-m comment --comment "rate limit ssh" -j ACCEPT'
+
+
+def save_commands(calls):
+    return [command.split()[0] for command in calls()['commands'] if command.split()[0].endswith('-save')]
+
+
+def test_page_load_reads_each_family_once(client, write_rules, calls):
+    write_rules(SAVE)
+    assert client.get('/').status_code == 200
+    assert sorted(save_commands(calls)) == ['ip6tables-save', 'iptables-save']
+    # Served from the snapshot until a change invalidates it
+    assert client.get('/').status_code == 200
+    assert len(save_commands(calls)) == 2
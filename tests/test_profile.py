@@ -0,0 +1,45 @@
+import iptables_gui
+from iptables_gui import parse_iptables_save, profile_ruleset
+
+# A multiport rule whose port list includes an earlier DROP's single port
+# must stay below it
+BLOCKED = """*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+[1:10] -A INPUT -p udp -m udp --dport 22 -j DROP
+[5000:50000] -A INPUT -s 10.2.0.0/16 -p udp -m multiport --dports 22,80 -j ACCEPT
+COMMIT
+"""
+
+# Nothing the hot rule matches can reach the rules above it
+FREE = """*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+[1:10] -A INPUT -p udp -m udp --dport 53 -j DROP
+[1:10] -A INPUT -s 10.3.0.0/16 -j DROP
+[5000:50000] -A INPUT -s 10.2.0.0/16 -p tcp -m tcp --dport 22 -j ACCEPT
+COMMIT
+"""
+
+
+def proposals(text):
+    report = profile_ruleset(parse_iptables_save(text))
+    return [proposal for chain in report['chains'] for proposal in chain['proposals']]
+
+
+def test_hot_rule_moves_above_rules_it_cannot_meet():
+    moves = proposals(FREE)
+    assert [(move['num'], move['to'], move['blocked_by']) for move in moves] == [(3, 1, None)]
+
+
+def test_no_move_past_a_rule_sharing_a_port():
+    assert proposals(BLOCKED) == []
+
+
+def test_moves_are_checked_past_the_index(monkeypatch):
+    # An index that misses every blocker still can't produce an unsafe move
+    monkeypatch.setattr(iptables_gui.ShapeIndex, 'last_earlier_blocker', lambda self, shape: None)
+    assert proposals(BLOCKED) == []
+    assert [(move['num'], move['to']) for move in proposals(FREE)] == [(3, 1)]
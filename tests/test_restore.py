@@ -0,0 +1,101 @@
+import io
+import random
+
+import pytest
+
+from iptables_gui import diff_chain, diff_rulesets, parse_iptables_save, parse_rule_spec
+
+SPECS = ['-p tcp -m tcp --dport 22 -j ACCEPT', '-p tcp -m tcp --dport 80 -j ACCEPT', '-s 10.0.0.0/8 -j DROP',
+         '-p udp -m udp --dport 53 -j ACCEPT', '-i lo -j ACCEPT', '-j LOG']
+LIVE = """*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:OLD - [0:0]
+[10:600] -A INPUT -i lo -j ACCEPT
+[20:1200] -A INPUT -p tcp -m tcp --dport 22 -j ACCEPT
+[30:1800] -A INPUT -p tcp -m tcp --dport 80 -j ACCEPT
+-A OLD -j DROP
+COMMIT
+"""
+
+
+def rules(specs):
+    return [parse_rule_spec(spec) for spec in specs]
+
+
+def apply(specs, changes):
+    # What iptables does with the deletes and inserts, in order. A delete by
+    # spec takes the first rule with that spec
+    specs = list(specs)
+    for change in changes:
+        if change['op'] == 'delete':
+            if change['position']:
+                assert specs[change['position'] - 1] == change['spec']
+                del specs[change['position'] - 1]
+            else:
+                specs.remove(change['spec'])
+        else:
+            specs.insert(change['position'] - 1, change['spec'])
+    return specs
+
+
+def test_diff_chain_reaches_the_target():
+    rng = random.Random(3)
+    for _ in range(2000):
+        live = [rng.choice(SPECS) for _ in range(rng.randrange(8))]
+        target = [rng.choice(SPECS) for _ in range(rng.randrange(8))]
+        changes, summary = diff_chain('filter', 'INPUT', rules(live), rules(target))
+        assert apply(live, changes) == target
+        assert summary['unchanged'] + len(summary['removed']) + len(summary['moved']) == len(live)
+        assert summary['unchanged'] + len(summary['added']) + len(summary['moved']) == len(target)
+
+
+def test_diff_chain_leaves_unchanged_rules_alone():
+    live = SPECS[:4]
+    changes, summary = diff_chain('filter', 'INPUT', rules(live), rules(live[:2] + [SPECS[5]] + live[2:]))
+    assert changes == [{'op': 'insert', 'table': 'filter', 'chain': 'INPUT', 'position': 3, 'spec': SPECS[5]}]
+    assert (summary['added'], summary['removed'], summary['unchanged']) == ([SPECS[5]], [], 4)
+    changes, summary = diff_chain('filter', 'INPUT', rules(live), rules(live[1:] + live[:1]))
+    assert (summary['moved'], summary['unchanged']) == ([SPECS[0]], 3)
+    assert len(changes) == 2
+
+
+def test_duplicates_are_deleted_by_position():
+    live = [SPECS[5], SPECS[0], SPECS[5]]
+    changes, _ = diff_chain('filter', 'INPUT', rules(live), rules(live[:2]))
+    assert changes == [{'op': 'delete', 'table': 'filter', 'chain': 'INPUT', 'spec': SPECS[5], 'position': 3}]
+
+
+def test_diff_rulesets_creates_and_deletes_chains():
+    target = LIVE.replace(':OLD - [0:0]', ':NEW - [0:0]').replace('-A OLD -j DROP', '-A NEW -j DROP')
+    target = target.replace(':INPUT ACCEPT', ':INPUT DROP')
+    changes, chains = diff_rulesets(parse_iptables_save(LIVE), parse_iptables_save(target))
+    assert [change['op'] for change in changes] == ['new_chain', 'insert', 'policy', 'delete_chain']
+    assert {chain['chain']: chain.get('policy') for chain in chains} == {'INPUT': ['ACCEPT', 'DROP'],
+                                                                       'NEW': None, 'OLD': None}
+
+
+def upload(text):
+    return {'rules_file': (io.BytesIO(text.encode()), 'rules.v4')}
+
+
+def test_restore_applies_only_the_difference(client, write_rules, calls):
+    write_rules(LIVE)
+    target = LIVE.replace('[20:1200] -A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\n', '')
+    preview = client.post('/api/restore/preview', data=upload(target)).get_json()
+    assert preview['changes'] == 1
+    assert preview['chains'][0]['removed'] == ['-p tcp -m tcp --dport 22 -j ACCEPT']
+    assert client.post('/restore_rules', data=upload(target)).status_code == 302
+    log = calls()
+    assert [command for command in log['commands'] if not command.startswith('iptables-save')] == [
+        'iptables -w 10 -t filter -D INPUT -p tcp -m tcp --dport 22 -j ACCEPT']
+    assert log['restore'] == ''
+
+
+@pytest.mark.parametrize('text', ['*filter\n-I INPUT -j DROP\nCOMMIT\n', 'iptables -A INPUT -j DROP\n'])
+def test_restore_refuses_what_it_cannot_diff(client, write_rules, text):
+    write_rules(LIVE)
+    response = client.post('/api/restore/preview', data=upload(text))
+    assert response.status_code == 400
+    assert 'Not iptables-save output' in response.get_json()['error']
@@ -0,0 +1,16 @@
+RULES = '*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n{rules}COMMIT\n'
+
+
+def test_search_reads_the_requested_family(client, write_rules):
+    write_rules(RULES.format(rules='-A INPUT -s 10.0.0.0/8 -p tcp -m tcp --dport 22 -j ACCEPT\n'))
+    write_rules(RULES.format(rules='-A INPUT -j LOG\n-A INPUT -s 2001:db8::/32 -j DROP\n'), 'ipv6')
+    ipv4 = client.get('/api/search?address=10.1.2.3&port=22')
+    assert [(rule['num'], rule['sides']) for rule in ipv4.get_json()['rules']] == [(1, ['source'])]
+    ipv6 = client.get('/api/search?address=2001:db8::1&family=ipv6')
+    assert ipv6.get_json()['family'] == 'ipv6'
+    assert [rule['spec'] for rule in ipv6.get_json()['rules']] == ['-s 2001:db8::/32 -j DROP']
+    assert ipv6.headers['ETag'] != ipv4.headers['ETag']
+    # The ETag of one family never answers for the other
+    again = client.get('/api/search?address=2001:db8::1&family=ipv6', headers={'If-None-Match': ipv4.headers['ETag']})
+    assert again.status_code == 200
+    assert client.get('/api/search?address=2001:db8::1', headers={'If-None-Match': ipv4.headers['ETag']}).status_code == 304
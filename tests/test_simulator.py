@@ -0,0 +1,94 @@
+import random
+
+import pytest
+
+import iptables_gui
+from iptables_gui import PacketSimulator, parse_iptables_save, parse_packet
+
+SOURCES = ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3/32', '192.168.0.0/16']
+PORTS = ['22', '80', '443', '1024:65535', '22,80,443']
+STATES = ['NEW', 'ESTABLISHED,RELATED', 'INVALID']
+INTERFACES = ['eth0', 'eth1', 'eth+', 'lo']
+
+
+def random_spec(rng, targets, sourced=0.5):
+    spec = []
+    if rng.random() < sourced:
+        spec += ['!'] * (rng.random() < 0.2) + ['-s', rng.choice(SOURCES)]
+    if rng.random() < 0.3:
+        spec += ['-d', rng.choice(SOURCES)]
+    if rng.random() < 0.3:
+        spec += ['-i', rng.choice(INTERFACES)]
+    if rng.random() < 0.6:
+        protocol = rng.choice(['tcp', 'udp', 'icmp'])
+        spec += ['-p', protocol]
+        port = rng.choice(PORTS)
+        if protocol != 'icmp' and ',' in port:
+            spec += ['-m', 'multiport', rng.choice(['--dports', '--ports']), port]
+        elif protocol != 'icmp' and rng.random() < 0.7:
+            spec += ['-m', protocol] + ['!'] * (rng.random() < 0.2) + [rng.choice(['--dport', '--sport']), port]
+    if rng.random() < 0.2:
+        spec += ['-m', 'conntrack', '--ctstate', rng.choice(STATES)]
+    return ' '.join(spec + rng.choice(targets))
+
+
+def random_ruleset(rng, length, sourced=0.5):
+    lines = ['*filter', ':INPUT DROP [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]',
+             ':WEB - [0:0]', ':ADMIN - [0:0]']
+    targets = [['-j', 'ACCEPT'], ['-j', 'DROP'], ['-j', 'REJECT'], ['-j', 'WEB'], ['-g', 'ADMIN'], ['-j', 'LOG']]
+    lines += ['-A INPUT ' + random_spec(rng, targets, sourced) for _ in range(length)]
+    lines += ['-A WEB ' + random_spec(rng, targets[:3] + [['-j', 'RETURN'], ['-j', 'ADMIN']]) for _ in range(5)]
+    lines += ['-A ADMIN ' + random_spec(rng, targets[:3] + [['-j', 'RETURN']]) for _ in range(5)]
+    return parse_iptables_save('\n'.join(lines + ['COMMIT', '']))
+
+
+def random_packets(rng, count):
+    protocols = ['tcp', 'udp', 'icmp']
+    return [parse_packet({'src': f'{rng.choice(["10.1.2", "10.1.9", "10.7.0", "192.168.4"])}.{rng.randrange(1, 5)}',
+                          'dst': '10.1.2.3', 'protocol': rng.choice(protocols),
+                          'sport': rng.choice(['', '22', '5000']), 'dport': rng.choice(['22', '80', '443', '8080']),
+                          'in_interface': rng.choice(['eth0', 'eth1', 'lo', '']),
+                          'state': rng.choice(['NEW', 'ESTABLISHED', 'INVALID']), 'hook': 'input'})
+            for _ in range(count)]
+
+
+def traced(simulator, packets):
+    return [{key: result[key] for key in ('verdict', 'table', 'chain', 'num')}
+            for result in map(simulator.trace, packets)]
+
+
+@pytest.mark.skipif(iptables_gui.np is None, reason='numpy not installed')
+@pytest.mark.parametrize('length, sourced', [(10, 0.5), (80, 0.5), (80, 0.95)])
+def test_batch_agrees_with_trace(length, sourced):
+    # Past PARTITION_MIN_RULES with mostly sourced rules the chain is split
+    # into prefix buckets
+    rng = random.Random(length)
+    for _ in range(30):
+        simulator = PacketSimulator(random_ruleset(rng, length, sourced))
+        packets = random_packets(rng, 200)
+        assert simulator.run_batch(packets) == traced(simulator, packets)
+
+
+def test_batch_without_numpy_or_for_ipv6(monkeypatch):
+    rng = random.Random(7)
+    simulator = PacketSimulator(random_ruleset(rng, 20))
+    packets = random_packets(rng, 50)
+    expected = traced(simulator, packets)
+    monkeypatch.setattr(iptables_gui, 'np', None)
+    assert simulator.run_batch(packets) == expected
+    ipv6 = [parse_packet({'src': '2001:db8::1', 'dst': '2001:db8::2', 'dport': '22'})]
+    assert simulator.run_batch(ipv6) == traced(simulator, ipv6)
+
+
+def test_api_simulate_batch(client, write_rules):
+    write_rules('*filter\n:INPUT DROP [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n'
+                '-A INPUT -s 10.0.0.0/8 -p tcp -m tcp --dport 22 -j ACCEPT\nCOMMIT\n')
+    response = client.post('/api/simulate', json={'packets': [
+        {'src': '10.1.1.1', 'dst': '10.0.0.1', 'dport': '22'},
+        {'src': '192.0.2.1', 'dst': '10.0.0.1', 'dport': '22'},
+        {'src': 'nowhere', 'dst': '10.0.0.1'}]})
+    data = response.get_json()
+    assert data['count'] == 2
+    assert data['summary'] == {'ACCEPT': 1, 'DROP': 1}
+    assert data['decided_by'] == {'filter/INPUT/1': 1, 'filter/INPUT/policy': 1}
+    assert [error['line'] for error in data['errors']] == [3]
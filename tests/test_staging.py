@@ -0,0 +1,20 @@
+import iptables_gui
+
+RULES = ('*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\n'
+         '-A INPUT -j LOG\n-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\n-A INPUT -j LOG\nCOMMIT\n')
+
+
+def test_staged_delete_names_the_rule_by_spec(client, write_rules, calls):
+    write_rules(RULES)
+    client.post('/stage/delete_rule', data={'table': 'filter', 'chain': 'INPUT', 'rule_number': '2'})
+    change, = iptables_gui.pending_changes.list()
+    assert (change['op'], change['spec']) == ('delete', '-p tcp -m tcp --dport 22 -j ACCEPT')
+    client.post('/commit_changes')
+    assert calls()['commands'][-1].endswith('-D INPUT -p tcp -m tcp --dport 22 -j ACCEPT')
+
+
+def test_staged_delete_of_a_repeated_rule_is_refused(client, write_rules):
+    write_rules(RULES)
+    response = client.post('/stage/delete_rule', data={'table': 'filter', 'chain': 'INPUT', 'rule_number': '3'})
+    assert 'more than once' in response.get_data(as_text=True)
+    assert iptables_gui.pending_changes.list() == []